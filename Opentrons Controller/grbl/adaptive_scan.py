@@ -0,0 +1,281 @@
+"""
+Adaptive field mapping: octree refinement where the field is not linear.
+
+A uniform grid at fixed spacing spends most of its points where the field is smooth. Here the bore volume is first
+covered by a coarse lattice of cubic cells, each measured at its 8 corners and its center. A linear model of the
+field (value and gradient) is fitted to the readings of each cell. The curvature (gradient of the gradient) is
+estimated by differencing the fitted gradients of neighbouring cells. Where the residual of the linear model or the
+curvature is above tolerance, the cell is split into 8 and the new corners and centers measured. Refinement goes
+worst cell first, round by round, until every cell is within tolerance or the point or time budget runs out, so the
+points end up at the bore edges where the nonlinearity is.
+
+Cells with too few points inside the bore to fit (fewer than 5) are split after all fitted cells, down to
+settings['edge_size'], so the bore edge is covered at that spacing at least.
+
+Each round is measured like measure_points.py, through utilities.scan_points_async, in shortest travel order.
+"""
+import asyncio
+import heapq
+import time
+
+import numpy as np
+
+import scan_order
+import utilities
+from robot import robot
+
+# Refinement settings: residual of the linear model in mT, curvature in mT/mm^2, cell sizes in mm
+settings = {'coarse': 40, 'min_size': 5, 'edge_size': 10, 'tolerance': 0.005, 'curvature_tolerance': 1e-4,
+            'max_points': 2000, 'max_time': None, 'clearance': 20}
+
+# Corners and center of the unit cell, in half sizes
+cell_offsets = np.vstack([np.array(np.meshgrid([-1, 1], [-1, 1], [-1, 1], indexing='ij')).reshape(3, -1).T,
+                          np.zeros((1, 3))])
+
+
+def _key(point):
+    # Points shared between cells are measured once
+    return tuple(np.round(point, 3))
+
+
+class Cell:
+    def __init__(self, center, size):
+        self.center = np.asarray(center, dtype=float)
+        self.size = size
+        # Unknown until fitted, or if too few of the cell's points are inside the bore
+        self.residual = np.nan
+        # Fitted gradient in mT/mm, row i is the gradient of field component i
+        self.gradient = None
+        # Largest gradient difference to a neighbouring cell per mm, nan without fitted neighbours
+        self.curvature = np.nan
+
+    @property
+    def points(self):
+        return self.center + cell_offsets * self.size / 2
+
+    def children(self):
+        return [Cell(self.center + offset * self.size / 4, self.size / 2) for offset in cell_offsets[:8]]
+
+    def fit(self, fields):
+        """
+        Fit a linear field model to the cell's readings and keep how far the readings are from it.
+        :param fields: (k, 3) readings in mT of the cell's valid points, None for points outside the bore
+        :return:
+        """
+        measured = [(point, field) for point, field in zip(self.points, fields) if field is not None]
+        if len(measured) < 5:
+            # Too few points inside the bore to tell
+            self.residual = np.nan
+            self.gradient = None
+            return
+
+        points = np.array([point for point, _ in measured]) - self.center
+        values = np.array([field for _, field in measured])
+        design = np.hstack([np.ones((len(points), 1)), points])
+        coefficients = np.linalg.lstsq(design, values, rcond=None)[0]
+
+        self.residual = np.max(np.abs(design @ coefficients - values))
+        self.gradient = coefficients[1:].T
+
+    @property
+    def fitted(self):
+        return self.gradient is not None
+
+    @property
+    def excess(self):
+        # How far over tolerance the cell is, by its worse criterion
+        excess = self.residual / settings['tolerance']
+        if np.isfinite(self.curvature):
+            excess = max(excess, self.curvature / settings['curvature_tolerance'])
+        return excess
+
+    @property
+    def priority(self):
+        # Furthest over tolerance first, cells that could not be fitted after all others
+        return -self.excess if self.fitted else np.inf
+
+    def needs_split(self):
+        if not self.fitted:
+            return self.size / 2 >= settings['edge_size']
+        return self.size / 2 >= settings['min_size'] and self.excess > 1
+
+
+class AdaptiveScan:
+    def __init__(self, x, y, z, r, l=utilities.bore_length, measure=None):
+        """
+        :param x, y, z: bore center in Opentrons coordinates
+        :param r: bore radius in mm, points keep settings['clearance'] from the wall
+        :param l: bore length along X in mm
+        :param measure: function of an (N, 3) array of points returning their (N, 3) fields in mT,
+                        defaults to moving the robot there and reading the probe
+        """
+        self.center = np.array([x, y, z], dtype=float)
+        self.radius = r - settings['clearance']
+        self.length = l
+        self.measure = measure if measure is not None else self._measure
+
+        # Readings by point key, in the order they were measured, and the cell size each point was added at
+        self.fields = {}
+        self.points = []
+        self.spacing = []
+        self.cells = []
+        self.measure_time = 0.0
+
+    def valid(self, points):
+        # Inside the bore cylinder with clearance and inside the Opentrons workspace
+        points = np.atleast_2d(points)
+        radial = np.linalg.norm(points[:, 1:] - self.center[1:], axis=1)
+        inside = (radial <= self.radius) & (np.abs(points[:, 0] - self.center[0]) <= self.length / 2)
+        for axis, limits in enumerate([utilities.opentrons_x_range, utilities.opentrons_y_range,
+                                       utilities.opentrons_z_range]):
+            inside &= (points[:, axis] >= limits[0]) & (points[:, axis] <= limits[1])
+        return inside
+
+    def coarse_cells(self):
+        # Lattice of cells of the coarse size covering the bore, centered on the bore center
+        size = settings['coarse']
+        extent = np.array([self.length, 2 * self.radius, 2 * self.radius])
+        counts = np.ceil(extent / size).astype(int)
+        axes = [self.center[i] + (np.arange(counts[i]) - (counts[i] - 1) / 2) * size for i in range(3)]
+        centers = np.array(np.meshgrid(*axes, indexing='ij')).reshape(3, -1).T
+        return [Cell(center, size) for center in centers if np.any(self.valid(Cell(center, size).points))]
+
+    def _measure(self, points):
+        return asyncio.run(utilities.scan_points_async(points))
+
+    def _new_points(self, cells):
+        # Valid points of the cells that have not been measured yet, with the cell size they come from
+        new = {}
+        for cell in cells:
+            points = cell.points[self.valid(cell.points)]
+            for point in points:
+                key = _key(point)
+                if key not in self.fields and key not in new:
+                    new[key] = (point, cell.size)
+        return new
+
+    def _measure_points(self, new):
+        if not new:
+            return
+        points = np.array([point for point, _ in new.values()])
+        sizes = [size for _, size in new.values()]
+
+        # Visit the points of the round in shortest travel order from where the robot is
+        order = scan_order.order_points(points, robot.max_rate, start=robot.pos)[0]
+        index = {_key(point): i for i, point in enumerate(points)}
+        order = np.array([index[_key(point)] for point in order])
+
+        start = time.monotonic()
+        fields = self.measure(points[order])
+        self.measure_time += time.monotonic() - start
+
+        for i, field in zip(order, fields):
+            self.fields[_key(points[i])] = np.asarray(field)
+            self.points.append(points[i])
+            self.spacing.append(sizes[i])
+
+    def _fit(self, cell):
+        cell.fit([self.fields.get(_key(point)) for point in cell.points])
+
+    def _update_curvature(self):
+        """
+        Estimate the gradient of the gradient of every fitted cell from its face neighbours: the largest difference
+        of fitted gradients divided by the distance between the cell centers, in mT/mm^2.
+        """
+        cells = [cell for cell in self.cells if cell.fitted]
+        for cell in self.cells:
+            cell.curvature = np.nan
+        if len(cells) < 2:
+            return
+
+        centers = np.array([cell.center for cell in cells])
+        half = np.array([cell.size / 2 for cell in cells])
+        gradients = np.array([cell.gradient for cell in cells])
+
+        for i, cell in enumerate(cells):
+            # Cells sharing a face: touching along one axis and overlapping along the other two
+            gap = np.abs(centers - centers[i]) - (half + half[i])[:, None]
+            touching = np.isclose(gap, 0, atol=1e-6)
+            overlapping = gap < -1e-6
+            neighbours = (touching.sum(axis=1) == 1) & (overlapping.sum(axis=1) == 2)
+            if not np.any(neighbours):
+                continue
+            distance = np.linalg.norm(centers[neighbours] - centers[i], axis=1)
+            change = np.abs(gradients[neighbours] - gradients[i]).max(axis=(1, 2))
+            cell.curvature = np.max(change / distance)
+
+    def _over_budget(self, n_new):
+        if len(self.points) + n_new > settings['max_points']:
+            return True
+        if settings['max_time'] is not None and self.points:
+            # Predict the round from the time per point so far
+            per_point = self.measure_time / len(self.points)
+            return self.measure_time + n_new * per_point > settings['max_time']
+        return False
+
+    def run(self):
+        """
+        Measure the coarse lattice, then refine until within tolerance or out of budget.
+        :return: (N, 3) points in Opentrons coordinates, (N, 3) fields in mT, (N,) cell size each point was added at
+        """
+        self.cells = self.coarse_cells()
+        self._measure_points(self._new_points(self.cells))
+        for cell in self.cells:
+            self._fit(cell)
+        self._update_curvature()
+
+        while True:
+            # Worst cells first: split as many of them as the budget allows this round
+            candidates = [(cell.priority, i, cell) for i, cell in enumerate(self.cells) if cell.needs_split()]
+            if not candidates:
+                print("Adaptive scan: all cells within tolerance")
+                break
+            heapq.heapify(candidates)
+
+            split = []
+            children = []
+            new = {}
+            while candidates:
+                cell = heapq.heappop(candidates)[2]
+                cell_children = [child for child in cell.children() if np.any(self.valid(child.points))]
+                cell_new = self._new_points(cell_children)
+                cell_new = {key: value for key, value in cell_new.items() if key not in new}
+                if self._over_budget(len(new) + len(cell_new)):
+                    break
+                split.append(cell)
+                children += cell_children
+                new.update(cell_new)
+
+            if not split:
+                print("Adaptive scan: budget reached")
+                break
+
+            self._measure_points(new)
+            split_ids = {id(cell) for cell in split}
+            self.cells = [cell for cell in self.cells if id(cell) not in split_ids] + children
+            for cell in children:
+                self._fit(cell)
+            residuals = [cell.residual for cell in split if cell.fitted]
+            curvatures = [cell.curvature for cell in split if np.isfinite(cell.curvature)]
+            self._update_curvature()
+            print(f"Adaptive scan: split {len(split)} cells, {len(self.points)} points measured"
+                  + (f", worst residual {max(residuals) * 1000:.2f} uT" if residuals else "")
+                  + (f", worst curvature {max(curvatures) * 1000:.3f} uT/mm^2" if curvatures else ""))
+
+        return np.array(self.points), np.array([self.fields[_key(point)] for point in self.points]), \
+            np.array(self.spacing)
+
+
+if __name__ == '__main__':
+    # Map the bore around the origin set in the App, saved in its coordinates like measure_points.py
+    origin_info = utilities.read_points("origin_info.csv")
+    origin = origin_info[0]
+    rotation_matrix = origin_info[1:4]
+
+    utilities.connect_robot()
+    utilities.connect_probe()
+
+    points, fields, spacing = AdaptiveScan(*origin, utilities.bore_radius).run()
+
+    true_coordinates = (points - origin) @ rotation_matrix.T
+    utilities.save_readings(true_coordinates, fields, "field_readings_adaptive.csv", extra={"Spacing[mm]": spacing})
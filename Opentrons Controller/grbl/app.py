@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D  # Required for 3D plotting
 
 import utilities
+from jog import Jogger, JogKeys
 
 class App:
     def __init__(self):
@@ -23,6 +24,9 @@ class App:
         self.step_size_idx = 2
         self.step_size = self.step_sizes[self.step_size_idx]
 
+        # Moves run on the jogger's thread so the GUI stays responsive
+        self.jogger = Jogger()
+
         # GUI elements
         self.root = None
 
@@ -46,17 +50,18 @@ class App:
         self._setup_generate_points()
         self._setup_visualize_points_button()
 
+        self.jogger.start()
         self.root.mainloop()
+        self.jogger.stop()
 
     def _setup_key_bindings(self):
         self.root.bind('<Shift_L>', lambda event: self.increase_step())
         self.root.bind('<Control_L>', lambda event: self.decrease_step())
-        self.root.bind('<w>', lambda event: self.move_forward())
-        self.root.bind('<s>', lambda event: self.move_backward())
-        self.root.bind('<a>', lambda event: self.move_left())
-        self.root.bind('<d>', lambda event: self.move_right())
-        self.root.bind('<e>', lambda event: self.move_up())
-        self.root.bind('<q>', lambda event: self.move_down())
+        # Tap to step, hold to jog
+        self.jog_keys = JogKeys(self.root, self.jogger,
+                                {'w': (0, 1, 0), 's': (0, -1, 0), 'a': (-1, 0, 0),
+                                 'd': (1, 0, 0), 'e': (0, 0, 1), 'q': (0, 0, -1)},
+                                step_size=lambda: self.step_size)
 
     def _setup_step_size_controls(self):
         step_selection = tk.Frame(self.root)
@@ -203,27 +208,27 @@ class App:
 
     def move_forward(self):
         pos = [0,self.step_size,0]
-        utilities.move_relative(pos)
+        self.jogger.step(pos)
 
     def move_backward(self):
         pos = [0,-self.step_size,0]
-        utilities.move_relative(pos)
+        self.jogger.step(pos)
 
     def move_left(self):
         pos = [-self.step_size,0,0]
-        utilities.move_relative(pos)
+        self.jogger.step(pos)
 
     def move_right(self):
         pos = [self.step_size,0,0]
-        utilities.move_relative(pos)
+        self.jogger.step(pos)
 
     def move_up(self):
         pos = [0,0,self.step_size]
-        utilities.move_relative(pos)
+        self.jogger.step(pos)
 
     def move_down(self):
         pos = [0,0,-self.step_size]
-        utilities.move_relative(pos)
+        self.jogger.step(pos)
 
     def add_position(self):
         bot_pos = utilities.get_position()
@@ -299,8 +304,13 @@ class App:
                                                              float(self.radius_entry.get()))
         
 
+        # Order points for the shortest travel, starting from the current position
+        self.valid_points, travel_time, original_time = utilities.order_points(self.valid_points,
+                                                                               start=utilities.get_position())
+
         # Save valid points to CSV
-        utilities.save_points("valid_points.csv", self.valid_points)
+        footer = f"Predicted travel time {travel_time:.1f} s, saving {original_time - travel_time:.1f} s over grid order"
+        utilities.save_points("valid_points.csv", self.valid_points, footer=footer)
         print("Valid points saved to valid_points.csv")
 
         origin_info = np.array([origin, x_hat, y_hat, z_hat])
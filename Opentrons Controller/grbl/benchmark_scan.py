@@ -0,0 +1,82 @@
+"""
+Throughput benchmark of measure_points.py-style scans against the simulated gerbl device.
+
+Runs without the CNC or the probe, so it can be used in CI to compare driver changes:
+    python benchmark_scan.py --spacing 20 --time-scale 20
+
+The scan mode runs the full measure_points.py loop, utilities.scan_points_async, against the simulated probe:
+    python benchmark_scan.py --modes scan --average 1000
+
+Motion time is what the simulated machine spends moving (in wall-clock seconds at the given time scale),
+overhead is everything else: serial round-trips, status polling latency and host-side work.
+"""
+import argparse
+import asyncio
+import time
+
+from grbl_sim import GrblSimulator
+from robot import robot
+import utilities
+
+
+def run(simulator, points, mode):
+    # Time one pass over the points with the given motion mode
+    simulator.machine_time = 0.0
+    start = time.perf_counter()
+
+    if mode == 'move_head':
+        for point in points:
+            robot.move_head(x=point[0], y=point[1], z=point[2])
+    elif mode == 'stream':
+        # Sync at every point as a probe reading would
+        robot.stream_points(points, on_point=lambda i, point: None)
+    elif mode == 'stream_nosync':
+        robot.stream_points(points)
+        robot.wait_until_idle()
+    elif mode == 'scan':
+        # Move, measure and process each point like measure_points.py
+        asyncio.run(utilities.scan_points_async(points))
+
+    wall = time.perf_counter() - start
+    motion = simulator.machine_time / simulator.time_scale
+    return wall, motion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scan throughput against a simulated gerbl device")
+    parser.add_argument('--spacing', type=float, default=20, help="grid spacing in mm")
+    parser.add_argument('--clearance', type=float, default=20, help="clearance from the bore wall in mm")
+    parser.add_argument('--time-scale', type=float, default=20, help="simulated machine speed-up")
+    parser.add_argument('--modes', nargs='+', default=['move_head', 'stream', 'stream_nosync'],
+                        help="move_head, stream, stream_nosync and scan")
+    parser.add_argument('--average', type=int, default=1000, help="probe averaging count of the scan mode")
+    args = parser.parse_args()
+
+    points = utilities.get_valid_points_cartesian(150, 125, -25, utilities.bore_radius,
+                                                  clearance=args.clearance, spacing=args.spacing)
+
+    simulator = GrblSimulator(max_rate=robot.max_rate, acceleration=robot.acceleration,
+                              xlim=robot.cnc_xlim, ylim=robot.cnc_ylim, zlim=robot.cnc_zlim,
+                              time_scale=args.time_scale)
+    simulator.start()
+    robot.connect(simulator.port)
+    robot.home()
+
+    if 'scan' in args.modes:
+        utilities.connect_probe('Emulate')
+        utilities.params['average'] = args.average
+
+    print(f"{len(points)} points, time scale {args.time_scale}")
+    print(f"{'mode':<15}{'wall [s]':>10}{'motion [s]':>12}{'overhead/pt [ms]':>18}{'points/s':>10}")
+    for mode in args.modes:
+        robot.move_head(x=points[0, 0], y=points[0, 1], z=points[0, 2])
+        wall, motion = run(simulator, points, mode)
+        overhead = (wall - motion) / len(points) * 1000
+        print(f"{mode:<15}{wall:>10.2f}{motion:>12.2f}{overhead:>18.1f}{len(points) / wall:>10.1f}")
+
+    robot.disconnect()
+    simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,13 @@
 from robot import robot
+from jog import Jogger, JogKeys
 import tkinter as tk
 
 class Calibrator:
     def __init__(self):
-        self.xlim = (0,375)
-        self.ylim = (0,250)
-        self.zlim = (-150,100)
-
         self.positions = []
+
+        # Moves run on the jogger's thread so the GUI stays responsive, clamped to the robot's workspace limits
+        self.jogger = Jogger()
     
     def start(self):
         self.root = tk.Tk()
@@ -25,12 +25,11 @@ class Calibrator:
         # Key bindings
         self.root.bind('<Shift_L>', lambda event: self.increase_step())
         self.root.bind('<Control_L>', lambda event: self.decrease_step())
-        self.root.bind('<w>', lambda event: self.move_forward())
-        self.root.bind('<s>', lambda event: self.move_backward())
-        self.root.bind('<a>', lambda event: self.move_left())
-        self.root.bind('<d>', lambda event: self.move_right())
-        self.root.bind('<e>', lambda event: self.move_up())
-        self.root.bind('<q>', lambda event: self.move_down())
+        # Tap to step, hold to jog
+        self.jog_keys = JogKeys(self.root, self.jogger,
+                                {'w': (0, 1, 0), 's': (0, -1, 0), 'a': (-1, 0, 0),
+                                 'd': (1, 0, 0), 'e': (0, 0, 1), 'q': (0, 0, -1)},
+                                step_size=lambda: self.step_size)
         #self.root.bind('<Enter>', lambda event: self.save_position())
 
         # Step size radio button list
@@ -86,7 +85,9 @@ class Calibrator:
         btn_save.pack()
 
 
+        self.jogger.start()
         self.root.mainloop()
+        self.jogger.stop()
     
     def increase_step(self):
         self.step_size_idx = min(len(self.step_sizes)-1,self.step_size_idx+1)
@@ -102,38 +103,23 @@ class Calibrator:
         self.step_size_idx = self.step_var.get()
         self.step_size = self.step_sizes[self.step_size_idx]
     
-    def move_constrained(self, **kwargs):
-        if 'x' in kwargs.keys():
-            kwargs['x'] = max(min(kwargs['x'],self.xlim[1]), self.xlim[0])
-        if 'y' in kwargs.keys():
-            kwargs['y'] = max(min(kwargs['y'],self.ylim[1]), self.ylim[0])
-        if 'z' in kwargs.keys():
-            kwargs['z'] = max(min(kwargs['z'],self.zlim[1]), self.zlim[0])
-        robot.move_head(**kwargs)
-
     def move_forward(self):
-        bot_pos = robot._driver.get_head_position()['current']['y']
-        self.move_constrained(y=bot_pos+self.step_size)
+        self.jogger.step([0, self.step_size, 0])
     
     def move_backward(self):
-        bot_pos = robot._driver.get_head_position()['current']['y']
-        self.move_constrained(y=bot_pos-self.step_size)
+        self.jogger.step([0, -self.step_size, 0])
     
     def move_left(self):
-        bot_pos = robot._driver.get_head_position()['current']['x']
-        self.move_constrained(x=bot_pos-self.step_size)
+        self.jogger.step([-self.step_size, 0, 0])
 
     def move_right(self):
-        bot_pos = robot._driver.get_head_position()['current']['x']
-        self.move_constrained(x=bot_pos+self.step_size)
+        self.jogger.step([self.step_size, 0, 0])
 
     def move_up(self):
-        bot_pos = robot._driver.get_head_position()['current']['z']
-        self.move_constrained(z=bot_pos+self.step_size)
+        self.jogger.step([0, 0, self.step_size])
 
     def move_down(self):
-        bot_pos = robot._driver.get_head_position()['current']['z']
-        self.move_constrained(z=bot_pos-self.step_size)
+        self.jogger.step([0, 0, -self.step_size])
 
     def save_position(self):
         bot_pos = list(robot._driver.get_head_position()['current'].values())
@@ -0,0 +1,117 @@
+"""
+On-the-fly field mapping: the robot moves along a path at constant feed while the probe streams periodic blocks.
+
+Probe samples carry device timestamps, status reports carry host arrival times. The two clocks are tied together
+by comparing when each probe block arrived at the host with the device timestamp of its last sample; the smallest
+difference is the least delayed block and gives the clock offset. Sample positions are then interpolated from
+the status report positions, giving a dense X,Y,Z,Bx,By,Bz map instead of one reading per stop.
+
+The offset estimate still includes the shortest USB transfer delay, a few ms, which shifts samples by
+feed * delay along the path; keep the feed low enough for that to be negligible.
+"""
+import threading
+
+import numpy as np
+
+from robot import robot
+import utilities
+
+# Periodic acquisition: 100 samples per block at 1 kHz, raw averaging
+params = {"trigger_type": "periodic", 'block_size': 100, 'period': 1e-3, 'range': '0.1T', 'average': 1,
+          'format': 'INTEGER'}
+
+# Feed rate along the path in mm/min
+feed = 300
+
+
+def clock_offset(thm):
+    # Host time minus device time, from the least delayed block.
+    # Both the sample buffer and the fetch times keep the most recent blocks, so they are matched from the end.
+    block_size = thm.block_size
+    device_times = np.asarray(thm.data_stack['Timestamp'])[::-1][::block_size][::-1]
+    n = min(len(device_times), len(thm.fetch_times))
+    host_times = np.asarray(thm.fetch_times)[-n:]
+    return np.min(host_times - device_times[-n:])
+
+
+def fuse(thm, times, positions):
+    """
+    Tie the probe samples acquired so far to the logged robot positions.
+    :param thm: probe after a periodic acquisition
+    :param times: host times of the status reports
+    :param positions: positions of the status reports in Opentrons coordinates
+    :return: (N, 6) array of X, Y, Z in Opentrons coordinates and Bx, By, Bz in mT aligned with the bore,
+             empty if no sample was taken while positions were logged
+    """
+    if len(times) < 2:
+        raise ValueError(f"{len(times)} robot positions logged, at least 2 are needed to place the probe samples; "
+                         "was the move over before the first status report?")
+    if not len(thm.data_stack['Timestamp']) or not len(thm.fetch_times):
+        return np.zeros((0, 6))
+
+    sample_times = np.asarray(thm.data_stack['Timestamp']) + clock_offset(thm)
+
+    # Only keep samples taken while positions were logged
+    during = (sample_times >= times[0]) & (sample_times <= times[-1])
+    if not np.any(during):
+        return np.zeros((0, 6))
+    sample_times = sample_times[during]
+
+    sample_positions = np.column_stack([np.interp(sample_times, times, positions[:, axis]) for axis in range(3)])
+    fields = utilities.reading_to_field(thm.data_stack).reshape(3, -1).T[during]
+
+    return np.hstack((sample_positions, fields))
+
+
+def scan_path(thm, waypoints, feed=feed, params=params):
+    """
+    Move through the waypoints at constant feed while acquiring continuously.
+    :param thm: connected Thm1176 probe
+    :param waypoints: (N, 3) array of path corners in Opentrons coordinates, e.g. the ends of a line
+                      or the points of a ring
+    :return: (M, 6) array of X, Y, Z, Bx, By, Bz samples along the path
+    """
+    # Go to the start of the path first, then record from a standstill
+    robot.move_head(x=waypoints[0][0], y=waypoints[0][1], z=waypoints[0][2])
+
+    # Keep every sample of the path in memory, with margin for acceleration and the stop at the end
+    duration = np.sum(np.linalg.norm(np.diff(waypoints, axis=0), axis=1)) / feed * 60
+    thm.setup(**params, buffer_duration=2 * duration + 10)
+    thm.buffer.clear()
+    thm.fetch_times.clear()
+
+    robot.start_position_log()
+    acquisition = threading.Thread(target=thm.start_acquisition)
+    acquisition.start()
+    try:
+        # Feed the whole path to gerbl at once so it moves without stopping at the corners
+        robot.stream(robot.move_gcode(feed=feed, x=point[0], y=point[1], z=point[2]) for point in waypoints[1:])
+        robot.wait_until_idle()
+    finally:
+        thm.stop = True
+        acquisition.join()
+        times, positions = robot.stop_position_log()
+
+    return fuse(thm, times, positions)
+
+
+def scan_lines(thm, lines, feed=feed, params=params):
+    # Scan several straight lines, each given as a (start, end) pair
+    return [scan_path(thm, np.asarray(line), feed, params) for line in lines]
+
+
+if __name__ == '__main__':
+    # Scan continuously through the points of valid_points.csv in order, e.g. a ring from generate_ring_points.py
+    valid_points = utilities.read_points("valid_points.csv")
+    origin_info = utilities.read_points("origin_info.csv")
+    origin = origin_info[0]
+    rotation_matrix = origin_info[1:4]
+
+    utilities.connect_robot()
+    utilities.connect_probe()
+
+    samples = scan_path(utilities.thm, valid_points)
+    print(f"{len(samples)} samples along {len(valid_points)} waypoints")
+
+    true_coordinates = (samples[:, :3] - origin) @ rotation_matrix.T
+    utilities.save_readings(true_coordinates, samples[:, 3:], "field_readings_continuous.csv")
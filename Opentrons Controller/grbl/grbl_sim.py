@@ -0,0 +1,449 @@
+"""
+Simulated gerbl device on a pseudo-terminal.
+
+Speaks enough of the gerbl 1.1 serial protocol for Robot to drive it like the real CNC: line replies (ok/error),
+'?' status reports, $H homing, $J= jogging with the jog cancel byte, $$ settings, soft reset and the 128 byte
+serial receive buffer. Moves are timed with a trapezoidal profile limited by per-axis max rate and acceleration,
+and the planner holds a limited number of blocks, so scan plans can be timed and driver changes benchmarked
+without the machine.
+
+Blocks start and end at rest (no junction look-ahead), which makes timings slightly pessimistic for long
+streamed paths of short segments.
+
+Only available where pseudo-terminals are (Linux, macOS).
+"""
+import os
+import re
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+import numpy as np
+
+# Real-time command bytes, acted on as soon as they are received
+STATUS_REPORT = 0x3f     # '?'
+FEED_HOLD = 0x21         # '!'
+CYCLE_START = 0x7e       # '~'
+SOFT_RESET = 0x18        # ctrl-x
+JOG_CANCEL = 0x85
+
+
+class Block:
+    """A planned linear move with a trapezoidal speed profile."""
+    def __init__(self, start, target, feed, max_rate, acceleration, jog=False, dwell=0.0):
+        self.start = np.array(start, dtype=float)
+        self.target = np.array(target, dtype=float)
+        self.jog = jog
+
+        delta = self.target - self.start
+        self.length = np.linalg.norm(delta)
+
+        if self.length == 0:
+            self.speed = 0.0
+            self.accel = 1.0
+            self.duration = dwell
+            return
+
+        # Limit path speed and acceleration so no axis exceeds its own limits
+        unit = np.abs(delta) / self.length
+        moving = unit > 0
+        speed = min(np.min(max_rate[moving] / 60 / unit[moving]), feed / 60)
+        accel = np.min(acceleration[moving] / unit[moving])
+
+        if speed ** 2 / accel >= self.length:
+            # Triangular profile, never reaches full speed
+            speed = np.sqrt(accel * self.length)
+            self.duration = 2 * speed / accel
+        else:
+            self.duration = 2 * speed / accel + (self.length - speed ** 2 / accel) / speed
+
+        self.speed = speed
+        self.accel = accel
+
+    def distance(self, t):
+        # Distance travelled along the block t seconds after it started
+        t = min(max(t, 0.0), self.duration)
+        if self.length == 0:
+            return 0.0
+
+        t_ramp = self.speed / self.accel
+        if t < t_ramp:
+            return 0.5 * self.accel * t ** 2
+        if t > self.duration - t_ramp:
+            t_left = self.duration - t
+            return self.length - 0.5 * self.accel * t_left ** 2
+        return 0.5 * self.accel * t_ramp ** 2 + self.speed * (t - t_ramp)
+
+    def position(self, t):
+        if self.length == 0:
+            return self.target.copy()
+        return self.start + (self.target - self.start) * self.distance(t) / self.length
+
+    def velocity(self, t):
+        if self.length == 0 or t < 0 or t > self.duration:
+            return 0.0
+        return min(self.speed, self.accel * t, self.accel * (self.duration - t))
+
+
+class GrblSimulator:
+    """
+    Stand-in gerbl device. Start it, then connect Robot to simulator.port.
+
+    Times are in simulated machine seconds; time_scale > 1 runs the machine faster than real time.
+    """
+    settings_ids = {'max_rate': (110, 111, 112), 'acceleration': (120, 121, 122), 'max_travel': (130, 131, 132)}
+
+    def __init__(self, max_rate=(1500, 1500, 1500), acceleration=(50, 50, 50),
+                 xlim=(-377, 0), ylim=(-252, 0), zlim=(-252, 0),
+                 rx_buffer_size=128, planner_size=16, homing_required=True, time_scale=1.0):
+        # Axis limits in mm/min and mm/s^2, machine travel in gerbl machine coordinates
+        self.max_rate = np.array(max_rate, dtype=float)
+        self.acceleration = np.array(acceleration, dtype=float)
+        self.limits = np.array([xlim, ylim, zlim], dtype=float)
+
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = planner_size
+        self.homing_required = homing_required
+        self.time_scale = time_scale
+
+        # Bytes received but not yet parsed, mirrors gerbl's serial receive buffer
+        self.rx_buffer = bytearray()
+        self.rx_overflows = 0
+
+        # Planned blocks with their start time, current block first
+        self.planner = deque()
+        self.lock = threading.Condition()
+
+        self.port = None
+        self.master_fd = None
+        self.slave_fd = None
+        self.running = False
+        self.threads = []
+
+        self._reset_state()
+
+    def _reset_state(self):
+        self.pos = np.zeros(3)
+        self.absolute = True
+        self.motion = 'G0'
+        self.feed = None
+        self.alarm = 'Alarm' if self.homing_required else None
+        self.planner.clear()
+        self.rx_buffer.clear()
+
+        # Total simulated motion time and number of moves executed
+        self.machine_time = 0.0
+        self.moves = 0
+
+    def start(self):
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        self.running = True
+        self.threads = [threading.Thread(target=self._receive, daemon=True),
+                        threading.Thread(target=self._process, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+        self._send_line("Grbl 1.1h ['$' for help]")
+        return self.port
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _now(self):
+        # Simulated machine time
+        return time.monotonic() * self.time_scale
+
+    def _send_line(self, line):
+        os.write(self.master_fd, (line + '\r\n').encode())
+
+    def _receive(self):
+        # Split the incoming byte stream into real-time commands and buffered line data
+        while self.running:
+            ready, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master_fd, 1024)
+            except OSError:
+                break
+
+            with self.lock:
+                for byte in data:
+                    if byte == STATUS_REPORT:
+                        self._send_line(self._status_report())
+                    elif byte == SOFT_RESET:
+                        self._reset_state()
+                        self._send_line("Grbl 1.1h ['$' for help]")
+                    elif byte == JOG_CANCEL:
+                        self._cancel_jog()
+                    elif byte in (FEED_HOLD, CYCLE_START):
+                        pass
+                    elif len(self.rx_buffer) >= self.rx_buffer_size:
+                        # Real gerbl silently loses bytes when the host overruns the buffer
+                        self.rx_overflows += 1
+                    else:
+                        self.rx_buffer.append(byte)
+                self.lock.notify_all()
+
+    def _process(self):
+        # Parse complete lines once the planner has room for them
+        while self.running:
+            with self.lock:
+                self._retire_blocks()
+                end = self.rx_buffer.find(b'\n')
+                if end < 0 or len(self.planner) >= self.planner_size:
+                    # Wake up when data arrives or the current block finishes
+                    timeout = 0.1
+                    if self.planner:
+                        timeout = min(timeout, max(self._block_end(0) - self._now(), 0) / self.time_scale)
+                    self.lock.wait(timeout)
+                    continue
+
+                line = self.rx_buffer[:end].decode('ascii', errors='replace').strip()
+                del self.rx_buffer[:end + 1]
+
+            if line:
+                reply = self._execute(line)
+                if reply:
+                    self._send_line(reply)
+
+    def _block_end(self, i):
+        start, block = self.planner[i]
+        return start + block.duration
+
+    def _retire_blocks(self):
+        # Drop blocks that have finished executing
+        now = self._now()
+        while self.planner and self._block_end(0) <= now:
+            start, block = self.planner.popleft()
+            self.machine_time += block.duration
+            self.moves += 1
+
+    def _queue_block(self, block):
+        with self.lock:
+            self._retire_blocks()
+            start = self._block_end(-1) if self.planner else self._now()
+            self.planner.append((max(start, self._now()), block))
+            self.pos = block.target.copy()
+            self.lock.notify_all()
+
+    def _wait_for_planner(self):
+        # Block until all queued motion has finished
+        with self.lock:
+            while self.running and self.planner:
+                self._retire_blocks()
+                if self.planner:
+                    self.lock.wait(max(self._block_end(-1) - self._now(), 0) / self.time_scale)
+
+    def current_position(self):
+        with self.lock:
+            self._retire_blocks()
+            now = self._now()
+            for start, block in self.planner:
+                if start <= now:
+                    return block.position(now - start)
+                return block.start.copy()
+            return self.pos.copy()
+
+    def _state(self):
+        if self.alarm is not None:
+            return 'Alarm'
+        if not self.planner:
+            return 'Idle'
+        start, block = self.planner[0]
+        if self._now() < start:
+            return 'Idle'
+        return 'Jog' if block.jog else 'Run'
+
+    def _status_report(self):
+        self._retire_blocks()
+        now = self._now()
+        state = self._state()
+
+        pos = self.pos
+        speed = 0.0
+        if self.planner:
+            start, block = self.planner[0]
+            pos = block.position(now - start) if now >= start else block.start
+            speed = block.velocity(now - start) * 60
+
+        free_blocks = self.planner_size - len(self.planner)
+        free_bytes = self.rx_buffer_size - len(self.rx_buffer)
+        return (f"<{state}|MPos:{pos[0]:.3f},{pos[1]:.3f},{pos[2]:.3f}|Bf:{free_blocks},{free_bytes}"
+                f"|FS:{speed:.0f},0>")
+
+    def _cancel_jog(self):
+        # Stop where the machine is now and discard the remaining jog blocks
+        if not self.planner or not self.planner[0][1].jog:
+            return
+        now = self._now()
+        start, block = self.planner[0]
+        self.pos = block.position(now - start) if now >= start else block.start
+        self.machine_time += min(max(now - start, 0), block.duration)
+        self.moves += 1
+        self.planner.clear()
+
+    def _execute(self, line):
+        line = re.sub(r'\(.*?\)', '', line).split(';')[0].strip().upper()
+        if not line:
+            return 'ok'
+
+        if line.startswith('$'):
+            return self._execute_system(line)
+
+        if self.alarm is not None:
+            return 'error:9'
+
+        return self._execute_gcode(line)
+
+    def _execute_system(self, line):
+        if line == '$$':
+            for name, ids in self.settings_ids.items():
+                for axis, setting in enumerate(ids):
+                    if name == 'max_travel':
+                        value = self.limits[axis, 1] - self.limits[axis, 0]
+                    else:
+                        value = getattr(self, name)[axis]
+                    self._send_line(f"${setting}={value:.3f}")
+            return 'ok'
+
+        if line == '$I':
+            self._send_line('[VER:1.1h.sim]')
+            return 'ok'
+
+        if line == '$X':
+            self.alarm = None
+            self._send_line('[MSG:Caution: Unlocked]')
+            return 'ok'
+
+        if line == '$H':
+            # Home to machine zero and only reply once homing is done, like gerbl
+            self._wait_for_planner()
+            self.alarm = None
+            self._queue_block(Block(self.current_position(), np.zeros(3), np.inf, self.max_rate, self.acceleration))
+            self._wait_for_planner()
+            return 'ok'
+
+        if line.startswith('$J='):
+            if self.alarm is not None:
+                return 'error:9'
+            return self._execute_gcode(line[3:], jog=True)
+
+        match = re.fullmatch(r'\$(\d+)=([-\d.]+)', line)
+        if match:
+            setting, value = int(match.group(1)), float(match.group(2))
+            for name, ids in self.settings_ids.items():
+                if setting in ids and name != 'max_travel':
+                    getattr(self, name)[ids.index(setting)] = value
+            return 'ok'
+
+        return 'error:3'
+
+    def _execute_gcode(self, line, jog=False):
+        words = re.findall(r'([A-Z])\s*([-+]?[\d.]+)', line)
+        if not words:
+            return 'error:1'
+
+        absolute = self.absolute
+        motion = 'G1' if jog else self.motion
+        feed = None
+        dwell = None
+        target = {}
+
+        for letter, value in words:
+            value = float(value)
+            if letter == 'G':
+                code = int(value)
+                if code in (0, 1) and not jog:
+                    motion = f'G{code}'
+                elif code == 90:
+                    absolute = True
+                elif code == 91:
+                    absolute = False
+                elif code == 4:
+                    dwell = 0.0
+                elif code == 28:
+                    target = {0: 0.0, 1: 0.0, 2: 0.0}
+                    motion = 'G0'
+                elif code not in (17, 20, 21, 53, 54, 94):
+                    return 'error:20'
+            elif letter in 'XYZ':
+                target['XYZ'.index(letter)] = value
+            elif letter == 'F':
+                feed = value
+            elif letter == 'P':
+                dwell = value
+            elif letter in 'MST':
+                pass
+            else:
+                return 'error:20'
+
+        if not jog:
+            self.absolute = absolute
+            self.motion = motion
+            if feed is not None:
+                self.feed = feed
+
+        if dwell is not None:
+            # Dwell waits for the planner to empty before it is acknowledged
+            self._wait_for_planner()
+            time.sleep(dwell / self.time_scale)
+            return 'ok'
+
+        if not target:
+            return 'ok'
+
+        with self.lock:
+            start = self.pos.copy()
+        end = start.copy()
+        for axis, value in target.items():
+            end[axis] = value if absolute else start[axis] + value
+
+        if np.any(end < self.limits[:, 0] - 1e-6) or np.any(end > self.limits[:, 1] + 1e-6):
+            if jog:
+                return 'error:15'
+            # Soft limit: gerbl stops everything and locks out G-code
+            with self.lock:
+                self.planner.clear()
+                self.alarm = 'Alarm'
+            self._send_line('ALARM:2')
+            return None
+
+        if motion == 'G0':
+            rate = np.inf
+        else:
+            rate = feed if jog else self.feed
+            if rate is None:
+                return 'error:22'
+
+        self._queue_block(Block(start, end, rate, self.max_rate, self.acceleration, jog=jog))
+        return 'ok'
+
+
+if __name__ == '__main__':
+    # Run a simulator until interrupted so Robot (or a terminal program) can be pointed at it
+    with GrblSimulator() as simulator:
+        print(f"Simulated gerbl listening on {simulator.port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
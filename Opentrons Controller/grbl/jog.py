@@ -0,0 +1,214 @@
+"""
+Jogging for the Tk GUIs without blocking the main thread.
+
+A worker thread owns all motion requested from the GUI. Held keys turn into a stream of short gerbl $J= jogs,
+each covering `tick` seconds of motion, kept a few jogs ahead of the machine so it moves smoothly. Releasing
+the keys sends the real-time jog cancel, which stops the machine at once instead of finishing queued moves.
+Single steps (button clicks, key taps) run on the same thread, one at a time.
+
+The GUI talks to the worker through JogKeys, which polls it with root.after; the worker never touches Tk.
+"""
+import queue
+import threading
+import time
+
+import numpy as np
+
+from robot import robot, GrblError, GrblAlarm
+
+
+class Jogger:
+    def __init__(self, robot=robot, tick=0.05, lookahead=3):
+        self.robot = robot
+
+        # Seconds of motion per jog command and number of jogs kept queued ahead of the machine
+        self.tick = tick
+        self.lookahead = lookahead
+
+        # Jog speed in mm/min, capped by the slowest axis max rate
+        self.feed = 600
+
+        # Directions of the held keys, summed into the jog direction
+        self.held = {}
+        self.lock = threading.Lock()
+
+        # Single step moves and errors for the GUI to report
+        self.steps = queue.Queue()
+        self.errors = queue.Queue()
+
+        self.jogging = False
+        self.target = None
+        self.jog_start = None
+        self.jogs_sent = 0
+        self.replies = []
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.release_all()
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def press(self, key, direction):
+        # Jog along direction until the key is released
+        with self.lock:
+            self.held[key] = np.asarray(direction, dtype=float)
+
+    def release(self, key):
+        with self.lock:
+            self.held.pop(key, None)
+
+    def release_all(self):
+        with self.lock:
+            self.held.clear()
+
+    def step(self, offset):
+        # Queue a move by offset in Opentrons coordinates
+        self.steps.put(np.asarray(offset, dtype=float))
+
+    def _direction(self):
+        with self.lock:
+            if not self.held:
+                return None
+            direction = sum(self.held.values())
+        norm = np.linalg.norm(direction)
+        return direction / norm if norm else None
+
+    def _clip(self, pos):
+        limits = np.array([self.robot.xlim, self.robot.ylim, self.robot.zlim], dtype=float)
+        return np.clip(pos, limits[:, 0], limits[:, 1])
+
+    def _run(self):
+        while self.running:
+            try:
+                direction = self._direction()
+                if direction is not None:
+                    self._jog(direction)
+                    continue
+                if self.jogging:
+                    self._cancel()
+
+                try:
+                    offset = self.steps.get(timeout=self.tick)
+                except queue.Empty:
+                    continue
+                target = self._clip(self.robot.pos + offset)
+                self.robot.move_head(x=target[0], y=target[1], z=target[2])
+            except (GrblError, GrblAlarm, TimeoutError) as e:
+                self.jogging = False
+                self.replies = []
+                self.errors.put(e)
+
+    def _jog(self, direction):
+        if not self.jogging:
+            # Start from the last commanded position, the machine is idle
+            self.jogging = True
+            self.target = self.robot.pos.copy()
+            self.jog_start = time.monotonic()
+            self.jogs_sent = 0
+
+        # gerbl acknowledges jogs as soon as they are planned, so pace them in real time instead:
+        # stay at most lookahead ticks of motion ahead of the machine
+        ahead = self.jogs_sent * self.tick - (time.monotonic() - self.jog_start)
+        if ahead > self.lookahead * self.tick:
+            time.sleep(ahead - self.lookahead * self.tick)
+            return
+
+        feed = min(self.feed, np.min(self.robot.max_rate))
+        target = self._clip(self.target + direction * feed / 60 * self.tick)
+        if np.allclose(target, self.target):
+            # Already at the workspace limit in this direction
+            time.sleep(self.tick)
+            return
+
+        self.target = target
+        reply = self.robot.jog(feed, x=target[0], y=target[1], z=target[2])
+        self.jogs_sent += 1
+        if reply is not None:
+            self.replies.append(reply)
+        self._check_replies()
+
+    def _check_replies(self):
+        # Drop acknowledged jogs, result() raises GrblError if gerbl rejected one
+        while self.replies and self.replies[0].done():
+            self.replies.pop(0).result()
+
+    def _cancel(self):
+        # Jogs still in gerbl's receive buffer would survive the cancel, wait until all are planned
+        for reply in self.replies:
+            reply.result(timeout=self.robot.cmd_timeout)
+        self.replies = []
+        self.jogging = False
+        self.robot.jog_cancel()
+
+
+class JogKeys:
+    """
+    Keyboard jogging for a Tk window: tapping a key moves one step, holding it jogs continuously.
+    """
+    def __init__(self, root, jogger, directions, step_size, hold_delay=0.3, poll_interval=20):
+        '''
+        :param root: Tk root to bind the keys on
+        :param jogger: started Jogger
+        :param directions: dict of key name to unit direction, e.g. {'w': (0, 1, 0)}
+        :param step_size: callable returning the current step size in mm
+        :param hold_delay: seconds a key must be held before continuous jogging starts
+        :param poll_interval: ms between polls of the key state and the jogger
+        '''
+        self.root = root
+        self.jogger = jogger
+        self.directions = directions
+        self.step_size = step_size
+        self.hold_delay = hold_delay
+        self.poll_interval = poll_interval
+
+        # Key press and last release times, auto-repeat sends release/press pairs while a key is held
+        self.pressed = {}
+        self.released = {}
+
+        for key in directions:
+            root.bind(f'<KeyPress-{key}>', lambda event, key=key: self._press(key))
+            root.bind(f'<KeyRelease-{key}>', lambda event, key=key: self._release(key))
+        root.bind('<FocusOut>', lambda event: self._release_all())
+
+        self.root.after(self.poll_interval, self._poll)
+
+    def _press(self, key):
+        self.released.pop(key, None)
+        if key not in self.pressed:
+            self.pressed[key] = time.monotonic()
+            self.jogger.step(np.asarray(self.directions[key]) * self.step_size())
+
+    def _release(self, key):
+        self.released[key] = time.monotonic()
+
+    def _release_all(self):
+        self.pressed.clear()
+        self.released.clear()
+        self.jogger.release_all()
+
+    def _poll(self):
+        now = time.monotonic()
+
+        # A release counts once no auto-repeat press followed it
+        for key, t in list(self.released.items()):
+            if now - t > self.poll_interval / 1000:
+                del self.released[key]
+                self.pressed.pop(key, None)
+                self.jogger.release(key)
+
+        for key, t in self.pressed.items():
+            if now - t > self.hold_delay:
+                self.jogger.press(key, self.directions[key])
+
+        while not self.jogger.errors.empty():
+            print(f"Jog failed: {self.jogger.errors.get()}")
+
+        self.root.after(self.poll_interval, self._poll)
@@ -11,6 +11,11 @@ from robot import robot
 
 import csv
 import time
+import asyncio
+
+import utilities
+import continuous_scan
+import readings_file
 
 # Bore and Opentrons dimensions
 bore_diameter = 290
@@ -74,6 +79,9 @@ def generate_random_points(num_points=10, radius_variance=3):
 #mode = 'Simulate'
 mode = 'Live'
 
+# Sweep each line at constant feed while streaming probe data instead of stopping at every point
+continuous = False
+
 calibrator = Calibrator()
 
 if mode == 'Simulate':
@@ -155,18 +163,6 @@ z_cylinder = fitted_center_z + fitted_radius * np.sin(theta)
 
 ax.plot_surface(x_cylinder, y_cylinder, z_cylinder, color="red", alpha=0.3, label="Fitted Cylinder")
 
-def connect_probe():
-    global params
-    global thm
-
-    params = {"trigger_type": "single", 'range': '0.1T', 'average': 30000, 'format': 'ASCII'}
-
-    thm = thm_api.Thm1176(backend.list_devices()[0], **params)
-    # Get device id string and print output. This can be used to check communications are OK
-    device_id = thm.get_id()
-    for key in thm.id_fields:
-        print('{}: {}'.format(key, device_id[key]))
-
 def connect_robot():
     robot.connect("COM6")
     robot.home()
@@ -174,18 +170,7 @@ def connect_robot():
 def move_to(point):
     robot.move_head(x=point[0], y=point[1], z=point[2])
 
-def read_field():
-    time.sleep(1)
-    thm.make_measurement(**params)
-    meas = thm.last_reading
-    measurements = list(meas.values())
-    Bx = np.array(measurements[2])*1000
-    By = np.array(measurements[1])*-1000
-    Bz = np.array(measurements[0])*1000
-
-    return np.array([Bx, By, Bz]).flatten()
-
-connect_probe()
+utilities.connect_probe()
 
 points_to_map = {}
 mapped_radii = {}
@@ -195,13 +180,25 @@ angles_degrees = [90, 45, 0, -45]
 for i, angle in enumerate(angles_degrees):
     valid_points, valid_radii = get_valid_points(points[0,0],fitted_center_y, fitted_center_z, angles_to_map[i], fitted_radius, clearance=30, spacing=10)
     
+    # Readings are also streamed to a binary readings file with the radius as an extra column
+    writer = readings_file.ReadingsWriter(f"readings_{int(angle)}.readings", extra=["R[mm]"])
+    if continuous:
+        # Sweep from one end of the line to the other, radii follow from the sampled positions
+        samples = continuous_scan.scan_path(utilities.thm, valid_points[[0, -1]])
+        valid_points = samples[:, :3]
+        direction = np.array([0, np.cos(angles_to_map[i]), np.sin(angles_to_map[i])])
+        valid_radii = (valid_points - np.array([points[0, 0], fitted_center_y, fitted_center_z])) @ direction
+        readings[angle] = samples[:, 3:]
+        writer.extend(valid_points, readings[angle], {"R[mm]": valid_radii})
+    else:
+        # Move and measure, overlapping each move with post-processing of the previous reading
+        def stream(j, field, valid_points=valid_points, valid_radii=valid_radii, writer=writer):
+            writer.append(valid_points[j], field, {"R[mm]": valid_radii[j]})
+        readings[angle] = asyncio.run(utilities.scan_points_async(valid_points, on_reading=stream))
+    writer.close()
+
     points_to_map[angle] = valid_points
     mapped_radii[angle] = valid_radii
-    readings[angle] = []
-    
-    for i in range(len(valid_points)):
-        move_to(valid_points[i])
-        readings[angle].append(read_field())
     
     # Prepare the filename based on the angle
     output_file = f"readings_{int(angle)}.csv"
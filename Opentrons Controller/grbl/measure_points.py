@@ -1,12 +1,10 @@
-import numpy as np
 from robot import robot
 
-import time
-
-import usbtmc as backend
-import pyTHM1176.api.thm_usbtmc_api as thm_api
+import asyncio
 
 import utilities
+import scan_journal
+import readings_file
 
 # Get valid points and origin info from latest read
 valid_points = utilities.read_points("valid_points.csv")
@@ -23,20 +21,44 @@ translated_points = valid_points - origin
 # Apply the rotation matrix to align the points with the global reference frame
 true_coordinates = translated_points @ rotation_matrix.T  # Matrix multiplication with the transpose of the rotation matrix
 
-field_vals = np.zeros_like(true_coordinates)
+# Pick the averaging count of each point from pilot readings instead of always using the maximum
+utilities.adaptive['enabled'] = False
+# Read each point as a short periodic burst, saving the spread and drift of the field with it
+utilities.burst['enabled'] = False
 
 utilities.connect_robot()
 utilities.connect_probe()
 
+# Journal every point, running the same plan again after an interruption only measures the points left
+journal = scan_journal.ScanJournal.for_plan(valid_points, origin_info, params=utilities.params,
+                                            adaptive=utilities.adaptive, burst=utilities.burst)
+if journal.completed:
+    print(f"Resuming {journal.filename}: {len(journal.completed)} of {len(valid_points)} points done")
+    journal.verify_origin(origin_info)
+    journal.verify_point(valid_points, utilities.read_field)
+
+# Stream the readings as they come in, watch them with: python readings_file.py field_readings.readings --follow
+# A point takes seconds, so every one is written out at once
+writer = readings_file.ReadingsWriter("field_readings.readings", chunk=1)
+for i, record in sorted(journal.completed.items()):
+    writer.append(true_coordinates[i], record['field'])
+
 robot.move_head(y=valid_points[0,1], z=valid_points[0,2])
 
-for i in range(len(true_coordinates)):
-    target = valid_points[i]
-    print(target)
-    utilities.move_to(target)
-    time.sleep(0.1)
-    field_vals[i,:] = utilities.read_field()
-    print(f"Measured field: \t{field_vals[i,0]:.3f}\t{field_vals[i,1]:.3f}\t{field_vals[i,2]:.3f}")
+def report(i, field):
+    # Runs in a worker thread while the robot moves to the next point
+    print(valid_points[i])
+    print(f"Measured field: \t{field[0]:.3f}\t{field[1]:.3f}\t{field[2]:.3f}")
+    writer.append(true_coordinates[i], field)
+
+# Move and measure, overlapping each move with post-processing of the previous reading
+stats = {}
+field_vals = asyncio.run(utilities.scan_points_async(valid_points, on_reading=report, stats=stats, journal=journal))
+journal.close()
+writer.close()
 
 
-utilities.save_readings(true_coordinates, field_vals, "field_readings.csv")
\ No newline at end of file
+extra = {"Average": stats['average'], "Sigma[mT]": stats['sigma']}
+if 'burst' in stats:
+    extra.update(utilities.burst_columns(stats['burst']))
+utilities.save_readings(true_coordinates, field_vals, "field_readings.csv", extra=extra)
\ No newline at end of file
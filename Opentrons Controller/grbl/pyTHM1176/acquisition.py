@@ -0,0 +1,190 @@
+'''
+Managed periodic acquisition of the THM1176
+
+AcquisitionService runs the fetch loop of a periodic acquisition on its own thread and hands every block to any
+number of consumers (plotter, file writer, statistics) through bounded queues. Each consumer chooses its policy
+when its queue is full: 'drop' discards the new block for that consumer and counts it, 'block' makes the
+acquisition wait for the consumer. Blocking stalls the fetches, so only use it for consumers that keep up on
+average, such as a file writer.
+
+The acquisition is always aborted on the instrument when the service stops, whether stopped normally, by an
+exception in the fetch loop, or at interpreter exit, so the probe is never left acquiring.
+
+    with AcquisitionService(thm, trigger_type='periodic', block_size=500, period=1 / 2000) as service:
+        for block in service.subscribe('writer', policy='block'):
+            ...
+'''
+
+import atexit
+import queue
+import threading
+import time
+
+
+class Subscription:
+    def __init__(self, name, maxsize=16, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError("policy must be 'drop' or 'block'")
+        self.name = name
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=maxsize)
+
+        # Blocks handed to this consumer and blocks it missed because its queue was full
+        self.delivered = 0
+        self.dropped = 0
+
+    def put(self, block, stopping):
+        '''
+        Hand a block to the consumer according to its policy
+        :param block: block of samples
+        :param stopping: event that ends a blocking wait when the service stops
+        :return:
+        '''
+        if self.policy == 'drop':
+            try:
+                self.queue.put_nowait(block)
+                self.delivered += 1
+            except queue.Full:
+                self.dropped += 1
+            return
+
+        while True:
+            try:
+                self.queue.put(block, timeout=0.1)
+                self.delivered += 1
+                return
+            except queue.Full:
+                if stopping.is_set():
+                    self.dropped += 1
+                    return
+
+    def close(self):
+        # The end-of-stream marker always gets in, making room for it if needed
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        '''
+        Next block, None once the acquisition has stopped
+        :param timeout: seconds to wait, raises queue.Empty when it runs out
+        :return:
+        '''
+        return self.queue.get(timeout=timeout)
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            yield block
+
+
+class AcquisitionService:
+    def __init__(self, thm, **params):
+        '''
+
+        :param thm: connected Thm1176
+        :param params: setup parameters for a periodic acquisition, the current setup is used if none are given
+        '''
+        self.thm = thm
+        self.params = params
+
+        self.subscriptions = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+        # Blocks fetched, and the exception that ended the fetch loop, if any
+        self.blocks = 0
+        self.error = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def subscribe(self, name, maxsize=16, policy='drop'):
+        '''
+        Register a consumer, before start so it sees every block
+        :param name: consumer name for the statistics
+        :param maxsize: number of blocks queued for this consumer
+        :param policy: 'drop' or 'block' when the queue is full
+        :return: Subscription to iterate over or get blocks from
+        '''
+        subscription = Subscription(name, maxsize, policy)
+        self.subscriptions[name] = subscription
+        return subscription
+
+    def start(self):
+        if self.running:
+            return
+        if self.params:
+            self.thm.setup(**self.params)
+
+        self.stopping.clear()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        '''
+        Stop the acquisition and wait for the fetch loop to abort it
+        :param timeout: seconds to wait for the fetch loop, which finishes its current fetch first
+        :return:
+        '''
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        atexit.unregister(self.stop)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        thm = self.thm
+        thm.running = True
+        try:
+            thm.write(':INIT')
+            while not self.stopping.is_set():
+                thm.fetch()
+                # Host times travel with the blocks, thm.fetch_times only keeps the most recent ones
+                host_time = time.monotonic()
+                thm.buffer.append(thm.last_reading)
+
+                block = dict(thm.last_reading)
+                block['host_time'] = host_time
+                self.blocks += 1
+                for subscription in list(self.subscriptions.values()):
+                    subscription.put(block, self.stopping)
+        except Exception as e:
+            self.error = e
+        finally:
+            thm.running = False
+            try:
+                thm.stop_acquisition()
+            except Exception as e:
+                self.error = self.error or e
+            for subscription in self.subscriptions.values():
+                subscription.close()
+
+    def summary(self):
+        '''
+        Acquisition statistics
+        :return: dict with the blocks fetched and, per consumer, the blocks delivered and dropped
+        '''
+        return {'blocks': self.blocks,
+                'samples': self.thm.buffer.total,
+                'error': self.error,
+                'consumers': {name: {'delivered': s.delivered, 'dropped': s.dropped}
+                              for name, s in self.subscriptions.items()}}
@@ -0,0 +1,855 @@
+'''
+Copyright 2018 Hyperfine
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+functions
+parse_ieee_block_header
+from_binary_block
+_use_numpy_routines
+are copied from pyVISA library
+copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+license: MIT, see pyVISA LICENSE for more details.
+
+
+Transport independent core of the THM1176 driver: SCPI command encoding, response decoding, setup, measurement
+and acquisition logic.
+
+Thm1176Core does no I/O of its own. The transport adapters in thm_usbtmc_api, thm_visa_api and thm_sim provide
+    write(message), read(), ask(message), read_raw(), read_stb() and a timeout attribute in s
+and call Thm1176Core.__init__ once their connection is open.
+
+Responses are always read raw and decoded by the same code in both formats, so every fetch is a single
+transaction whatever the kinds requested, and decoding improvements apply to all transports.
+
+Errors are flagged by the *STB? that ends every fetch. Draining the error queue is deferred to the instrument
+executor, so a measurement stays one fetch transaction; error_policy decides what a flagged error does to the
+measurement (see check_status_byte).
+
+Author: Cedric Hugon
+Date: 16Apr2018
+'''
+
+import struct
+import inspect
+import time
+import asyncio
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from pyTHM1176.ring_buffer import RingBuffer
+
+
+def _use_numpy_routines(container):
+    """Should optimized numpy routines be used to extract the data.
+    """
+    # Function copied from pyVISA
+    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+    # license: MIT, see pyVISA LICENSE for more details.
+    if np is None or container in (tuple, list):
+        return False
+
+    if (container is np.array or (inspect.isclass(container) and
+                                  issubclass(container, np.ndarray))):
+        return True
+
+    return False
+
+
+def parse_ieee_block_header(block, start=0):
+    """
+    Parse the header of a IEEE block.
+    Definite Length Arbitrary Block:
+    #<header_length><data_length><data>
+    The header_length specifies the size of the data_length field.
+    And the data_length field specifies the size of the data.
+    Indefinite Length Arbitrary Block:
+    #0<data>
+    :param block: IEEE block.
+    :type block: bytes | bytearray
+    :param start: position in block to look for the block from
+    :return: (offset, data_length)
+    :rtype: (int, int)
+    """
+    # Function copied from pyVISA
+    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+    # license: MIT, see pyVISA LICENSE for more details.
+
+    begin = block.find(b'#', start)
+    if begin < 0:
+        raise ValueError("Could not find hash sign (#) indicating the start of"
+                         " the block.")
+
+    try:
+        # int(block[begin+1]) != int(block[begin+1:begin+2]) in Python 3
+        header_length = int(block[begin + 1:begin + 2])
+    except ValueError:
+        header_length = 0
+    offset = begin + 2 + header_length
+
+    if header_length > 0:
+        # #3100DATA
+        # 012345
+        data_length = int(block[begin + 2:offset])
+    else:
+        # #0DATA
+        # 012
+        data_length = len(block) - offset - 1
+
+    return offset, data_length
+
+
+def from_binary_block(block, offset=0, data_length=None, datatype='f',
+                      is_big_endian=False, container=list):
+    """
+    Convert a binary block into an iterable of numbers.
+    :param block: binary block.
+    :type block: bytes | bytearray
+    :param offset: offset at which the data block starts (default=0)
+    :param data_length: size in bytes of the data block
+                        (default=len(block) - offset)
+    :param datatype: the format string for a single element. See struct module.
+    :param is_big_endian: boolean indicating endianess.
+    :param container: container type to use for the output data.
+    :return: items
+    :rtype: type(container)
+    """
+    # Function copied from pyVISA
+    # copyright: 2014 by PyVISA Authors, see AUTHORS for more details.
+    # license: MIT, see pyVISA LICENSE for more details.
+
+    if data_length is None:
+        data_length = len(block) - offset
+
+    element_length = struct.calcsize(datatype)
+    array_length = int(data_length / element_length)
+
+    endianess = '>' if is_big_endian else '<'
+
+    if _use_numpy_routines(container):
+        return np.frombuffer(block, endianess + datatype, array_length, offset)
+
+    fullfmt = '%s%d%s' % (endianess, array_length, datatype)
+
+    try:
+        return container(struct.unpack_from(fullfmt, block, offset))
+    except struct.error:
+        raise ValueError("Binary data was malformed")
+
+
+def split_binary_response(response, datatype='>i4'):
+    '''
+    Split a ;-separated response whose fields may be IEEE definite length blocks.
+    Blocks may contain ';' bytes, so the response is walked field by field instead of split.
+    :param response: raw response, e.g. b'#18<8 bytes>;#18<8 bytes>;#18<8 bytes>;0x1F;27;0\n'
+    :param datatype: numpy dtype of the block elements, big endian 32 bit integers for the THM1176
+    :return: list of fields, blocks as numpy arrays viewing the response buffer and other fields as stripped bytes
+    '''
+    fields = []
+    pos = 0
+    while pos < len(response):
+        if response[pos:pos + 1] == b'#':
+            offset, length = parse_ieee_block_header(response, pos)
+            if offset + length > len(response):
+                raise ValueError("Truncated block in response: {!r}".format(response[pos:pos + 80]))
+            fields.append(np.frombuffer(response, datatype, length // np.dtype(datatype).itemsize, offset))
+            # Skip the block and the separator after it
+            pos = offset + length + 1
+        else:
+            end = response.find(b';', pos)
+            if end < 0:
+                end = len(response)
+            fields.append(response[pos:end].strip())
+            pos = end + 1
+
+    return fields
+
+
+def fetch_command(kinds, count=None, n_digits=5):
+    '''
+    Encode a fetch of several kinds as one query, ending with *STB? for the error check
+    :param kinds: fetch kinds in the order they should be returned, e.g. ['Bx', 'By', 'Bz', 'Timestamp']
+    :param count: number of samples of each field axis, None fetches the last sample as a scalar
+    :param n_digits: significant digits of ASCII field values
+    :return: command string
+    '''
+    commands = []
+    for kind in kinds:
+        if kind in Thm1176Core.field_axes:
+            axis = Thm1176Core.axes[Thm1176Core.field_axes.index(kind)]
+            if count is None:
+                commands.append(Thm1176Core.base_fetch_cmd["single"] + axis + '? {}'.format(n_digits))
+            else:
+                commands.append(Thm1176Core.base_fetch_cmd["periodic"] + axis + '? {},{}'.format(count, n_digits))
+        elif kind == 'Timestamp':
+            commands.append(':FETCH:TIMESTAMP?')
+        elif kind == 'Temperature':
+            commands.append(':FETCH:TEMPERATURE?')
+        else:
+            raise ValueError("Unknown fetch kind {}".format(kind))
+    commands.append('*STB?')
+    return ';'.join(commands)
+
+
+class ThmError(Exception):
+    '''
+    Entry of the instrument error queue
+    '''
+    def __init__(self, code, message, time=None, command=None):
+        '''
+        :param code: SCPI error code, e.g. -113
+        :param message: error description
+        :param time: time.monotonic() at which the error was flagged
+        :param command: query whose status byte flagged the error
+        '''
+        super().__init__('{},"{}"'.format(code, message))
+        self.code = code
+        self.message = message
+        self.time = time
+        self.command = command
+
+    @classmethod
+    def parse(cls, response, time=None, command=None):
+        # Parse a :SYSTEM:ERROR? response such as -113,"Undefined header"
+        code, _, message = response.strip().partition(',')
+        return cls(int(code), message.strip('"'), time, command)
+
+
+class Thm1176Core:
+    ranges = ["0.1T", '0.3T', '1T', '3T']
+    trigger_period_bounds = (122e-6, 2.79)
+    base_fetch_cmd = {"periodic": ':FETCh:ARRay:', "single": ":FETCh:SCALar:"}
+    axes = ['X', 'Y', 'Z']
+    field_axes = ['Bx', 'By', 'Bz']
+    fetch_kinds = ['Bx', 'By', 'Bz', 'Timestamp',
+                   'Temperature']  # Order matters, this is linked to the fetch command that is sent to retrived data
+    n_digits = 5
+    # Tesla per count of INTEGER format readings of each range: signed 24 bit ADC counts over the full scale
+    integer_scales = {'0.1T': 0.1 / 2 ** 23, '0.3T': 0.3 / 2 ** 23, '1T': 1.0 / 2 ** 23, '3T': 3.0 / 2 ** 23}
+    defaults = {'block_size': 10, 'period': 0.5, 'range': '0.1T', 'average': 1, 'format': 'INTEGER'}
+    id_fields = ['manufacturer', 'model', 'serial', 'version']
+    completion_modes = ['opc', 'stb']
+    error_policies = ['ignore', 'warn', 'retry', 'abort']
+    # Host times kept of the most recent blocks of a periodic acquisition, hours of blocks at 10 Hz
+    fetch_times_length = 2 ** 16
+    # Samples kept in memory: buffer_duration seconds of a periodic acquisition, at least min_buffer_capacity
+    min_buffer_capacity = 2 ** 12
+    buffer_duration = 60
+
+    def __init__(self, **kwargs):
+        '''
+
+        :param kwargs: setup parameters, the transport has to be open already
+        '''
+        self.running = False
+        self.stop = False
+
+        self.fetch_cmd = None
+        self.trigger_type = None
+        # Setup parameters so far, to restore the setup after an error
+        self.setup_params = {}
+
+        # Tesla per count of INTEGER format readings of each axis for each range, e.g. to apply a probe's own
+        # calibration on top of the nominal integer_scales
+        self.integer_scale = {range_: np.full(3, scale) for range_, scale in self.integer_scales.items()}
+
+        # Settings the instrument currently has, so setup only sends what changed.
+        # Cleared whenever the instrument reports an error and its state is no longer certain.
+        self.applied = {}
+
+        # How measure() detects the end of an acquisition:
+        # 'opc' blocks on an *OPC? query, 'stb' polls the USBTMC status byte for the event summary bit set by *OPC
+        self.completion = 'opc'
+        self.stb_poll_interval = 0.005
+
+        # Expected acquisition time is overhead + average * sample_time until measured,
+        # then an exponentially weighted average of the measured times per averaging count
+        self.sample_time = self.trigger_period_bounds[0]
+        self.acquisition_overhead = 0.01
+        self.acquisition_times = {}
+        self.acquisition_smoothing = 0.3
+        # Fraction of the expected time to sleep before asking the instrument, leaves margin for jitter
+        self.wait_fraction = 0.9
+
+        # Seconds from :INIT to the parsed reading of the last measurement
+        self.last_latency = None
+
+        self.block_size = self.defaults['block_size']
+        self.period = self.defaults['period']
+        self.range = self.defaults['range']
+        self.average = self.defaults['average']
+        self.format = self.defaults['format']
+
+        self.last_reading = {fetch_kind: None for fetch_kind in self.fetch_kinds}
+        # Samples of periodic acquisitions, sized by setup for buffer_duration seconds at the trigger period.
+        # Replace with RingBuffer(capacity, spill=filename) to keep longer runs on disk.
+        self.buffer = RingBuffer(self.min_buffer_capacity)
+        # Host time.monotonic() at which each of the most recent blocks of data_stack was received
+        self.fetch_times = deque(maxlen=self.fetch_times_length)
+        # ThmError records of the errors drained from the instrument
+        self.errors = []
+
+        # What an error flagged by a fetch does:
+        # 'ignore' and 'warn' drain the error queue later on the executor, 'warn' also prints the errors,
+        # 'retry' drains it at once and measures again up to max_retries times, 'abort' drains it and raises
+        self.error_policy = 'warn'
+        self.max_retries = 1
+        self.error_time = None
+        self.drain_pending = False
+
+        # Transactions are not thread safe, the async API runs them one at a time on this executor
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Queries from other threads, e.g. the deferred error drain, are kept whole by this lock
+        self.io_lock = threading.RLock()
+
+        self.setup(**kwargs)
+
+    def _apply(self, setting, value, *commands):
+        '''
+        Send the commands of a setting unless the instrument has it already, and record it as applied once they
+        are all sent. If any of them fails, the instrument may have part of the setting: every setting is
+        forgotten, so the next setup sends them all again.
+        :param setting: name of the setting
+        :param value: value being applied
+        :param commands: commands that apply it
+        :return: True if the commands were sent
+        '''
+        if setting in self.applied and self.applied[setting] == value:
+            return False
+        try:
+            for command in commands:
+                self.write(command)
+        except Exception:
+            self.forget_settings()
+            raise
+        self.applied[setting] = value
+        return True
+
+    @property
+    def data_stack(self):
+        '''
+        Samples of the periodic acquisition still in the buffer, as views keyed by fetch kind
+        :return:
+        '''
+        return self.buffer.columns()
+
+    @data_stack.setter
+    def data_stack(self, stack):
+        # Assigning empty lists clears the buffer, as code written for the old list based stack does
+        self.buffer.clear()
+        if len(stack[self.fetch_kinds[0]]):
+            self.buffer.append(stack)
+
+    def write(self, message, *args):
+        # Every transaction holds io_lock, so a query made on another thread, e.g. the deferred error drain,
+        # can never have a command sent between its write and its read
+        with self.io_lock:
+            return super().write(message, *args)
+
+    def read_raw(self, *args):
+        with self.io_lock:
+            return super().read_raw(*args)
+
+    def ask(self, message, *args):
+        with self.io_lock:
+            return super().ask(message, *args)
+
+    def ask_raw(self, message):
+        '''
+        Send a query and return the undecoded response
+        :param message: query
+        :return: response bytes
+        '''
+        with self.io_lock:
+            self.write(message)
+            return self.read_raw()
+
+    def query(self, message):
+        '''
+        Send a query and return the decoded response
+        :param message: query
+        :return: response string
+        '''
+        with self.io_lock:
+            return self.ask(message)
+
+    def set_format(self):
+        self._apply('format', self.format, ':FORMAT:DATA ' + self.format)
+
+    def set_average(self):
+        self._apply('average', self.average, ':AVERAGE:COUNT {}'.format(self.average))
+
+    def set_range(self):
+        '''
+        Set sense range of the Metrolab THM1176
+        Possible ranges are 0.1T,0.3T,1T,3T
+        :param range_str:
+        :return:
+        '''
+
+        self._apply('range', self.range, ':SENSe:FLUX:RANGe ' + self.range)
+
+    def set_trigger(self, trigger_type, count=1):
+        '''
+        Set the probe to run in periodic trigger mode with a given period, continuously,
+        to take one block of block_size periodic acquisitions per :INIT (burst),
+        or to take count immediate acquisitions per :INIT
+        :param trigger_type: "periodic", "burst" or "single"
+        :param count: number of back to back single acquisitions
+        :return:
+        '''
+        with self.io_lock:
+            if trigger_type == "periodic":
+                if self.trigger_period_bounds[0] <= self.period <= self.trigger_period_bounds[1]:
+                    self._apply('trigger', (trigger_type, self.period, self.block_size),
+                                ':TRIGger:SOURce TIMer',
+                                ':TRIGger:TIMer {:f}S'.format(self.period),
+                                ':TRIG:COUNT {}'.format(self.block_size),
+                                ':INIT:CONTINUOUS ON')
+                    return True
+                else:
+                    print('Invalid trigger period value.')
+                    return False
+            elif trigger_type == "burst":
+                self._apply('trigger', (trigger_type, self.period, self.block_size),
+                            ':INIT:CONTINUOUS OFF',
+                            ':TRIGger:SOURce TIMer',
+                            ':TRIGger:TIMer {:f}S'.format(self.period),
+                            ':TRIG:COUNT {}'.format(self.block_size))
+                return True
+            elif trigger_type == "single":
+                # Continuous triggering may still be on from a periodic acquisition
+                self._apply('trigger', (trigger_type, count),
+                            ':INIT:CONTINUOUS OFF',
+                            ':TRIG:COUNT {}'.format(count),
+                            ':TRIGger:SOURce IMMediate')
+                return True
+            else:
+                return False
+
+    def str_conv(self, input_str, kind, count=None):
+        if count is None:
+            count = self.block_size
+
+        if kind == 'Timestamp':
+            val = int(input_str, 0) * 1e-9
+            time_offset = val - (count - 1) * self.period
+            res = np.linspace(time_offset, val, count)
+        elif kind == 'Temperature':
+            res = int(input_str) * np.ones(count)
+
+        else:
+            res = np.array(input_str.replace('T', '').split(','), dtype=float)
+
+        return res
+
+    def decode_fetch(self, response, kinds=None, count=None, command=None):
+        '''
+        Decode a fetch response into last_reading.
+        ASCII and INTEGER responses are split by the same walker; INTEGER field values are big endian 32 bit
+        counts, converted to tesla with the scale of the current range.
+        :param response: raw response bytes
+        :param kinds: fetch kinds in the order they were fetched, defaults to fetch_kinds
+        :param count: samples per kind, defaults to block_size
+        :param command: query the response answers, for the error records
+        :return: last_reading
+        '''
+        if kinds is None:
+            kinds = self.fetch_kinds
+
+        fields = split_binary_response(response)
+        if len(fields) < len(kinds) + 1:
+            raise ValueError("Incomplete fetch response: {!r}".format(response[:80]))
+
+        scale = self.integer_scale[self.range] if self.format == 'INTEGER' else None
+
+        for key, field in zip(kinds, fields):
+            if key in self.field_axes:
+                if scale is None:
+                    field = np.array(field.replace(b'T', b'').split(b','), dtype=float)
+                else:
+                    # Scalar fetches may come back as plain numbers instead of blocks
+                    if isinstance(field, bytes):
+                        field = np.array([int(field)])
+                    field = field * scale[self.field_axes.index(key)]
+                self.last_reading[key] = field
+            else:
+                self.last_reading[key] = self.str_conv(field.decode('ascii'), key, count)
+
+        self.check_status_byte(fields[len(kinds)].decode('ascii'), command)
+        return self.last_reading
+
+    def check_status_byte(self, stb, command=None):
+        '''
+        Act on errors flagged by the status byte returned with a fetch (bit 2), according to error_policy.
+        Costs no transaction unless the policy is 'retry' or 'abort'.
+        :param stb: status byte as a decimal string
+        :param command: query the status byte came with, for the error records
+        :return:
+        '''
+        if not int(stb) & 4:
+            return
+
+        # The instrument state is no longer certain, resend every setting on the next setup
+        self.forget_settings()
+        self.error_time = time.monotonic()
+
+        if self.error_policy in ('retry', 'abort'):
+            errors = self.drain_errors(command)
+            if errors:
+                raise errors[0]
+        elif not self.drain_pending:
+            # Runs after the current executor job, or alongside a caller that does not use the executor
+            self.drain_pending = True
+            self.executor.submit(self.drain_errors, command)
+
+    def drain_errors(self, command=None, report=None):
+        '''
+        Read the error queue until it is empty
+        :param command: query whose status byte flagged the errors, for the records
+        :param report: print the errors, defaults to the 'warn' policy
+        :return: list of ThmError records, also appended to errors
+        '''
+        if report is None:
+            report = self.error_policy == 'warn'
+
+        errors = []
+        with self.io_lock:
+            self.drain_pending = False
+            while True:
+                error = ThmError.parse(self.ask(':SYSTEM:ERROR?'), self.error_time, command)
+                if error.code == 0:
+                    break
+                errors.append(error)
+                if report:
+                    print("THM1176 error: {}".format(error))
+
+        self.errors.extend(errors)
+        return errors
+
+    def get_id(self):
+        '''
+        Get the identification string of the instrument.
+        Parse it according to expected format specified by docs.
+        :return:
+        '''
+        res = self.query('*IDN?')
+        id_vals = res.split(',')
+        header = {field: val for field, val in zip(self.id_fields, id_vals)}
+
+        return header
+
+    def get_data_array(self):
+        '''
+        Fetch data from probe buffer
+        :return:
+        '''
+        if self.running:
+            self.fetch()
+
+    def fetch(self, kinds=None):
+        '''
+        Fetch the data of the last acquisition and parse it into last_reading
+        All kinds are fetched in one transaction.
+        :param kinds: fetch kinds to fetch, defaults to all of them with the command prepared by setup
+        :return: last_reading
+        '''
+        if kinds is None:
+            self.decode_fetch(self.ask_raw(self.fetch_cmd), command=self.fetch_cmd)
+        else:
+            count = self.block_size if self.trigger_type in ("periodic", "burst") else None
+            cmd = fetch_command(kinds, count, self.n_digits)
+            self.decode_fetch(self.ask_raw(cmd), kinds, command=cmd)
+
+        return self.last_reading
+
+    def setup(self, **kwargs):
+        '''
+
+        :param kwargs:
+        :return:
+        '''
+        # The settings go out as one sequence, no other thread's transactions in between
+        with self.io_lock:
+            keys = list(kwargs.keys())
+            trigger_type = kwargs["trigger_type"]
+            self.setup_params.update(kwargs)
+
+            if trigger_type in ("periodic", "burst"):
+                # This will setup the sensor to acquire continuously with a set time period
+                # Acquisition will be started with the "INITiate" command and data should be fetched on time with "FETCh:ARRay"
+                # A burst acquires a single block per "INITiate", measure() then returns all of its samples
+                if 'block_size' in keys:
+                    self.block_size = kwargs['block_size']
+
+                if 'period' in keys:
+                    if self.trigger_period_bounds[0] <= kwargs['period'] <= self.trigger_period_bounds[1]:
+                        self.period = kwargs['period']
+                    else:
+                        print('Invalid trigger period value.')
+                        print('Setting to default...')
+                        self.period = self.defaults['period']
+
+                if 'buffer_duration' in keys:
+                    self.buffer_duration = kwargs['buffer_duration']
+
+                self.set_trigger(trigger_type)
+                if trigger_type == "periodic":
+                    self.size_buffer()
+                count = self.block_size
+
+            elif trigger_type == "single":
+                # This will setup the sensor to acquire a single trigger
+                # Acquisition should be started by "READ" and data obtained via FETCH
+                self.set_trigger("single")
+                self.block_size = 1 # needed for data unpacking
+                count = None
+
+            else:
+                print("Invalid trigger type! Nothing setup.")
+                return
+
+            self.trigger_type = trigger_type
+
+            if 'range' in keys:
+                if kwargs['range'] in self.ranges:
+                    self.range = kwargs['range']
+
+            if 'average' in keys:
+                self.average = kwargs['average']
+
+            if 'format' in keys:
+                self.format = kwargs['format']
+
+            self.set_format()
+            self.set_range()
+            self.set_average()
+
+            self.fetch_cmd = fetch_command(self.fetch_kinds, count, self.n_digits)
+
+    def size_buffer(self):
+        '''
+        Grow the sample buffer to hold buffer_duration seconds of the periodic acquisition, and a block at least.
+        It never shrinks, so a setup between runs does not drop samples that are still to be read.
+        :return:
+        '''
+        capacity = max(self.min_buffer_capacity, self.block_size, int(np.ceil(self.buffer_duration / self.period)))
+        if capacity > self.buffer.capacity:
+            self.buffer.resize(capacity)
+
+    def forget_settings(self):
+        # Resend every setting on the next setup, e.g. after the instrument was reset
+        self.applied = {}
+
+    def make_measurement(self, **kwargs):
+        """
+        To be used for single, one-off acquisition with parameters supplied (may have averaging)
+        Only the settings that differ from the current ones are sent to the instrument.
+        :return:
+        """
+        if kwargs:
+            self.setup(**kwargs)
+        self.measure()
+
+    def _timing_key(self, trigger_type=None):
+        # Acquisition times are learnt per averaging count, and per block for bursts.
+        # Keyed on the setup, which error handling leaves alone, not on the applied settings it clears.
+        if trigger_type is None:
+            trigger_type = self.trigger_type
+        if trigger_type == "burst":
+            return trigger_type, self.period, self.block_size
+        return self.average
+
+    def expected_acquisition_time(self, average=None, trigger_type=None):
+        '''
+        Expected time from :INIT until a single acquisition, or a burst, is complete.
+        :param average: averaging count of a single acquisition, defaults to the current setup
+        :param trigger_type: trigger of the acquisition when it is not the setup's, e.g. "single" while calibrating
+        :return: time in s
+        '''
+        if average is None:
+            key = self._timing_key(trigger_type)
+            if key in self.acquisition_times:
+                return self.acquisition_times[key]
+            if key != self.average:
+                # A burst lasts block_size trigger periods
+                return self.acquisition_overhead + self.block_size * self.period
+            average = self.average
+        if average in self.acquisition_times:
+            return self.acquisition_times[average]
+        return self.acquisition_overhead + average * self.sample_time
+
+    def wait_for_completion(self, start, count=1, trigger_type=None):
+        '''
+        Block until the acquisition started at start is complete and refine the expected acquisition time.
+        :param start: time.monotonic() at which :INIT was sent
+        :param count: number of back to back acquisitions started by the :INIT
+        :param trigger_type: trigger of the acquisition when it is not the setup's
+        :return: measured acquisition time in s
+        '''
+        expected = count * self.expected_acquisition_time(trigger_type=trigger_type)
+
+        # Most of the wait is a plain sleep so the link is not held by a long blocking query
+        remaining = self.wait_fraction * expected - (time.monotonic() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+
+        if self.completion == 'stb':
+            # Bit 5 (event summary) is set once *OPC has set the operation complete bit of *ESR
+            while not self.read_stb() & 0x20:
+                time.sleep(self.stb_poll_interval)
+        else:
+            # *OPC? replies once the acquisition is done, make sure the read does not time out first
+            timeout = self.timeout
+            self.timeout = max(timeout, 2 * expected + 1)
+            try:
+                self.query('*OPC?')
+            finally:
+                self.timeout = timeout
+
+        measured = time.monotonic() - start
+        key = self._timing_key(trigger_type)
+        previous = self.acquisition_times.get(key, measured / count)
+        self.acquisition_times[key] = previous + self.acquisition_smoothing * (measured / count - previous)
+        return measured
+
+    def _start(self):
+        # Send :INIT, armed for the completion mode, and return the time it was sent
+        with self.io_lock:
+            if self.completion == 'stb':
+                # Operation complete sets the event summary bit of the status byte
+                self._apply('event_enable', 1, '*ESE 1')
+                # Reading *ESR clears the operation complete bit left from the previous measurement,
+                # unlike *CLS it keeps the error queue for the *STB? check of the fetch
+                self.query('*ESR?')
+                start = time.monotonic()
+                self.write(':INIT;*OPC')
+            else:
+                start = time.monotonic()
+                self.write(':INIT')
+            return start
+
+    def measure(self):
+        """
+        Single acquisition, or burst, with the current settings, without any setup
+        The sensor should be set up for single triggers or bursts first, using the setup method
+        The reading is fetched as soon as the instrument reports the acquisition complete.
+        With the 'retry' error policy, a measurement whose fetch flags an error is set up and taken again.
+        :return: last_reading
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                start = self._start()
+                self.wait_for_completion(start)
+                self.fetch()
+                break
+            except ThmError:
+                if self.error_policy != 'retry' or attempt == self.max_retries:
+                    raise
+                self.setup(**self.setup_params)
+
+        self.last_latency = time.monotonic() - start
+        return self.last_reading
+
+    def measure_batch(self, n, kinds=None):
+        '''
+        n single acquisitions triggered back to back by one :INIT and fetched in one transaction,
+        e.g. repeated readings at the same point. Costs one round trip instead of n.
+        The sensor should be set up for single triggers first; it is left set up for them.
+        :param n: number of acquisitions, at most 4096
+        :param kinds: fetch kinds, defaults to the field axes and the temperature
+        :return: last_reading with n samples per kind fetched
+        '''
+        if kinds is None:
+            kinds = self.field_axes + ['Temperature']
+
+        self.set_trigger("single", n)
+        start = self._start()
+        self.wait_for_completion(start, n)
+        cmd = fetch_command(kinds, n, self.n_digits)
+        self.decode_fetch(self.ask_raw(cmd), kinds, n, cmd)
+        self.set_trigger("single")
+
+        self.last_latency = time.monotonic() - start
+        return self.last_reading
+
+    async def make_measurement_async(self, **kwargs):
+        '''
+        Awaitable make_measurement, the transactions run on the instrument executor
+        :return: copy of last_reading
+        '''
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, functools.partial(self.make_measurement, **kwargs))
+        return dict(self.last_reading)
+
+    async def measure_async(self):
+        '''
+        Awaitable measure, the transactions run on the instrument executor
+        :return: copy of last_reading
+        '''
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.measure)
+        return dict(self.last_reading)
+
+    async def fetch_async(self, kinds=None):
+        '''
+        Awaitable fetch, the transactions run on the instrument executor
+        :return: copy of last_reading
+        '''
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.fetch, kinds)
+        return dict(self.last_reading)
+
+    def start_acquisition(self):
+        """
+        starts a data acquisition
+        To be used for continuous periodic measurements only
+        The sensor should be set up first, using the setup method
+        :return:
+        """
+        self.running = True
+        self.stop = False
+        try:
+            self.write(':INIT')
+            while not self.stop:
+                self.get_data_array()
+                self.fetch_times.append(time.monotonic())
+                self.buffer.append(self.last_reading)
+        finally:
+            # Also when the 'abort' error policy ends the acquisition
+            self.stop_acquisition()
+            self.running = False
+
+    def stop_acquisition(self):
+        """
+        To be used for continuous periodic measurements
+        This is the method to stop a continuous acquisition that was started by the start_acquisition method
+        :return:
+        """
+        res = self.query(':ABORT;*STB?')
+        print("Stopping acquisition...")
+        print("THM1176 status: {}".format(res))
+
+    def check_error(self):
+        '''
+        Drain and print the error queue now, whatever the error policy
+        :return: list of ThmError records
+        '''
+        errors = self.drain_errors(report=True)
+        if errors:
+            self.forget_settings()
+        return errors
@@ -15,8 +15,9 @@ limitations under the License.
 
 Multithread logging of the THM1176 probe using the pyton API
 
-This is ugly code, very clunky, and does not exit cleanly. But it has the merit of showing how to use the api to get
-data and displaying it
+The acquisition runs in an AcquisitionService: a writer thread saves every block to the output file while the
+plot shows the most recent samples. Closing the figure, Ctrl+C or reaching the duration stops the acquisition,
+which is always aborted on the probe.
 
 Author: Cedric Hugon
 Date: 30Apr2018
@@ -52,6 +53,16 @@ if BACKEND_CHOICE == 'usbtmc':
 elif BACKEND_CHOICE == 'pyVISA':
     import pyTHM1176.api.thm_visa_api as thm_api
 
+from pyTHM1176.acquisition import AcquisitionService
+
+
+def write_blocks(subscription, filename):
+    # Append every block to a text file until the acquisition stops
+    with open(filename, 'a') as file:
+        for block in subscription:
+            np.savetxt(file, np.column_stack([block[key] for key in ['Timestamp', 'Bx', 'By', 'Bz', 'Temperature']]))
+
+
 if __name__ == '__main__':
 
     duration = 300
@@ -75,16 +86,15 @@ if __name__ == '__main__':
         # You may want to have a smarter way of fetching the resource name
         thm = thm_api.Thm1176(thm_res, **params)
 
-    data_stack = []  # list is thread safe
-
     # Get device id string and print output. This can be used to check communications are OK
     device_id = thm.get_id()
     for key in thm.id_fields:
         print('{}: {}'.format(key, device_id[key]))
 
-    # Start the monitoring thread
-    thread = threading.Thread(target=thm.start_acquisition)
-    thread.start()
+    service = AcquisitionService(thm)
+    # The writer must see every block, the plot reads the probe's ring buffer directly
+    writer = service.subscribe('writer', maxsize=64, policy='block')
+    writer_thread = threading.Thread(target=write_blocks, args=(writer, os.path.expanduser(output_file)))
 
     # Plotting stuff
     # initialize figure
@@ -93,9 +103,8 @@ if __name__ == '__main__':
     ax2 = ax1.twinx()
     plt.draw()
 
-    plt.pause(5)  # Wait for the monitor to start filling data in
-    plotdata = [thm.data_stack[key] for key in item_name]
-    timeline = thm.data_stack['Timestamp']
+    # Plot the last 10 s of data
+    plot_samples = int(10 / params['period'])
 
     # Setup colors
     NTemp = curve_type.count('T')
@@ -121,45 +130,50 @@ if __name__ == '__main__':
     lines = []
     for k, flag in enumerate(to_show):
         if flag:
-            data_to_plot = plotdata[k]
             if curve_type[k] == 'F':
-                ln, = ax1.plot(timeline, data_to_plot, label=labels[k], color=colors[k])
+                ln, = ax1.plot([], [], label=labels[k], color=colors[k])
             else:
-                ln, = ax2.plot(timeline, data_to_plot, label=labels[k], color=colors[k])
+                ln, = ax2.plot([], [], label=labels[k], color=colors[k])
             lines.append(ln)
 
     ax1.legend(lines, labels, loc='best')
 
     plt.ion()
 
-    time_start = time.time()
+    with service:
+        writer_thread.start()
+        time_start = time.time()
 
-    while time.time() - time_start < duration:
         try:
-            plt.pause(1)
-            plotdata = [thm.data_stack[key] for key in item_name]
-            timeline = thm.data_stack['Timestamp']
-
-            count = 0
-            for k, flag in enumerate(to_show):
-                if flag:
-                    lines[count].set_data(timeline, plotdata[k])
-                    count += 1
-
-            ax1.relim()
-            ax1.autoscale_view()
-            ax2.relim()
-            ax2.autoscale_view()
-
-            plt.draw()
-
-        except:
-            plt.ioff()
-            thm.stop = True
-            plt.pause(1)
-            sys.exit("Done!")
-
-    thm.stop = True
+            while time.time() - time_start < duration and service.running and plt.fignum_exists(fig.number):
+                plt.pause(1)
+
+                # Copy the snapshot, the acquisition keeps writing into the buffer while the plot holds on to it
+                snapshot = thm.buffer.snapshot(plot_samples).copy()
+                timeline = snapshot['Timestamp']
+
+                count = 0
+                for k, flag in enumerate(to_show):
+                    if flag:
+                        lines[count].set_data(timeline, snapshot[item_name[k]])
+                        count += 1
+
+                ax1.relim()
+                ax1.autoscale_view()
+                ax2.relim()
+                ax2.autoscale_view()
+
+                plt.draw()
+        except KeyboardInterrupt:
+            print("Interrupted")
+
+    writer_thread.join()
+    summary = service.summary()
+    print("Blocks: {blocks}, samples: {samples}".format(**summary))
+    for name, counts in summary['consumers'].items():
+        print("{}: {delivered} delivered, {dropped} dropped".format(name, **counts))
+    if summary['error'] is not None:
+        print("Acquisition stopped by error: {}".format(summary['error']))
 
     # This is to keep the figure open when everything is done
     plt.ioff()
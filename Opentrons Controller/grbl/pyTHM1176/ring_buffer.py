@@ -0,0 +1,138 @@
+'''
+Ring buffer of THM1176 samples for long periodic acquisitions
+
+Samples are stored as structured records (Bx, By, Bz, Timestamp, Temperature) in a preallocated array. Every
+record is written twice, at its position and one capacity further, so the most recent records are always one
+contiguous slice: snapshots are views into the buffer and appending never reallocates or copies the history.
+The capacity only changes through resize, e.g. when the probe is set up for a longer or faster acquisition.
+
+With a spill file, every appended block is also written to disk, so runs longer than the capacity keep all their
+data. load_spill maps the file back as a record array without reading it into memory.
+'''
+
+import threading
+
+import numpy as np
+
+record_dtype = np.dtype([('Bx', 'f8'), ('By', 'f8'), ('Bz', 'f8'), ('Timestamp', 'f8'), ('Temperature', 'f8')])
+
+
+class RingBuffer:
+    def __init__(self, capacity, dtype=record_dtype, spill=None):
+        '''
+
+        :param capacity: number of records kept in memory
+        :param dtype: structured record dtype
+        :param spill: optional file name that receives every record appended
+        '''
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.data = np.zeros(2 * capacity, dtype=self.dtype)
+
+        # Number of records appended since the last clear, and of those still in memory
+        self.total = 0
+        self.held = 0
+        self.lock = threading.Lock()
+
+        self.spill = spill
+        self.spill_file = open(spill, 'ab') if spill is not None else None
+
+    def __len__(self):
+        return self.held
+
+    @property
+    def dropped(self):
+        # Records overwritten in memory, still available in the spill file if there is one
+        return self.total - self.held
+
+    def append(self, block):
+        '''
+        Append a block of samples.
+        :param block: dict of equal length arrays keyed by field name, e.g. Thm1176.last_reading,
+                      or an array of records
+        :return:
+        '''
+        if isinstance(block, dict):
+            n = len(np.atleast_1d(block[self.dtype.names[0]]))
+            records = np.empty(n, dtype=self.dtype)
+            for name in self.dtype.names:
+                records[name] = block[name]
+        else:
+            records = np.asarray(block, dtype=self.dtype)
+
+        with self.lock:
+            self._store(records)
+
+        if self.spill_file is not None:
+            records.tofile(self.spill_file)
+
+    def _store(self, records):
+        # Write records to memory, with the lock held.
+        # Blocks longer than the buffer only keep their end in memory.
+        kept = records[-self.capacity:]
+        n = len(kept)
+
+        start = (self.total + len(records) - n) % self.capacity
+        first = min(n, self.capacity - start)
+
+        # Primary copy, wrapping around the end of the first half
+        self.data[start:start + first] = kept[:first]
+        self.data[:n - first] = kept[first:]
+        # Mirror copy one capacity further
+        self.data[self.capacity + start:self.capacity + start + first] = kept[:first]
+        self.data[self.capacity:self.capacity + n - first] = kept[first:]
+
+        self.total += len(records)
+        self.held = min(self.held + n, self.capacity)
+
+    def resize(self, capacity):
+        '''
+        Change the number of records kept in memory, keeping the most recent ones that fit.
+        :param capacity: new capacity
+        :return:
+        '''
+        with self.lock:
+            end = self.total % self.capacity + self.capacity
+            kept = self.data[end - min(len(self), capacity):end].copy()
+            total = self.total
+            self.capacity = capacity
+            self.data = np.zeros(2 * capacity, dtype=self.dtype)
+            self.total = total - len(kept)
+            self.held = 0
+            self._store(kept)
+
+    def snapshot(self, n=None):
+        '''
+        View of the most recent records, oldest first, without copying.
+        The view is only stable until the buffer wraps over it; copy it to keep it longer than that.
+        :param n: number of records, defaults to all records in memory
+        :return: record array view
+        '''
+        with self.lock:
+            size = len(self) if n is None else min(n, len(self))
+            end = self.total % self.capacity + self.capacity
+            return self.data[end - size:end]
+
+    def columns(self, n=None):
+        # Snapshot as a dict of per-field views, the layout of Thm1176.last_reading
+        snap = self.snapshot(n)
+        return {name: snap[name] for name in self.dtype.names}
+
+    def clear(self):
+        with self.lock:
+            self.total = 0
+            self.held = 0
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+def load_spill(filename, dtype=record_dtype):
+    '''
+    Map a spill file as a record array without reading it into memory
+    :param filename: spill file written by a RingBuffer
+    :return: read-only memory mapped record array
+    '''
+    return np.memmap(filename, dtype=dtype, mode='r')
@@ -0,0 +1,356 @@
+'''
+Simulated THM1176 instrument
+
+Implements the SCPI subset the driver uses, in ASCII and INTEGER formats, so probe code runs without the Metrolab
+hardware: *IDN?, *OPC(?), *ESE, *ESR?, *STB?, *CLS, :FORMat:DATA, :AVERage:COUNt, :SENSe:FLUX:RANGe,
+:TRIGger:SOURce/TIMer/COUNt, :INITiate[:CONTinuous], :ABORt, :FETCh:SCALar/ARRay, :FETCh:TIMestamp?,
+:FETCh:TEMPerature? and :SYSTem:ERRor?. Unknown commands go to the error queue like on the instrument.
+
+The field comes from a pluggable model of position, e.g. the robot position, with white noise that falls with the
+averaging count. Single measurements take overhead + average * sample_time, :TRIGger:COUNt of them per :INIT;
+fetches and *OPC? wait for them, and every transaction costs transfer_delay. Periodic blocks are sampled on the trigger timer, with positions
+interpolated between fetches so continuous scans see the motion.
+
+    thm = SimulatedThm1176(field_model=uniform_field((0.057, 0, 0)), position=robot.machine_position,
+                           trigger_type='single', average=1000)
+'''
+
+import struct
+import threading
+import time
+
+import numpy as np
+
+from pyTHM1176.api.thm_core import Thm1176Core
+
+
+def uniform_field(field=(0.05712, 0.0, 0.0)):
+    '''
+    Field model with the same field everywhere
+    :param field: field along the probe X, Y and Z axes in T
+    :return: field model
+    '''
+    field = np.asarray(field, dtype=float)
+    return lambda position: field
+
+
+def gradient_field(field=(0.05712, 0.0, 0.0), gradient=np.zeros((3, 3)), center=(0.0, 0.0, 0.0)):
+    '''
+    Field model with a constant gradient
+    :param field: field at center along the probe axes in T
+    :param gradient: (3, 3) matrix of T/mm, row i is the gradient of probe component i along X, Y and Z
+    :param center: position of the reference field in mm
+    :return: field model
+    '''
+    field = np.asarray(field, dtype=float)
+    gradient = np.asarray(gradient, dtype=float)
+    center = np.asarray(center, dtype=float)
+    return lambda position: field + gradient @ (np.asarray(position, dtype=float) - center)
+
+
+class SimulatedInstrument:
+    '''
+    Transport for Thm1176Core that answers in place of the instrument, with the usbtmc.Instrument interface
+    '''
+    idn = 'Metrolab Technology SA,THM1176-MF,0000000,simulated'
+    range_limits = {'0.1T': 0.1, '0.3T': 0.3, '1T': 1.0, '3T': 3.0}
+    # INTEGER readings are signed 24 bit ADC counts over the range
+    integer_counts = 2 ** 23
+
+    def __init__(self):
+        self.timeout = 5.0
+        self.sim_lock = threading.Lock()
+
+        # Instrument settings
+        self.sim_format = 'ASCII'
+        self.sim_average = 1
+        self.sim_range = '0.1T'
+        self.sim_source = 'IMM'
+        self.sim_period = 0.1
+        self.sim_count = 1
+        self.sim_continuous = False
+
+        # Acquisition state, times are time.monotonic() seconds
+        self.boot_time = time.monotonic()
+        self.init_time = None
+        self.ready_time = None
+        self.measurement = None
+        self.blocks_fetched = 0
+        self.block_fetched = False
+        self.last_sample = None
+
+        # Status registers and error queue
+        self.esr = 0
+        self.ese = 0
+        self.opc_pending = False
+        self.error_queue = []
+
+        self.output = None
+
+    # USBTMC transport
+
+    def write(self, message):
+        time.sleep(self.transfer_delay)
+        with self.sim_lock:
+            self.output = self._execute(message)
+
+    def read_raw(self, num=-1):
+        with self.sim_lock:
+            output, self.output = self.output, None
+        if output is None:
+            raise TimeoutError("Simulated THM1176: nothing to read")
+        time.sleep(self.transfer_delay)
+        return output
+
+    def read(self, num=-1, encoding='utf-8'):
+        return self.read_raw(num).decode(encoding).rstrip('\n')
+
+    def ask(self, message, num=-1, encoding='utf-8'):
+        self.write(message)
+        return self.read(num, encoding)
+
+    def read_stb(self):
+        time.sleep(self.transfer_delay)
+        with self.sim_lock:
+            return self._status_byte()
+
+    def close(self):
+        pass
+
+    # SCPI
+
+    @staticmethod
+    def _header(command):
+        # Short form of every node so long and short spellings match, e.g. :TRIGger:COUNt -> TRIG:COUN
+        header, _, argument = command.strip().partition(' ')
+        query = header.endswith('?')
+        nodes = header.strip(':?').upper().split(':')
+        short = ':'.join(node if node.startswith('*') else node[:4] for node in nodes)
+        return short + ('?' if query else ''), argument.strip()
+
+    def _execute(self, message):
+        # All fetches of one message return the same periodic block
+        self.block_fetched = False
+        replies = []
+        for command in message.strip().split(';'):
+            if not command.strip():
+                continue
+            header, argument = self._header(command)
+            handler = self.commands.get(header.rstrip('?XYZ') if header.startswith('FETC:') else header)
+            if handler is None:
+                self.error_queue.append('-113,"Undefined header;{}"'.format(command.strip()))
+                continue
+            reply = handler(self, header, argument)
+            if reply is not None:
+                replies.append(reply if isinstance(reply, bytes) else reply.encode('ascii'))
+
+        if not replies:
+            return None
+        return b';'.join(replies) + b'\n'
+
+    def _set_format(self, header, argument):
+        self.sim_format = 'INTEGER' if argument.upper().startswith('INT') else 'ASCII'
+
+    def _set_average(self, header, argument):
+        self.sim_average = max(1, int(argument))
+
+    def _set_range(self, header, argument):
+        if argument.upper() in self.range_limits:
+            self.sim_range = argument.upper()
+        else:
+            self.error_queue.append('-222,"Data out of range"')
+
+    def _set_source(self, header, argument):
+        self.sim_source = argument.upper()[:3]
+
+    def _set_timer(self, header, argument):
+        self.sim_period = float(argument.upper().rstrip('S'))
+
+    def _set_count(self, header, argument):
+        self.sim_count = int(argument)
+
+    def _set_continuous(self, header, argument):
+        self.sim_continuous = argument.upper() in ('ON', '1')
+
+    def _init(self, header, argument):
+        now = time.monotonic()
+        self.init_time = now
+        self.blocks_fetched = 0
+        self.last_sample = (now, self._position())
+        if self.sim_source == 'TIM':
+            self.ready_time = now + self.sim_count * self.sim_period / self.time_scale
+        else:
+            # Immediate triggers take sim_count measurements back to back
+            self.ready_time = now + self.sim_count * self.acquisition_time() / self.time_scale
+        self.measurement = None
+
+    def _abort(self, header, argument):
+        self.init_time = None
+        self.ready_time = None
+
+    def _opc(self, header, argument):
+        if header.endswith('?'):
+            self._wait_until_ready()
+            return '1'
+        self.opc_pending = True
+
+    def _ese(self, header, argument):
+        self.ese = int(argument)
+
+    def _esr(self, header, argument):
+        self._update_esr()
+        esr, self.esr = self.esr, 0
+        return str(esr)
+
+    def _cls(self, header, argument):
+        self.esr = 0
+        self.opc_pending = False
+        self.error_queue = []
+
+    def _stb(self, header, argument):
+        return str(self._status_byte())
+
+    def _idn(self, header, argument):
+        return self.idn
+
+    def _error(self, header, argument):
+        if self.error_queue:
+            return self.error_queue.pop(0)
+        return '0,"No error"'
+
+    def _fetch(self, header, argument):
+        kind = header.rstrip('?').split(':')[1]
+        if kind in ('SCAL', 'ARRA'):
+            axis = 'XYZ'.index(header.rstrip('?')[-1])
+            values = self._current_measurement()[:, axis]
+            if kind == 'SCAL':
+                values = values[-1:]
+            elif argument:
+                values = values[:int(argument.split(',')[0])]
+            return self._format_values(values, argument)
+        if kind == 'TIME':
+            self._current_measurement()
+            return '0x{:016X}'.format(int(self.measurement_time * 1e9))
+        if kind == 'TEMP':
+            return str(self.temperature)
+
+    commands = {'*IDN?': _idn, '*OPC': _opc, '*OPC?': _opc, '*ESE': _ese, '*ESR?': _esr, '*CLS': _cls,
+                '*STB?': _stb, 'FORM:DATA': _set_format, 'AVER:COUN': _set_average, 'SENS:FLUX:RANG': _set_range,
+                'TRIG:SOUR': _set_source, 'TRIG:TIME': _set_timer, 'TRIG:COUN': _set_count,
+                'INIT:CONT': _set_continuous, 'INIT': _init, 'ABOR': _abort, 'SYST:ERRO?': _error,
+                'FETC:SCAL:': _fetch, 'FETC:ARRA:': _fetch, 'FETC:TIME': _fetch, 'FETC:TEMP': _fetch}
+
+    def _format_values(self, values, argument):
+        if self.sim_format == 'INTEGER':
+            scale = self.range_limits[self.sim_range] / self.integer_counts
+            counts = np.clip(np.round(values / scale), -self.integer_counts, self.integer_counts - 1)
+            data = struct.pack('>{}i'.format(len(counts)), *counts.astype(int))
+            length = str(len(data)).encode('ascii')
+            return b'#' + str(len(length)).encode('ascii') + length + data
+
+        digits = int(argument.split(',')[-1]) if argument else 5
+        return ','.join('{:.{}g}T'.format(value, digits) for value in values)
+
+    # Measurement model
+
+    def acquisition_time(self):
+        return self.sim_overhead + self.sim_average * self.sim_sample_time
+
+    def _position(self):
+        return np.asarray(self.position(), dtype=float)
+
+    def _wait_until_ready(self):
+        # The lock is held by the caller: the instrument answers nothing else while it waits, like the real one
+        if self.ready_time is None:
+            return
+        delay = self.ready_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _update_esr(self):
+        if self.opc_pending and (self.ready_time is None or time.monotonic() >= self.ready_time):
+            self.esr |= 1
+            self.opc_pending = False
+
+    def _status_byte(self):
+        self._update_esr()
+        stb = 0
+        if self.error_queue:
+            stb |= 4
+        if self.esr & self.ese:
+            stb |= 32
+        return stb
+
+    def _noise(self, n):
+        return self.rng.normal(0, self.sim_noise / np.sqrt(self.sim_average), (n, 3))
+
+    def _current_measurement(self):
+        '''
+        Samples of the measurement a fetch returns, waiting for it when it is still being acquired
+        :return: (n, 3) field samples in T
+        '''
+        if self.sim_source == 'TIM' and self.init_time is not None:
+            # Periodic: each fetch returns the next block of sim_count samples, once its last sample is taken
+            if self.block_fetched:
+                return self.measurement
+            n = self.sim_count
+            period = self.sim_period / self.time_scale
+            first = self.init_time + self.blocks_fetched * n * period
+            self.ready_time = first + (n - 1) * period
+            self._wait_until_ready()
+
+            # Positions between the previous fetch and now, interpolated over the sample times
+            now = time.monotonic()
+            position = self._position()
+            sample_times = first + np.arange(n) * period
+            t0, p0 = self.last_sample
+            weights = np.clip((sample_times - t0) / max(now - t0, 1e-9), 0, 1)[:, None]
+            positions = p0 + weights * (position - p0)
+            self.last_sample = (now, position)
+
+            self.measurement = np.array([self.field_model(p) for p in positions]) + self._noise(n)
+            self.block_fetched = True
+            self.measurement_time = (sample_times[-1] - self.boot_time) * self.time_scale
+            self.blocks_fetched += 1
+            return self.measurement
+
+        if self.measurement is None:
+            if self.init_time is None:
+                self.error_queue.append('-230,"Data corrupt or stale"')
+                return np.zeros((1, 3))
+            self._wait_until_ready()
+            self.measurement = self.field_model(self._position())[None, :] + self._noise(self.sim_count)
+            self.measurement_time = (self.ready_time - self.boot_time) * self.time_scale
+        return self.measurement
+
+
+class SimulatedThm1176(Thm1176Core, SimulatedInstrument):
+    '''
+    THM1176 driver talking to a simulated instrument
+    '''
+    def __init__(self, field_model=None, position=None, noise=2e-6, sample_time=122e-6,
+                 acquisition_overhead=0.002, transfer_delay=0.0005, temperature=27, time_scale=1.0, seed=None,
+                 **kwargs):
+        '''
+        :param field_model: callable of position returning the field along the probe axes in T
+        :param position: callable returning the probe position, e.g. robot.machine_position
+        :param noise: noise of a single sample per axis in T, divided by sqrt(average)
+        :param sample_time: acquisition time per averaged sample in s
+        :param acquisition_overhead: fixed time per single measurement in s
+        :param transfer_delay: time per USB transaction in s
+        :param time_scale: > 1 runs the instrument faster than real time
+        :param kwargs: setup parameters, as for Thm1176Core
+        '''
+        self.field_model = field_model if field_model is not None else uniform_field()
+        self.position = position if position is not None else (lambda: np.zeros(3))
+        # Named apart from the driver's own acquisition time model
+        self.sim_noise = noise
+        self.sim_sample_time = sample_time
+        self.sim_overhead = acquisition_overhead
+        self.transfer_delay = transfer_delay
+        self.temperature = temperature
+        self.time_scale = time_scale
+        self.rng = np.random.default_rng(seed)
+
+        SimulatedInstrument.__init__(self)
+        Thm1176Core.__init__(self, **kwargs)
@@ -0,0 +1,195 @@
+"""
+Streaming binary field readings files.
+
+A readings file is a short text header followed by fixed-width records of little endian doubles, one per point:
+X, Y, Z in mm, Bx, By, Bz in mT and any extra columns such as Average or Sigma[mT]. The writer appends records as
+points are measured and writes them out in chunks, so a scan in progress can be watched with follow() and nothing
+but the last chunk is lost if it stops. load_readings maps the file as a record array without reading it, and
+export_csv writes the same CSV as utilities.save_readings.
+
+    with ReadingsWriter("field_readings.readings", extra=["Average"]) as writer:
+        writer.append(point, field, {"Average": 30000})
+
+    python readings_file.py field_readings.readings            # export to field_readings.csv
+    python readings_file.py field_readings.readings --follow   # print readings as they are written
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+magic = b'SOLOWRD1\n'
+base_columns = ['X[mm]', 'Y[mm]', 'Z[mm]', 'Bx[mT]', 'By[mT]', 'Bz[mT]']
+
+
+def readings_dtype(columns):
+    # Record fields are the column names without their unit, e.g. Sigma[mT] -> Sigma
+    return np.dtype([(column.split('[')[0], '<f8') for column in columns])
+
+
+class ReadingsWriter:
+    def __init__(self, filename, extra=(), chunk=64):
+        """
+        Create a readings file, replacing any file of the same name.
+        :param filename: readings file
+        :param extra: headers of the extra columns, e.g. ["Average", "Sigma[mT]"]
+        :param chunk: number of records written out at once
+        """
+        self.filename = filename
+        self.columns = base_columns + list(extra)
+        self.dtype = readings_dtype(self.columns)
+
+        # Records not written out yet, and records written in total
+        self.records = np.zeros(chunk, dtype=self.dtype)
+        self.count = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+        self.file = open(filename, 'wb')
+        header = json.dumps({'columns': self.columns}).encode()
+        # Pad so the records start 8 byte aligned for memory mapping
+        padding = -(len(magic) + len(header) + 1) % 8
+        self.file.write(magic + header + b' ' * padding + b'\n')
+        self.file.flush()
+
+    def append(self, coords, field, extra=None):
+        """
+        Add the reading of one point.
+        :param coords: X, Y, Z in mm
+        :param field: Bx, By, Bz in mT
+        :param extra: values of the extra columns as {header: value}, missing ones are written as NaN
+        :return:
+        """
+        extra = extra or {}
+        row = list(coords) + list(field) + [extra.get(column, np.nan) for column in self.columns[6:]]
+
+        with self.lock:
+            self.records[self.count] = tuple(row)
+            self.count += 1
+            if self.count == len(self.records):
+                self._write()
+
+    def extend(self, coords, fields, extra=None):
+        """
+        Add the readings of many points at once, e.g. the samples of a continuous scan.
+        :param coords: (N, 3) X, Y, Z in mm
+        :param fields: (N, 3) Bx, By, Bz in mT
+        :param extra: (N,) values of the extra columns as {header: values}
+        :return:
+        """
+        extra = extra or {}
+        records = np.zeros(len(coords), dtype=self.dtype)
+        for i, name in enumerate(self.dtype.names):
+            column = self.columns[i]
+            if i < 3:
+                records[name] = np.asarray(coords)[:, i]
+            elif i < 6:
+                records[name] = np.asarray(fields)[:, i - 3]
+            else:
+                records[name] = extra.get(column, np.nan)
+
+        with self.lock:
+            self._write()
+            records.tofile(self.file)
+            self.file.flush()
+            self.total += len(records)
+
+    def _write(self):
+        # Write out the buffered records, the lock is held by the caller
+        if self.count:
+            self.records[:self.count].tofile(self.file)
+            self.file.flush()
+            self.total += self.count
+            self.count = 0
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_header(filename):
+    """
+    Columns and record layout of a readings file.
+    :param filename: readings file
+    :return: (columns, dtype, offset of the first record in bytes)
+    """
+    with open(filename, 'rb') as file:
+        if file.readline() != magic:
+            raise ValueError(f"{filename} is not a readings file")
+        columns = json.loads(file.readline())['columns']
+        offset = file.tell()
+    return columns, readings_dtype(columns), offset
+
+
+def load_readings(filename):
+    """
+    Map a readings file as a record array without reading it into memory.
+    A file still being written is mapped up to its last complete record.
+    :param filename: readings file
+    :return: (read-only record array, column headers)
+    """
+    columns, dtype, offset = read_header(filename)
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype), columns
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,)), columns
+
+
+def follow(filename, interval=0.5):
+    """
+    Yield the records of a readings file as they are written, e.g. to watch a scan in progress.
+    :param filename: readings file
+    :param interval: seconds between checks for new records
+    :return: generator of record arrays
+    """
+    seen = 0
+    while True:
+        records, _ = load_readings(filename)
+        if len(records) > seen:
+            yield np.array(records[seen:])
+            seen = len(records)
+        time.sleep(interval)
+
+
+def export_csv(filename, csv_filename=None):
+    """
+    Write a readings file as CSV with the headers utilities.save_readings uses.
+    :param filename: readings file
+    :param csv_filename: CSV file, defaults to the readings file name with a .csv extension
+    :return: name of the CSV file
+    """
+    if csv_filename is None:
+        csv_filename = os.path.splitext(filename)[0] + '.csv'
+    records, columns = load_readings(filename)
+    data = np.column_stack([records[name] for name in records.dtype.names]) if len(records) else \
+        np.zeros((0, len(columns)))
+    np.savetxt(csv_filename, data, delimiter=",", header=",".join(columns), comments="")
+    return csv_filename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or follow a readings file")
+    parser.add_argument('filename')
+    parser.add_argument('csv', nargs='?', help="CSV file to export to")
+    parser.add_argument('--follow', action='store_true', help="print readings as they are written")
+    args = parser.parse_args()
+
+    if args.follow:
+        for block in follow(args.filename):
+            for record in block:
+                print("\t".join(f"{value:.4f}" for value in record))
+    else:
+        print(f"Exported to {export_csv(args.filename, args.csv)}")
@@ -1,8 +1,27 @@
+import asyncio
 import numpy as np
 import serial
 import serial.tools.list_ports
 import threading
 import time
+import re
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+class GrblError(Exception):
+    """gerbl rejected a command with an error:N reply."""
+    def __init__(self, code, cmd=None):
+        self.code = code
+        self.cmd = cmd
+        super().__init__(f"gerbl error {code} for command '{cmd}'")
+
+
+class GrblAlarm(Exception):
+    """gerbl entered an alarm state while commands were pending."""
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"gerbl alarm: {message}")
 
 class Driver:
     def __init__(self):
@@ -31,8 +50,16 @@ class Robot:
         self.cnc_ylim = (-252, 0)
         self.cnc_zlim = (-252, 0)
 
+        # gerbl max rate ($110-$112, mm/min) and acceleration ($120-$122, mm/s^2) per axis, updated by read_settings
+        self.max_rate = np.array([1500.0, 1500.0, 1500.0])
+        self.acceleration = np.array([50.0, 50.0, 50.0])
+        self.settings = {}
+
+        # Simulated gerbl device when connected to 'Emulate'
+        self.simulator = None
+
         # Position in Opentrons coordinates
-        self.pos = np.array([0, 250, 100])
+        self.pos = np.array([0.0, 250.0, 100.0])
 
         # Serial connection to gerbl Arduino
         self.serial = serial.Serial()
@@ -42,20 +69,68 @@ class Robot:
         self.read_thread = None
         self.keep_reading = False
 
+        # Seconds a blocking read waits for data before checking keep_reading again
+        self.read_timeout = 0.1
+
+        # Handlers for each kind of message received from gerbl
+        self.handlers = {'ok': self._on_ok,
+                         'error': self._on_error,
+                         'status': self._update_status,
+                         'alarm': self._on_alarm,
+                         'welcome': self._on_welcome,
+                         'message': self._on_message}
+        self.version = None
+        self.last_message = None
+
         # For compatibility with Opentrons code
         self._driver = Driver()
         self._driver.pos = self.pos
 
-        # Wait until command finished
-        self.ok = False
+        # Commands waiting for an ok/error reply, oldest first, as (command, future) pairs
+        self.pending = deque()
+        self.pending_lock = threading.Lock()
+
+        # Seconds to wait for a reply before giving up (homing can take a while)
+        self.cmd_timeout = 120
+
+        # Size of gerbl's serial receive buffer in bytes, used for character-counting streaming
+        self.rx_buffer_size = 128
+
+        # Seconds between '?' status report requests, 0 disables the background poller
+        self.status_interval = 0.05
+        self.status_thread = None
+
+        # Latest status report: machine state and gerbl machine position/work coordinate offset
+        self.state = None
+        self.mpos = None
+        self.wco = np.zeros(3)
+
+        # (time, work position) of every status report while recording, see start_position_log
+        self.status_log = None
+
+        # Status requests sent and reports received, reports come back in request order
+        self.status_cond = threading.Condition()
+        self._status_requested = 0
+        self._status_received = 0
 
     def __del__(self):
-        # Close serial connection and stop reading thread on object deletion
+        # Close serial connection and stop reading threads on object deletion
+        self.disconnect()
+
+    def disconnect(self):
+        # Stop the reading and polling threads before closing the port, so no read is left on a closed port
+        self.keep_reading = False
+        if self.read_thread is not None:
+            self.read_thread.join()
+            self.read_thread = None
+        if self.status_thread is not None:
+            self.status_thread.join()
+            self.status_thread = None
         if self.serial.is_open:
-            self.keep_reading = False
-            if self.read_thread is not None:
-                self.read_thread.join()
             self.serial.close()
+        if self.simulator is not None:
+            self.simulator.stop()
+            self.simulator = None
 
     def _update_position(self, pos):
         axes = pos.keys()
@@ -77,23 +152,62 @@ class Robot:
 
         return pos
 
-    def _send_cmd(self, cmd, wait_for_ok=True):
-        if wait_for_ok:
-            self.ok = False
+    def _send_cmd(self, cmd, wait_for_ok=True, timeout=None):
         # If simulating, print the sent command
         if self.simulate:
             print(cmd)
-        # If live connection, send command over serial
-        else:
+            return None
+
+        # gerbl replies to every line in order, so queue a future for this command before sending it
+        reply = Future()
+        with self.pending_lock:
+            self.pending.append((cmd, reply))
             self.serial.write(str.encode(cmd + '\n'))
-            #print('Sent: ' + cmd)
-            while not self.ok and wait_for_ok:
-                pass
+        #print('Sent: ' + cmd)
+
+        if not wait_for_ok:
+            return reply
+
+        # Block until the reader thread resolves the reply, raises GrblError/GrblAlarm on failure
+        if timeout is None:
+            timeout = self.cmd_timeout
+        try:
+            return reply.result(timeout=timeout)
+        except FutureTimeout:
+            raise TimeoutError(f"No reply from gerbl to '{cmd}' after {timeout} s")
+
+    def _resolve_reply(self, error_code=None):
+        # Hand the reply to the oldest pending command
+        with self.pending_lock:
+            if not self.pending:
+                return
+            cmd, reply = self.pending.popleft()
+
+        if error_code is None:
+            reply.set_result(cmd)
+        else:
+            reply.set_exception(GrblError(error_code, cmd))
+
+    def _fail_pending(self, exc):
+        # Fail every outstanding command, e.g. after an alarm
+        with self.pending_lock:
+            pending = list(self.pending)
+            self.pending.clear()
+
+        for cmd, reply in pending:
+            reply.set_exception(exc)
 
     def connect(self, port=None):
         # Get available composite ports
         ports = serial.tools.list_ports.comports()
 
+        # Emulate runs a simulated gerbl device on a pseudo-terminal and connects to it like a real one
+        if port == 'Emulate':
+            from grbl_sim import GrblSimulator
+            self.simulator = GrblSimulator(max_rate=self.max_rate, acceleration=self.acceleration,
+                                           xlim=self.cnc_xlim, ylim=self.cnc_ylim, zlim=self.cnc_zlim)
+            port = self.simulator.start()
+
         # Check if real connection
         if not port in ['Simulate', 'Virtual Smoothie']:
             # If no port is specified, choose first port connected to Arduino
@@ -106,6 +220,7 @@ class Robot:
             # Open connection to Arduino running gerbl
             self.serial.baudrate = 115200  # baud rate used by gerbl
             self.serial.port = port
+            self.serial.timeout = self.read_timeout
             self.serial.open()
 
             # Start reading serial messages
@@ -113,31 +228,225 @@ class Robot:
             self.read_thread = threading.Thread(target=self.read_serial, daemon=True)
             self.read_thread.start()
 
-            time.sleep(2)
+            # Start polling status reports
+            if self.status_interval:
+                self.status_thread = threading.Thread(target=self.poll_status, daemon=True)
+                self.status_thread.start()
+
+            # Wait for the Arduino to reset after opening the port
+            if self.simulator is None:
+                time.sleep(2)
         else:
             self.simulate = True
 
     def read_serial(self):
-        """Continuously read and print serial messages."""
+        """Read serial messages and dispatch each complete line to its handler."""
+        buffer = b''
         while self.keep_reading:
-            if self.serial.is_open and self.serial.in_waiting > 0:
-                try:
-                    message = self.serial.readline().decode('utf-8').strip()
-                    #print(f"Received: {message}")
-                    if message == 'ok':
-                        self.ok = True
-                except Exception as e:
-                    print(f"Error reading from serial: {e}")
+            try:
+                # Blocks until at least one byte arrives or the read timeout expires, then takes whatever is waiting
+                chunk = self.serial.read(max(1, self.serial.in_waiting))
+            except Exception as e:
+                if not self.keep_reading or not self.serial.is_open:
+                    break
+                print(f"Error reading from serial: {e}")
+                continue
+
+            if not chunk:
+                continue
+
+            # Lines may be split across reads, keep the unterminated tail for the next one
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                message = line.decode('utf-8', errors='replace').strip()
+                if message:
+                    self._dispatch(message)
+
+    def _dispatch(self, message):
+        #print(f"Received: {message}")
+        if message == 'ok':
+            kind = 'ok'
+        elif message.startswith('error:'):
+            kind = 'error'
+        elif message.startswith('<'):
+            kind = 'status'
+        elif message.startswith('ALARM'):
+            kind = 'alarm'
+        elif message.startswith('Grbl '):
+            kind = 'welcome'
+        else:
+            kind = 'message'
+
+        try:
+            self.handlers[kind](message)
+        except Exception as e:
+            print(f"Error handling serial message '{message}': {e}")
+
+    def _on_ok(self, message):
+        self._resolve_reply()
+
+    def _on_error(self, message):
+        # gerbl 1.1 sends numeric codes, 0.9 sends a description
+        code = message[len('error:'):].strip()
+        self._resolve_reply(int(code) if code.isdigit() else code)
+
+    def _on_alarm(self, message):
+        self._fail_pending(GrblAlarm(message))
+
+    def _on_welcome(self, message):
+        # The banner is sent after a reset, which discards anything gerbl had buffered
+        self.version = message
+        self._fail_pending(GrblAlarm(f"reset ({message})"))
+
+    def _on_message(self, message):
+        # Feedback such as [MSG:...] or $ setting lines
+        self.last_message = message
+
+        # Setting lines look like $110=500.000
+        if message.startswith('$') and '=' in message:
+            setting, value = message[1:].split('=', 1)
+            try:
+                self.settings[int(setting)] = float(value)
+            except ValueError:
+                pass
 
-    def move_head(self, **pos):
+    def read_settings(self):
+        # Ask gerbl for its $$ settings and update the axis limits used for motion timing
+        self._send_cmd('$$')
+        for axis in range(3):
+            self.max_rate[axis] = self.settings.get(110 + axis, self.max_rate[axis])
+            self.acceleration[axis] = self.settings.get(120 + axis, self.acceleration[axis])
+        return self.settings
+
+    def request_status(self):
+        # '?' is a real-time command, gerbl answers it immediately even while lines are buffered
+        with self.status_cond:
+            self.serial.write(b'?')
+            self._status_requested += 1
+
+    def poll_status(self):
+        """Request status reports at a fixed rate."""
+        while self.keep_reading and self.status_interval:
+            if self.serial.is_open:
+                self.request_status()
+            time.sleep(self.status_interval)
+
+    def _update_status(self, message):
+        # gerbl 1.1: <Idle|MPos:0.000,0.000,0.000|FS:0,0|WCO:0.000,0.000,0.000>
+        # gerbl 0.9: <Idle,MPos:0.000,0.000,0.000,WPos:0.000,0.000,0.000>
+        body = message.strip('<>')
+        state = re.split('[|,:]', body)[0]
+        coords = {key: np.array(vals, dtype=float) for key, *vals in
+                  re.findall(r'(MPos|WPos|WCO):([-\d.]+),([-\d.]+),([-\d.]+)', body)}
+
+        with self.status_cond:
+            self.state = state
+            if 'WCO' in coords:
+                self.wco = coords['WCO']
+            if 'MPos' in coords:
+                self.mpos = coords['MPos']
+            elif 'WPos' in coords:
+                self.mpos = coords['WPos'] + self.wco
+            if self.status_log is not None and self.mpos is not None:
+                self.status_log.append((time.monotonic(), self.mpos - self.wco))
+            self._status_received += 1
+            self.status_cond.notify_all()
+
+    def machine_position(self):
+        """
+        Position from the latest gerbl status report, converted to Opentrons coordinates.
+        Unlike self.pos, which holds the last commanded target, this is where the machine actually is.
+        :return: np.array of x, y, z or None if no status report has been received
+        """
+        with self.status_cond:
+            if self.mpos is None:
+                return None
+            cnc_pos = self.mpos - self.wco
+
+        return self._cnc_to_opentrons(cnc_pos)
+
+    def _cnc_to_opentrons(self, cnc_pos):
+        # Inverse of the transform in move_gcode, works on (..., 3) arrays
+        offset = np.array([-self.cnc_xlim[0] - 2, self.ylim[1] + 2, self.zlim[1] + 2])
+        return np.asarray(cnc_pos) + offset
+
+    def start_position_log(self):
+        # Record the position from every status report from now on, with the host time it arrived
+        with self.status_cond:
+            self.status_log = []
+
+    def stop_position_log(self):
+        """
+        Stop recording status report positions.
+        :return: (times, positions) arrays, time.monotonic() seconds and Opentrons coordinates
+        """
+        with self.status_cond:
+            log = self.status_log or []
+            self.status_log = None
+
+        if not log:
+            return np.zeros(0), np.zeros((0, 3))
+        times = np.array([entry[0] for entry in log])
+        positions = self._cnc_to_opentrons(np.array([entry[1] for entry in log]))
+        return times, positions
+
+    def wait_until_idle(self, timeout=None, sync=True):
+        """
+        Block until every move sent so far is finished and a status report requested after that reports Idle.
+        gerbl can report Idle between acknowledging a move and starting it, so Idle alone does not mean done:
+        a G4P0 dwell is acknowledged only once the planner is empty and the machine has stopped.
+        :param timeout: seconds to wait, defaults to cmd_timeout
+        :param sync: send the G4P0 barrier first, off while jogging, when gerbl refuses G-code lines
+        :return: machine position in Opentrons coordinates
+        """
+        if self.simulate:
+            return self.pos
+
+        if timeout is None:
+            timeout = self.cmd_timeout
+        deadline = time.monotonic() + timeout
+
+        if sync:
+            self._send_cmd('G4P0', timeout=timeout)
+
+        with self.status_cond:
+            # Reports to requests already in flight may predate the last command
+            target = self._status_requested + 1
+            while True:
+                if self._status_received >= target:
+                    if self.state == 'Idle':
+                        break
+                    if self.state.startswith('Alarm'):
+                        raise GrblAlarm(self.state)
+                    target = self._status_received + 1
+
+                # Without the background poller, request reports here
+                if not self.status_interval and self._status_requested < target:
+                    self.request_status()
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"gerbl did not report Idle after {timeout} s (state: {self.state})")
+                self.status_cond.wait(remaining)
+
+        return self.machine_position()
+
+    def move_gcode(self, feed=None, jog=False, **pos):
         # Get coordinate axes to move
         axes = pos.keys()
 
         # Constrain target position to machine limits
         pos = self._update_position(pos)
 
-        # GCode move command
-        gcode = 'G0'
+        # GCode move command, rapid unless a feed rate in mm/min is given
+        if jog:
+            # Jogs need a feed rate and are absolute here so repeated jogs cannot drift past the limits
+            gcode = f'$J=G90 G21 F{feed}'
+        elif feed is None:
+            gcode = 'G0'
+        else:
+            gcode = f'G1 F{feed}'
 
         # If x coordinate is specified append it to the GCode command
         if 'x' in axes:
@@ -152,11 +461,115 @@ class Robot:
             cnc_z = pos['z'] - self.zlim[1] - 2  # CNC z-axis moves negative in Opentrons coordinates
             gcode += f' Z{cnc_z}'
 
-        # Send GCode command
-        self._send_cmd(gcode)
+        return gcode
+
+    def move_head(self, **pos):
+        # Send GCode move command, the reply means it has been planned
+        self._send_cmd(self.move_gcode(**pos))
+
+        # Wait for move to finish
+        self.wait_until_idle()
+
+    def jog(self, feed, wait_for_ok=False, **pos):
+        # Jog towards a position at feed mm/min, returns the reply future unless waiting for it
+        return self._send_cmd(self.move_gcode(feed=feed, jog=True, **pos), wait_for_ok=wait_for_ok)
+
+    def jog_cancel(self):
+        """
+        Stop jogging at once and flush the jogs gerbl has planned.
+        Jog lines still in the receive buffer are not flushed, wait for their replies before cancelling.
+        :return: position the machine stopped at in Opentrons coordinates
+        """
+        if self.simulate:
+            return self.pos
+
+        # 0x85 is a real-time command, gerbl acts on it immediately and does not reply
+        self.serial.write(b'\x85')
+        pos = self.wait_until_idle(sync=False)
+
+        # The commanded target is wherever the jog stopped
+        self.pos[:] = pos
+        return pos
+
+    async def move_head_async(self, **pos):
+        # Await the move reply on the event loop instead of blocking it
+        reply = self._send_cmd(self.move_gcode(**pos), wait_for_ok=False)
+        if reply is not None:
+            await asyncio.wait_for(asyncio.wrap_future(reply), self.cmd_timeout)
 
         # Wait for move to finish
-        self._send_cmd("G4P0")
+        return await self.wait_until_idle_async()
+
+    async def wait_until_idle_async(self, timeout=None):
+        # wait_until_idle blocks on a condition, so run it in the default executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.wait_until_idle, timeout)
+
+    def stream(self, commands):
+        """
+        Stream G-code to gerbl using its character-counting protocol.
+        Lines are sent as long as they fit in gerbl's serial receive buffer, so the planner can look ahead
+        instead of waiting for a round-trip per line.
+        Callable items are sync points: streaming pauses until gerbl reports Idle, then the callable is run.
+        :param commands: iterable of G-code strings and/or callables
+        :return:
+        """
+        # Commands sent but not yet acknowledged, as (length, future) pairs
+        in_flight = deque()
+        buffered = 0
+
+        for item in commands:
+            if callable(item):
+                # Every earlier line must be planned before Idle means the motion is finished
+                for length, reply in in_flight:
+                    reply.result(timeout=self.cmd_timeout)
+                in_flight.clear()
+                buffered = 0
+                self.wait_until_idle()
+
+                item()
+                continue
+
+            # Strip comments and whitespace, gerbl counts every byte including the newline
+            line = item.split(';')[0].strip()
+            if not line:
+                continue
+            length = len(line) + 1
+
+            # Wait for the oldest lines to be acknowledged until the new line fits in the receive buffer
+            while in_flight and buffered + length > self.rx_buffer_size:
+                done, reply = in_flight.popleft()
+                reply.result(timeout=self.cmd_timeout)
+                buffered -= done
+
+            reply = self._send_cmd(line, wait_for_ok=False)
+            if reply is not None:
+                in_flight.append((length, reply))
+                buffered += length
+
+        # Wait for the remaining lines
+        for length, reply in in_flight:
+            reply.result(timeout=self.cmd_timeout)
+
+    def stream_points(self, points, on_point=None):
+        """
+        Stream moves through a list of points in Opentrons coordinates.
+        :param points: (N, 3) array of x, y, z positions
+        :param on_point: optional callable on_point(i, point), run once the robot has stopped at each point
+        :return:
+        """
+        def commands():
+            for i, point in enumerate(points):
+                yield self.move_gcode(x=point[0], y=point[1], z=point[2])
+                if on_point is not None:
+                    yield lambda i=i, point=point: on_point(i, point)
+
+        self.stream(commands())
+
+    def stream_file(self, filename):
+        # Stream a G-code file, e.g. one written by generate_gcode.py
+        with open(filename, 'r') as file:
+            self.stream(file)
 
     def home(self, axes='xyz'):
         # Home all axes
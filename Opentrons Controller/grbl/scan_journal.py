@@ -0,0 +1,186 @@
+"""
+Append-only checkpoint journal for long point scans.
+
+Every measured point is appended to the journal as one JSON line and fsync'd before the scan moves on, so an
+interrupted map (USB timeout, Ctrl-C, power cut) keeps everything measured so far. The journal file is named after
+a hash of the scan plan: the machine coordinates of the points and the probe settings. Running the same plan
+again finds its journal, skips the completed points and measures only the rest.
+
+The journal also records the origin the scan was planned with. On resume the origin must still match, and one
+completed point is measured again to check that the robot and probe still see the same field there, e.g. that
+the probe holder was not bumped while the scan was down.
+
+    journal = scan_journal.ScanJournal.for_plan(valid_points, origin_info, params=utilities.params)
+    field_vals = asyncio.run(utilities.scan_points_async(valid_points, journal=journal))
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from robot import robot
+
+
+def plan_hash(points, **settings):
+    """
+    Hash of a scan plan.
+    :param points: (N, 3) array of points in machine (Opentrons) coordinates, in scan order
+    :param settings: anything else that changes the readings, e.g. probe parameters, as JSON serialisable values
+    :return: hex digest
+    """
+    digest = hashlib.sha256(np.ascontiguousarray(np.round(points, 6), dtype='<f8').tobytes())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+def _to_json(value):
+    # numpy values in journal records
+    return np.asarray(value).tolist()
+
+
+class ScanJournal:
+    def __init__(self, filename, plan, n_points, origin_info=None):
+        """
+        Open a journal, creating it if it does not exist yet.
+        :param filename: journal file
+        :param plan: plan hash the journal belongs to
+        :param n_points: number of points of the plan
+        :param origin_info: (4, 3) origin and axes the plan was made with, as in origin_info.csv
+        """
+        self.filename = filename
+        self.plan = plan
+        self.n_points = n_points
+        self.origin_info = None if origin_info is None else np.asarray(origin_info, dtype=float)
+
+        # Journal record of each completed point by index
+        self.completed = {}
+        self.lock = threading.Lock()
+
+        resumed = os.path.exists(filename) and self._load()
+        # A journal without a complete header was interrupted before it recorded anything, start it again
+        self.file = open(filename, 'a' if resumed else 'w')
+        if not resumed:
+            self._write({'plan': plan, 'points': n_points, 'created': time.time(),
+                         'origin_info': None if origin_info is None else self.origin_info.tolist()})
+
+    @classmethod
+    def for_plan(cls, points, origin_info=None, directory='.', **settings):
+        """
+        Journal of a scan plan, resumed if one was started before.
+        :param points: (N, 3) points in machine coordinates, in scan order
+        :param origin_info: (4, 3) origin and axes the points are measured in
+        :param directory: where journals are kept
+        :param settings: probe settings and anything else that changes the readings
+        :return: ScanJournal
+        """
+        plan = plan_hash(points, **settings)
+        journal = cls(os.path.join(directory, f"scan_{plan}.journal"), plan, len(points), origin_info)
+        if journal.n_points and not journal.remaining:
+            print(f"{journal.filename} already has all {journal.n_points} points of this plan, nothing is measured "
+                  f"again; delete it to measure the plan again")
+        return journal
+
+    def _load(self):
+        # Read the completed points of an existing journal, False if it has no complete header
+        with open(self.filename, 'rb') as file:
+            lines = file.readlines()
+
+        if not lines or not lines[0].endswith(b'\n'):
+            print(f"Warning: {self.filename} was interrupted before its header was written, starting it again")
+            return False
+
+        # A last line cut short by the interruption is dropped, its point is measured again
+        if not lines[-1].endswith(b'\n'):
+            os.truncate(self.filename, os.path.getsize(self.filename) - len(lines.pop()))
+
+        header = json.loads(lines[0])
+        if header['plan'] != self.plan or header['points'] != self.n_points:
+            raise ValueError(f"{self.filename} belongs to another scan plan")
+        if header['origin_info'] is not None:
+            self.origin_info = np.asarray(header['origin_info'])
+
+        for line in lines[1:]:
+            record = json.loads(line)
+            self.completed[record['i']] = record
+        return True
+
+    def _write(self, record):
+        # One line per record, on disk before returning
+        self.file.write(json.dumps(record, default=_to_json) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def append(self, i, field, **extra):
+        """
+        Record a completed point.
+        :param i: point index in the plan
+        :param field: Bx, By, Bz in mT
+        :param extra: other per-point values: numbers, arrays or dicts of them
+        :return:
+        """
+        record = {'i': int(i), 'time': time.time(), 'field': field, **extra}
+
+        with self.lock:
+            self._write(record)
+            self.completed[int(i)] = record
+
+    @property
+    def remaining(self):
+        return self.n_points - len(self.completed)
+
+    def verify_origin(self, origin_info, tolerance=0.01):
+        """
+        Check that the origin has not been recalibrated since the journal was started.
+        :param origin_info: current (4, 3) origin and axes
+        :param tolerance: allowed difference in mm and in axis components
+        :return:
+        """
+        if self.origin_info is None:
+            return
+        if not np.allclose(self.origin_info, origin_info, atol=tolerance):
+            raise ValueError(f"Origin changed since {self.filename} was started, "
+                             f"delete the journal to measure the plan again in the new frame")
+
+    def verify_point(self, points, read_field, tolerance=None, repeats=3, n_sigma=5, min_tolerance=0.001):
+        """
+        Measure the last completed point again and compare it with its journaled reading.
+        Unless a tolerance is given, it is derived from the noise of the two: the journaled noise estimate of the
+        point, or the spread of the new readings if the journal has none (fixed averaging, same settings).
+        :param points: plan points in machine coordinates
+        :param read_field: callable returning Bx, By, Bz in mT at the current position, e.g. utilities.read_field
+        :param tolerance: allowed difference in mT on each axis, None to derive it from the noise
+        :param repeats: readings taken at the point when the tolerance is derived, at least 2
+        :param n_sigma: allowed difference in standard deviations of the difference
+        :param min_tolerance: smallest derived tolerance in mT, e.g. for noiseless readings
+        :return: difference in mT, or None if no point is completed yet
+        """
+        if not self.completed:
+            return None
+
+        i = max(self.completed, key=lambda index: self.completed[index]['time'])
+        record = self.completed[i]
+        robot.move_head(x=points[i][0], y=points[i][1], z=points[i][2])
+
+        if tolerance is None:
+            readings = np.array([read_field() for _ in range(max(repeats, 2))])
+            field = readings.mean(axis=0)
+            # Noise of one new reading, and of the journaled one
+            sigma = np.max(np.std(readings, axis=0, ddof=1))
+            journaled_sigma = record.get('sigma')
+            if journaled_sigma is None or not np.isfinite(journaled_sigma):
+                journaled_sigma = sigma
+            tolerance = max(n_sigma * np.sqrt(journaled_sigma ** 2 + sigma ** 2 / len(readings)), min_tolerance)
+        else:
+            field = read_field()
+
+        difference = np.asarray(field) - record['field']
+        if np.max(np.abs(difference)) > tolerance:
+            raise ValueError(f"Point {i} reads {difference} mT off its journaled value (tolerance {tolerance:.4f} "
+                             f"mT), check the probe mounting and origin before resuming")
+        return difference
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,221 @@
+"""
+Ordering of scan points to cut travel time between them.
+
+gerbl moves all axes at once, so a move takes as long as its slowest axis: the cost of a move is the largest
+per-axis distance divided by that axis' max rate. Orderings are seeded with a serpentine (boustrophedon) sweep
+per slice and with nearest-neighbour tours, then refined with 2-opt and Or-opt moves. All cost evaluations are
+vectorized over candidate positions.
+"""
+import numpy as np
+
+
+def _speeds(max_rate):
+    # mm/min -> mm/s
+    return np.asarray(max_rate, dtype=float) / 60
+
+
+def _cost(a, b):
+    # Move time between points already divided by the axis speeds
+    return np.max(np.abs(a - b), axis=-1)
+
+
+def travel_times(points, max_rate):
+    # Time of each move between consecutive points, in seconds
+    return np.max(np.abs(np.diff(points, axis=0)) / _speeds(max_rate), axis=1)
+
+
+def path_time(points, max_rate, start=None):
+    # Total travel time through the points in order, optionally starting from a given position
+    if start is not None:
+        points = np.vstack((start, points))
+    return travel_times(points, max_rate).sum()
+
+
+def serpentine_order(points, decimals=3):
+    """
+    Boustrophedon order: X slices, Y rows within each slice and Z along each row, reversing direction
+    on alternate rows and slices so no row ends with a travel back to its start.
+    :param points: (N, 3) array of points
+    :return: index array into points
+    """
+    coords = np.round(points, decimals)
+    slice_idx = np.unique(coords[:, 0], return_inverse=True)[1]
+    row_idx = np.unique(coords[:, 1], return_inverse=True)[1]
+
+    # Alternate slices sweep rows in opposite directions
+    row_key = np.where(slice_idx % 2 == 0, row_idx, -row_idx)
+
+    # Number the rows in the order they are visited to alternate the column direction
+    by_row = np.lexsort((row_key, slice_idx))
+    new_row = np.ones(len(points), dtype=bool)
+    new_row[1:] = (np.diff(slice_idx[by_row]) != 0) | (np.diff(row_key[by_row]) != 0)
+    visit = np.empty(len(points), dtype=int)
+    visit[by_row] = np.cumsum(new_row)
+
+    col_key = np.where(visit % 2 == 0, coords[:, 2], -coords[:, 2])
+    return np.lexsort((col_key, row_key, slice_idx))
+
+
+def nearest_neighbour_order(points, max_rate, start=0):
+    """
+    Greedy tour that always moves to the closest unvisited point.
+    :param start: index of the first point
+    :return: index array into points
+    """
+    scaled = points / _speeds(max_rate)
+    n = len(points)
+    order = np.empty(n, dtype=int)
+
+    # Unvisited points, the visited one is swapped with the last entry and dropped
+    remaining = np.arange(n)
+    R = scaled.copy()
+    current = start
+    for k in range(n):
+        order[k] = remaining[current]
+        last = n - k - 1
+        remaining[current] = remaining[last]
+        R[current] = R[last]
+        if last == 0:
+            break
+        current = np.argmin(_cost(R[:last], scaled[order[k]]))
+
+    return order
+
+
+def two_opt(points, order, max_rate, window=256, max_passes=3, tol=1e-9):
+    """
+    Reverse path segments while that shortens the path. The path is open: it does not return to its start.
+    :param window: only segments up to this many points long are tried, which keeps large sets fast
+    :return: improved index array
+    """
+    order = order.copy()
+    P = points[order] / _speeds(max_rate)
+    n = len(order)
+    cost = _cost
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n - 2):
+            # Replace edges (i, i+1) and (j, j+1) by (i, j) and (i+1, j+1) for j > i+1 within the window
+            j = np.arange(i + 2, min(n, i + 2 + window))
+            has_next = j < n - 1
+            after = np.minimum(j + 1, n - 1)
+            removed = cost(P[i], P[i + 1]) + np.where(has_next, cost(P[j], P[after]), 0)
+            added = cost(P[i], P[j]) + np.where(has_next, cost(P[i + 1], P[after]), 0)
+            gain = removed - added
+
+            best = np.argmax(gain)
+            if gain[best] > tol:
+                k = j[best]
+                order[i + 1:k + 1] = order[i + 1:k + 1][::-1]
+                P[i + 1:k + 1] = P[i + 1:k + 1][::-1]
+                improved = True
+        if not improved:
+            break
+
+    return order
+
+
+def or_opt(points, order, max_rate, segment_lengths=(1, 2, 3), window=256, max_passes=3, tol=1e-9):
+    """
+    Move short runs of consecutive points to a better place in the path, optionally reversed.
+    :param window: only places within this many points of the run are tried
+    :return: improved index array
+    """
+    scaled = points / _speeds(max_rate)
+    order = order.copy()
+    P = scaled[order]
+    n = len(order)
+    cost = _cost
+
+    def removal_gain(a, b):
+        # Travel saved by taking the segment a..b out and joining its neighbours
+        gain = 0.0
+        if a > 0:
+            gain += cost(P[a - 1], P[a])
+        if b < n - 1:
+            gain += cost(P[b], P[b + 1])
+        if 0 < a and b < n - 1:
+            gain -= cost(P[a - 1], P[b + 1])
+        return gain
+
+    for _ in range(max_passes):
+        improved = False
+        for length in segment_lengths:
+            if n <= length + 2:
+                continue
+
+            # Segments in the middle of a straight run save nothing when removed, only try the others
+            a = np.arange(1, n - length)
+            b = a + length - 1
+            gains = cost(P[a - 1], P[a]) + cost(P[b], P[b + 1]) - cost(P[a - 1], P[b + 1])
+            candidates = np.concatenate(([0], a[gains > tol], [n - length]))
+
+            for a in candidates:
+                b = a + length - 1
+                removal = removal_gain(a, b)
+                if removal <= tol:
+                    continue
+
+                # Insertion into edge (k, k+1) for every nearby edge not touching the segment
+                k = np.arange(max(0, a - window), min(n - 1, b + window))
+                k = k[(k < a - 1) | (k > b)]
+                if len(k) == 0:
+                    continue
+                edge = cost(P[k], P[k + 1])
+                forward = cost(P[k], P[a]) + cost(P[b], P[k + 1]) - edge
+                backward = cost(P[k], P[b]) + cost(P[a], P[k + 1]) - edge
+                insertion = np.minimum(forward, backward)
+
+                best = np.argmin(insertion)
+                if removal - insertion[best] > tol:
+                    segment = order[a:b + 1]
+                    if backward[best] < forward[best]:
+                        segment = segment[::-1]
+                    j = k[best]
+                    if j < a:
+                        order = np.concatenate((order[:j + 1], segment, order[j + 1:a], order[b + 1:]))
+                    else:
+                        order = np.concatenate((order[:a], order[b + 1:j + 1], segment, order[j + 1:]))
+                    P = scaled[order]
+                    improved = True
+        if not improved:
+            break
+
+    return order
+
+
+def order_points(points, max_rate, start=None, refine=True, window=256, max_passes=2):
+    """
+    Find a fast order to visit the points.
+    :param points: (N, 3) array of points
+    :param max_rate: per-axis max rate in mm/min
+    :param start: position the robot starts from, the tour begins nearest to it
+    :param refine: refine the best seed with 2-opt and Or-opt
+    :param window: neighbourhood size for the refinement moves
+    :return: (ordered points, predicted travel time in s, travel time of the original order in s)
+    """
+    points = np.asarray(points, dtype=float)
+    original_time = path_time(points, max_rate, start)
+    if len(points) < 3:
+        return points, original_time, original_time
+
+    if start is None:
+        first = 0
+    else:
+        speeds = _speeds(max_rate)
+        first = np.argmin(_cost(points / speeds, start / speeds))
+
+    candidates = [serpentine_order(points), nearest_neighbour_order(points, max_rate, first)]
+    # Either end of a sweep can come first
+    candidates += [candidate[::-1] for candidate in candidates]
+
+    times = [path_time(points[candidate], max_rate, start) for candidate in candidates]
+    order = candidates[int(np.argmin(times))]
+
+    if refine:
+        order = two_opt(points, order, max_rate, window=window, max_passes=max_passes)
+        order = or_opt(points, order, max_rate, window=window, max_passes=max_passes)
+
+    ordered = points[order]
+    return ordered, path_time(ordered, max_rate, start), original_time
@@ -0,0 +1,114 @@
+"""
+Staged scan pipeline: motion, acquisition and post-processing run as separate stages joined by bounded queues.
+
+    motion ──arrived──> acquisition ──readings──> post-processing
+       ^                     │
+       └─────released────────┘
+
+The motion stage moves to a point and hands it to the acquisition stage, which releases the robot the moment the
+probe reading is complete: the next move is commanded while the reading is still being converted, journaled and
+written by the post-processing stage on a worker thread. The readings queue holds up to `depth` readings, so a
+slow disk delays the scan only once that many readings are waiting.
+
+Every stage counts the time it spends working (busy), waiting for input (starved) and waiting for the next stage
+(blocked). The stage with the highest utilisation is the one that sets the scan time.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        # Seconds spent working, waiting for input and waiting for the next stage
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def utilisation(self, wall):
+        return self.busy / wall if wall > 0 else 0.0
+
+
+async def _timed(coroutine, stats, counter):
+    # Await coroutine and add the time it took to one of the stage counters
+    start = time.monotonic()
+    try:
+        return await coroutine
+    finally:
+        setattr(stats, counter, getattr(stats, counter) + time.monotonic() - start)
+
+
+async def run_pipeline(items, move, acquire, process, depth=2):
+    """
+    Move, acquire and post-process a sequence of points, overlapping post-processing with the next move.
+    :param items: sequence of (index, point)
+    :param move: coroutine function move(index, point), returns once the robot is at the point
+    :param acquire: coroutine function acquire(index), returns the reading at the point
+    :param process: function process(index, reading), runs on a worker thread in point order
+    :param depth: readings waiting for post-processing before acquisition waits for it
+    :return: (dict of StageStats by stage name, wall time in s)
+    """
+    loop = asyncio.get_running_loop()
+    stages = {name: StageStats(name) for name in ('motion', 'acquisition', 'post-processing')}
+
+    arrived = asyncio.Queue(maxsize=1)
+    released = asyncio.Queue(maxsize=1)
+    readings = asyncio.Queue(maxsize=depth)
+
+    # One worker keeps post-processing in point order and off the event loop
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    async def motion():
+        stats = stages['motion']
+        for index, point in items:
+            await _timed(move(index, point), stats, 'busy')
+            await _timed(arrived.put(index), stats, 'blocked')
+            # The probe must not move while it reads
+            await _timed(released.get(), stats, 'blocked')
+            stats.items += 1
+        await arrived.put(None)
+
+    async def acquisition():
+        stats = stages['acquisition']
+        while True:
+            index = await _timed(arrived.get(), stats, 'starved')
+            if index is None:
+                break
+            reading = await _timed(acquire(index), stats, 'busy')
+            released.put_nowait(index)
+            await _timed(readings.put((index, reading)), stats, 'blocked')
+            stats.items += 1
+        await readings.put(None)
+
+    async def post_processing():
+        stats = stages['post-processing']
+        while True:
+            item = await _timed(readings.get(), stats, 'starved')
+            if item is None:
+                break
+            await _timed(loop.run_in_executor(executor, process, *item), stats, 'busy')
+            stats.items += 1
+
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(stage()) for stage in (motion, acquisition, post_processing)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # One stage failed or the scan was interrupted, stop the others
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+    return stages, time.monotonic() - start
+
+
+def print_utilisation(stages, wall):
+    # Share of the scan time each stage spent working, waiting for input and waiting for the next stage
+    print(f"{'stage':<17}{'items':>7}{'busy':>8}{'starved':>9}{'blocked':>9}")
+    for stats in stages.values():
+        print(f"{stats.name:<17}{stats.items:>7}{stats.utilisation(wall):>8.0%}"
+              f"{stats.starved / wall if wall else 0:>9.0%}{stats.blocked / wall if wall else 0:>9.0%}")
@@ -0,0 +1,430 @@
+"""
+Declarative scan plans: one file describes a field map, one executor runs it.
+
+A plan is a TOML or JSON file with the sections below. Everything but lattice.type has a default. Lattice
+coordinates are in the bore frame of origin_info.csv (X along the bore axis, origin at the bore center) and are
+turned into machine coordinates with the origin and axes saved there.
+
+    name = "gradients"
+
+    [region]                   # bore frame
+    origin = "origin_info.csv" # origin and axes file written by the App
+    radius = 145               # bore radius in mm
+    length = 440               # bore length in mm
+    clearance = 30             # distance kept from the bore wall in mm
+
+    [lattice]
+    type = "radial"            # grid | radial | ring | line
+    angles = [90, 45, 0, -45]  # radial: one line through the axis per angle in degrees, count points each
+    count = 30
+
+    [order]
+    method = "travel"          # travel (shortest travel time) | serpentine | planned
+    continuous = false         # radial and line: sweep each line at constant feed, see continuous_scan.py
+
+    [probe]                    # overrides utilities.params, and adaptive/burst switch utilities.adaptive/burst
+    average = 30000
+
+    [output]
+    csv = "{name}_{group}.csv"            # per group, in bore coordinates like measure_points.py
+    readings = "{name}_{group}.readings"  # streamed while scanning, "" for none
+    journal = true                        # resume an interrupted group where it stopped
+
+Lattices split into groups, each scanned and saved on its own: one group for grid and ring, one per angle for
+radial and one per offset for line. Expanding a plan (validating it, building the lattice, dropping points
+outside the bore or workspace and ordering them) is done once: the point arrays are cached in
+plan_<hash>.npz, keyed by the plan and origin, so the same plan starts at once and always measures the same points.
+
+    python scan_plan.py plans/gradients.toml --expand     # validate and show the points and travel time
+    python scan_plan.py plans/gradients.toml              # run on the CNC and probe
+    python scan_plan.py plans/gradients.toml --emulate    # run on the simulated CNC and probe
+"""
+import argparse
+import asyncio
+import json
+import os
+
+import numpy as np
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11, JSON plans only
+    tomllib = None
+
+import readings_file
+import scan_journal
+import scan_order
+import utilities
+from pyTHM1176.api.thm_core import Thm1176Core
+from robot import robot
+
+lattice_types = ['grid', 'radial', 'ring', 'line']
+order_methods = ['travel', 'serpentine', 'planned']
+
+# Keys of each section with their type and default, None for no default
+schema = {
+    'name': (str, 'scan'),
+    'region': {'origin': ((str, list), 'origin_info.csv'), 'radius': ((int, float), utilities.bore_radius),
+               'length': ((int, float), utilities.bore_length), 'clearance': ((int, float), 20)},
+    'lattice': {'type': (str, None), 'spacing': ((int, float), 10), 'angles': (list, [0]), 'count': (int, 30),
+                'x': ((int, float), 0), 'x_range': (list, None), 'step': ((int, float), 5),
+                'ring_radius': ((int, float), None), 'offsets': (list, [[0, 0]])},
+    'order': {'method': (str, 'travel'), 'continuous': (bool, False)},
+    'probe': {'range': (str, None), 'average': (int, None), 'format': (str, None), 'adaptive': (bool, None),
+              'burst': ((bool, dict), None)},
+    'output': {'csv': (str, '{name}_{group}.csv'), 'readings': (str, '{name}_{group}.readings'),
+               'journal': (bool, True)},
+}
+
+
+def load_plan(filename):
+    """
+    Read and validate a plan file.
+    :param filename: .toml or .json plan
+    :return: plan dict with every default filled in
+    """
+    if filename.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError(f"{filename}: TOML plans need Python 3.11 or later, use JSON")
+        with open(filename, 'rb') as file:
+            plan = tomllib.load(file)
+    else:
+        with open(filename) as file:
+            plan = json.load(file)
+    return validate(plan, filename)
+
+
+def _is_number(value):
+    # bool is an int, but not a number of points or mm
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_numbers(value, length=None):
+    # List of numbers, of the given length if any
+    return isinstance(value, list) and all(_is_number(item) for item in value) and \
+        (length is None or len(value) == length)
+
+
+def validate(plan, source='plan'):
+    """
+    Check a plan against the schema and fill in the defaults. All problems are reported together.
+    :param plan: plan dict as read from the file
+    :param source: name used in error messages
+    :return: validated plan
+    """
+    errors = []
+    # Keys whose type is wrong, their values are not looked into further
+    invalid = set()
+
+    def check(key, value, types):
+        types = types if isinstance(types, tuple) else (types,)
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            errors.append(f"{key} is {value!r}")
+            invalid.add(key)
+
+    if not isinstance(plan, dict):
+        raise ValueError(f"Invalid scan plan {source}: not a table of sections")
+
+    validated = {}
+    for section, keys in schema.items():
+        if not isinstance(keys, dict):
+            validated[section] = plan.get(section, keys[1])
+            check(section, validated[section], keys[0])
+            continue
+
+        values = plan.get(section, {})
+        if not isinstance(values, dict):
+            errors.append(f"{section} must be a table")
+            values = {}
+        for key in sorted(set(values) - set(keys)):
+            errors.append(f"unknown key {section}.{key}")
+        validated[section] = {}
+        for key, (types, default) in keys.items():
+            value = values.get(key, default)
+            if value is not None:
+                check(f"{section}.{key}", value, types)
+            validated[section][key] = value
+    for section in sorted(set(plan) - set(schema)):
+        errors.append(f"unknown section {section}")
+
+    def valid(key):
+        # Present and of the right type
+        section, name = key.split('.')
+        return key not in invalid and validated[section][name] is not None
+
+    region, lattice, order, probe = validated['region'], validated['lattice'], validated['order'], validated['probe']
+    if valid('region.origin') and isinstance(region['origin'], list) and not _is_numbers(region['origin'], 3):
+        errors.append("region.origin must be a file name or [x, y, z]")
+    for key in ('radius', 'length'):
+        if valid(f'region.{key}') and region[key] <= 0:
+            errors.append(f"region.{key} must be positive")
+    if valid('region.clearance') and valid('region.radius') and not 0 <= region['clearance'] < region['radius']:
+        errors.append("region.clearance must be between 0 and region.radius")
+
+    if lattice['type'] not in lattice_types:
+        errors.append(f"lattice.type must be one of {', '.join(lattice_types)}")
+    for key in ('spacing', 'count', 'step', 'ring_radius'):
+        if valid(f'lattice.{key}') and lattice[key] <= 0:
+            errors.append(f"lattice.{key} must be positive")
+    if valid('lattice.angles') and not _is_numbers(lattice['angles']):
+        errors.append("lattice.angles must be a list of angles in degrees")
+    if valid('lattice.x_range') and not _is_numbers(lattice['x_range'], 2):
+        errors.append("lattice.x_range must be [min, max]")
+    if valid('lattice.offsets') and not all(_is_numbers(offset, 2) for offset in lattice['offsets']):
+        errors.append("lattice.offsets must be a list of [y, z] pairs")
+
+    if valid('order.method') and order['method'] not in order_methods:
+        errors.append(f"order.method must be one of {', '.join(order_methods)}")
+    if valid('order.continuous') and order['continuous'] and lattice['type'] not in ('radial', 'line'):
+        errors.append("order.continuous needs a radial or line lattice")
+
+    if valid('probe.burst') and isinstance(probe['burst'], dict):
+        # Same keys and kinds of values as utilities.burst
+        for key, value in probe['burst'].items():
+            if key not in utilities.burst or key == 'enabled':
+                errors.append(f"unknown key probe.burst.{key}")
+            elif isinstance(utilities.burst[key], int) and not (_is_number(value) and float(value).is_integer()):
+                errors.append(f"probe.burst.{key} is {value!r}")
+            elif not _is_number(value) or value <= 0:
+                errors.append(f"probe.burst.{key} is {value!r}")
+    if valid('probe.range') and probe['range'] not in Thm1176Core.ranges:
+        errors.append(f"probe.range must be one of {', '.join(Thm1176Core.ranges)}")
+
+    if errors:
+        raise ValueError(f"Invalid scan plan {source}: " + "; ".join(errors))
+    return validated
+
+
+def lattice_groups(plan):
+    """
+    Points of each group of the plan's lattice in the bore frame, before clipping to the workspace.
+    :param plan: validated plan
+    :return: list of (group name, (N, 3) points, (3,) direction of the group's line or None)
+    """
+    region, lattice = plan['region'], plan['lattice']
+    inner = region['radius'] - region['clearance']
+    x_range = lattice['x_range'] or [-region['length'] / 2, region['length'] / 2]
+
+    if lattice['type'] == 'grid':
+        # Cubic grid through the bore center, like utilities.get_valid_points_cartesian
+        spacing = lattice['spacing']
+        X = np.arange(np.ceil(x_range[0] / spacing), np.floor(x_range[1] / spacing) + 1) * spacing
+        YZ = np.arange(-np.floor(inner / spacing), np.floor(inner / spacing) + 1) * spacing
+        points = np.array(np.meshgrid(X, YZ, YZ, indexing='ij')).reshape(3, -1).T
+        return [('grid', points[np.hypot(points[:, 1], points[:, 2]) <= inner], None)]
+
+    if lattice['type'] == 'radial':
+        # Lines through the bore axis across the full diameter, like map_gradients.py
+        groups = []
+        R = np.linspace(-region['radius'], region['radius'], lattice['count'])
+        R = R[np.abs(R) <= inner]
+        for angle in lattice['angles']:
+            direction = np.array([0, np.cos(np.radians(angle)), np.sin(np.radians(angle))])
+            groups.append((f"{angle:g}", np.array([lattice['x'], 0, 0]) + np.outer(R, direction), direction))
+        return groups
+
+    if lattice['type'] == 'ring':
+        # Circle around the bore axis, like generate_ring_points.py
+        radius = inner if lattice['ring_radius'] is None else lattice['ring_radius']
+        theta = np.arange(0, 360, lattice['step'])
+        theta = np.radians(theta)
+        points = np.column_stack([np.full_like(theta, lattice['x']), -radius * np.cos(theta), radius * np.sin(theta)])
+        return [('ring', points, None)]
+
+    # Lines parallel to the bore axis at each [y, z] offset, like map_gradients_linear.py
+    groups = []
+    X = np.arange(x_range[0], x_range[1] + lattice['spacing'] / 2, lattice['spacing'])
+    for i, (y, z) in enumerate(lattice['offsets']):
+        if np.hypot(y, z) <= inner:
+            points = np.column_stack([X, np.full_like(X, y), np.full_like(X, z)])
+            groups.append((str(i), points, np.array([1.0, 0, 0])))
+    return groups
+
+
+def in_workspace(points):
+    # Points the Opentrons can reach, in machine coordinates
+    inside = np.ones(len(points), dtype=bool)
+    for axis, limits in enumerate([utilities.opentrons_x_range, utilities.opentrons_y_range,
+                                   utilities.opentrons_z_range]):
+        inside &= (points[:, axis] >= limits[0]) & (points[:, axis] <= limits[1])
+    return inside
+
+
+def order_group(points, method):
+    # Indices visiting the points in the plan's order
+    if method == 'planned' or len(points) < 3:
+        return np.arange(len(points))
+    if method == 'serpentine':
+        return scan_order.serpentine_order(points)
+
+    ordered = scan_order.order_points(points, robot.max_rate)[0]
+    index = {tuple(np.round(point, 6)): i for i, point in enumerate(points)}
+    return np.array([index[tuple(np.round(point, 6))] for point in ordered])
+
+
+def read_origin(plan):
+    # (4, 3) origin and axes: the origin file, or an explicit origin with the machine axes
+    origin = plan['region']['origin']
+    if isinstance(origin, str):
+        return utilities.read_points(origin)
+    return np.vstack([origin, np.eye(3)])
+
+
+def expand(plan, origin_info, directory='.'):
+    """
+    Machine coordinates of every group of the plan, from the cache if the plan was expanded before.
+    :param plan: validated plan
+    :param origin_info: (4, 3) origin and axes of the bore frame
+    :param directory: where expanded plans are cached
+    :return: dict of {group name: {'points': (N, 3) machine coordinates in scan order,
+                                   'true': (N, 3) bore coordinates, 'direction': (3,) or None}}
+    """
+    origin, rotation_matrix = origin_info[0], origin_info[1:4]
+    key = scan_journal.plan_hash(origin_info, region=plan['region'], lattice=plan['lattice'], order=plan['order'],
+                                 max_rate=robot.max_rate.tolist(),
+                                 workspace=[utilities.opentrons_x_range, utilities.opentrons_y_range,
+                                            utilities.opentrons_z_range])
+    filename = os.path.join(directory, f"plan_{key}.npz")
+
+    groups = {}
+    if os.path.exists(filename):
+        with np.load(filename) as cache:
+            for name in json.loads(str(cache['groups'])):
+                direction = cache[f"{name}/direction"]
+                groups[name] = {'points': cache[f"{name}/points"], 'true': cache[f"{name}/true"],
+                                'direction': direction if direction.size else None}
+        return groups
+
+    arrays = {}
+    for name, true, direction in lattice_groups(plan):
+        # Bore frame to machine coordinates, the axes are the rows of the rotation matrix
+        points = true @ rotation_matrix + origin
+        keep = in_workspace(points)
+        points, true = points[keep], true[keep]
+        order = order_group(points, plan['order']['method'])
+        groups[name] = {'points': points[order], 'true': true[order], 'direction': direction}
+
+        arrays[f"{name}/points"] = groups[name]['points']
+        arrays[f"{name}/true"] = groups[name]['true']
+        arrays[f"{name}/direction"] = np.zeros(0) if direction is None else direction
+    np.savez(filename, groups=json.dumps(list(groups)), **arrays)
+    return groups
+
+
+def apply_probe_settings(plan):
+    # Plan probe settings on top of the utilities defaults, call after utilities.connect_probe
+    probe = plan['probe']
+    for key in ('range', 'average', 'format'):
+        if probe[key] is not None:
+            utilities.params[key] = probe[key]
+    if probe['adaptive'] is not None:
+        utilities.adaptive['enabled'] = probe['adaptive']
+    if isinstance(probe['burst'], dict):
+        # Integer settings may come as whole floats from JSON
+        utilities.burst.update({key: type(utilities.burst[key])(value) for key, value in probe['burst'].items()},
+                               enabled=True)
+    elif probe['burst'] is not None:
+        utilities.burst['enabled'] = probe['burst']
+
+
+def run_group(plan, name, group, origin_info):
+    """
+    Scan one group and save its readings.
+    :param plan: validated plan
+    :param name: group name
+    :param group: expanded group
+    :param origin_info: (4, 3) origin and axes of the bore frame
+    :return: (N, 3) bore coordinates, (N, 3) fields in mT
+    """
+    output = plan['output']
+    points, true_coordinates, direction = group['points'], group['true'], group['direction']
+    origin, rotation_matrix = origin_info[0], origin_info[1:4]
+    filenames = {key: output[key].format(name=plan['name'], group=name) if output[key] else None
+                 for key in ('csv', 'readings')}
+    print(f"Group {name}: {len(points)} points")
+
+    # Radial lines also record the position along the line
+    extra_columns = ["R[mm]"] if plan['lattice']['type'] == 'radial' else []
+    writer = readings_file.ReadingsWriter(filenames['readings'], extra=extra_columns, chunk=1) \
+        if filenames['readings'] else None
+
+    def along(coords):
+        return {"R[mm]": coords @ direction} if extra_columns else {}
+
+    extra = {}
+    if plan['order']['continuous']:
+        # Sweep from one end of the line to the other, positions follow from the sampled ones
+        import continuous_scan
+        samples = continuous_scan.scan_path(utilities.thm, points[[0, -1]])
+        true_coordinates = (samples[:, :3] - origin) @ rotation_matrix.T
+        fields = samples[:, 3:]
+        if writer is not None:
+            writer.extend(true_coordinates, fields, along(true_coordinates))
+    else:
+        journal = None
+        if output['journal']:
+            journal = scan_journal.ScanJournal.for_plan(points, origin_info, params=utilities.params,
+                                                        adaptive=utilities.adaptive, burst=utilities.burst)
+            if journal.completed:
+                print(f"Resuming {journal.filename}: {len(journal.completed)} of {len(points)} points done")
+                journal.verify_origin(origin_info)
+                journal.verify_point(points, utilities.read_field)
+                if writer is not None:
+                    for i, record in sorted(journal.completed.items()):
+                        writer.append(true_coordinates[i], record['field'], along(true_coordinates[i]))
+
+        def report(i, field):
+            if writer is not None:
+                writer.append(true_coordinates[i], field, along(true_coordinates[i]))
+
+        stats = {}
+        fields = asyncio.run(utilities.scan_points_async(points, on_reading=report, stats=stats, journal=journal))
+        if journal is not None:
+            journal.close()
+        extra = {"Average": stats['average'], "Sigma[mT]": stats['sigma']}
+        if 'burst' in stats:
+            extra.update(utilities.burst_columns(stats['burst']))
+
+    if writer is not None:
+        writer.close()
+    if filenames['csv']:
+        utilities.save_readings(true_coordinates, fields, filenames['csv'], extra={**along(true_coordinates), **extra})
+    return true_coordinates, fields
+
+
+def run(plan, origin_info=None, directory='.'):
+    """
+    Scan every group of a plan with the robot and probe already connected.
+    :param plan: validated plan
+    :param origin_info: (4, 3) origin and axes, defaults to the plan's region.origin
+    :param directory: where expanded plans are cached
+    :return: dict of {group name: (bore coordinates, fields in mT)}
+    """
+    origin_info = read_origin(plan) if origin_info is None else np.asarray(origin_info, dtype=float)
+    groups = expand(plan, origin_info, directory)
+    apply_probe_settings(plan)
+    return {name: run_group(plan, name, group, origin_info) for name, group in groups.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validate, expand and run a scan plan")
+    parser.add_argument('plan', help=".toml or .json scan plan")
+    parser.add_argument('--expand', action='store_true', help="only expand the plan and show its points")
+    parser.add_argument('--emulate', action='store_true', help="run on the simulated CNC and probe")
+    parser.add_argument('--port', default="COM6", help="CNC serial port")
+    args = parser.parse_args()
+
+    plan = load_plan(args.plan)
+    origin_info = read_origin(plan)
+    groups = expand(plan, origin_info)
+
+    for name, group in groups.items():
+        travel_time = scan_order.path_time(group['points'], robot.max_rate)
+        print(f"Group {name}: {len(group['points'])} points, predicted travel time {travel_time:.1f} s")
+
+    if not args.expand:
+        robot.connect('Emulate' if args.emulate else args.port)
+        robot.home()
+        utilities.connect_probe('Emulate' if args.emulate else None)
+        run(plan, origin_info)
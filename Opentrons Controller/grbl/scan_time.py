@@ -0,0 +1,151 @@
+"""
+Scan duration estimates for point plans.
+
+Each move is timed with a trapezoidal profile per axis (gerbl max rate and acceleration), the slowest axis
+setting the move time. Each point adds the probe integration time for its averaging count, USB overhead, a
+settle delay and host overhead. Everything is vectorized, and predict_scan_times evaluates many plans in one go
+so candidate spacings, clearances and shapes can be compared quickly.
+
+Usage:
+    python scan_time.py valid_points.csv [other_plan.csv ...] --average 30000
+"""
+import argparse
+
+import numpy as np
+
+from robot import robot
+import utilities
+
+# Machine limits default to the robot's gerbl settings, probe parameters to utilities.connect_probe
+default_settings = {
+    'max_rate': robot.max_rate,         # mm/min per axis
+    'acceleration': robot.acceleration, # mm/s^2 per axis
+    'start': robot.pos,                 # starting position in Opentrons coordinates
+    'average': 30000,                   # probe averaging count
+    'sample_time': 122e-6,              # s per averaged sample, the THM1176 minimum trigger period
+    'probe_overhead': 0.02,             # s per reading for the USB trigger and fetch transactions
+    'settle_time': 0.0,                 # s to wait after each move before reading
+    'host_overhead': 0.03,              # s per point for status polling, serial replies and Python work
+}
+
+phases = ['motion', 'integration', 'probe_overhead', 'settle', 'host']
+
+
+def axis_move_times(distances, max_rate, acceleration):
+    """
+    Time for each axis to travel the given distances with a trapezoidal speed profile.
+    :param distances: (..., 3) absolute per-axis distances in mm
+    :return: (..., 3) times in s
+    """
+    v = np.asarray(max_rate, dtype=float) / 60
+    a = np.asarray(acceleration, dtype=float)
+
+    # Short moves never reach full speed and follow a triangular profile
+    triangular = distances <= v ** 2 / a
+    return np.where(triangular, 2 * np.sqrt(distances / a), distances / v + v / a)
+
+
+def move_times(points, settings=None, start=None):
+    # Time of each move through the points, starting from settings['start'] unless given
+    settings = {**default_settings, **(settings or {})}
+    if start is None:
+        start = settings['start']
+    path = np.vstack((start, points))
+    distances = np.abs(np.diff(path, axis=0))
+    return axis_move_times(distances, settings['max_rate'], settings['acceleration']).max(axis=1)
+
+
+def _per_point_times(settings):
+    integration = settings['average'] * settings['sample_time']
+    return {'integration': integration,
+            'probe_overhead': settings['probe_overhead'],
+            'settle': settings['settle_time'],
+            'host': settings['host_overhead']}
+
+
+def predict_scan_time(points, settings=None):
+    """
+    Predict how long a scan of the points takes, in the given order.
+    :param points: (N, 3) array of points in Opentrons coordinates
+    :param settings: dict overriding entries of default_settings
+    :return: dict with the total and per-phase times in s
+    """
+    settings = {**default_settings, **(settings or {})}
+    points = np.asarray(points, dtype=float)
+
+    breakdown = {'motion': move_times(points, settings).sum()}
+    for phase, t in _per_point_times(settings).items():
+        breakdown[phase] = t * len(points)
+
+    breakdown['total'] = sum(breakdown[phase] for phase in phases)
+    breakdown['points'] = len(points)
+    return breakdown
+
+
+def predict_scan_times(plans, settings=None):
+    """
+    Predict scan times for many plans at once.
+    All moves of all plans are timed in a single vectorized pass and summed per plan.
+    :param plans: list of (N_i, 3) point arrays
+    :param settings: dict overriding entries of default_settings, shared by all plans
+    :return: dict of arrays with the total and per-phase times in s, one entry per plan
+    """
+    settings = {**default_settings, **(settings or {})}
+    start = np.asarray(settings['start'], dtype=float)
+
+    # Each plan starts from the start position, so prepend it and drop the moves that join plans
+    counts = np.array([len(plan) for plan in plans])
+    path = np.vstack([np.vstack((start, plan)) for plan in plans])
+    distances = np.abs(np.diff(path, axis=0))
+    times = axis_move_times(distances, settings['max_rate'], settings['acceleration']).max(axis=1)
+
+    # Moves into the next plan's start position join two plans and belong to neither
+    offsets = np.concatenate(([0], np.cumsum(counts + 1)[:-1]))
+    times[offsets[1:] - 1] = 0
+    motion = np.add.reduceat(np.append(times, 0), offsets)
+    motion[counts == 0] = 0
+
+    breakdown = {'motion': motion}
+    for phase, t in _per_point_times(settings).items():
+        breakdown[phase] = t * counts
+
+    breakdown['total'] = sum(breakdown[phase] for phase in phases)
+    breakdown['points'] = counts
+    return breakdown
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predict the duration of scan point plans")
+    parser.add_argument('plans', nargs='+', help="CSV point files as written by save_points")
+    parser.add_argument('--average', type=int, default=default_settings['average'], help="probe averaging count")
+    parser.add_argument('--settle', type=float, default=default_settings['settle_time'], help="settle time per point in s")
+    parser.add_argument('--host-overhead', type=float, default=default_settings['host_overhead'],
+                        help="host overhead per point in s")
+    parser.add_argument('--max-rate', type=float, nargs=3, default=default_settings['max_rate'],
+                        help="gerbl max rate per axis in mm/min")
+    parser.add_argument('--acceleration', type=float, nargs=3, default=default_settings['acceleration'],
+                        help="gerbl acceleration per axis in mm/s^2")
+    args = parser.parse_args()
+
+    settings = {'average': args.average, 'settle_time': args.settle, 'host_overhead': args.host_overhead,
+                'max_rate': args.max_rate, 'acceleration': args.acceleration}
+
+    plans = [utilities.read_points(filename).reshape(-1, 3) for filename in args.plans]
+    breakdown = predict_scan_times(plans, settings)
+
+    print(f"{'plan':<30}{'points':>8}" + ''.join(f"{phase:>16}" for phase in phases) + f"{'total':>12}")
+    for i, filename in enumerate(args.plans):
+        row = f"{filename:<30}{breakdown['points'][i]:>8}"
+        row += ''.join(f"{format_duration(breakdown[phase][i]):>16}" for phase in phases)
+        row += f"{format_duration(breakdown['total'][i]):>12}"
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
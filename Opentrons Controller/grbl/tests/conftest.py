@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The grbl scripts import each other and pyTHM1176 from their own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,43 @@
+'''
+Ring buffer of probe samples: wrapping, snapshots and resizing.
+'''
+import numpy as np
+
+from pyTHM1176.ring_buffer import RingBuffer
+
+
+def block(values):
+    values = np.asarray(values, dtype=float)
+    zeros = np.zeros(len(values))
+    return {'Bx': values, 'By': zeros, 'Bz': zeros, 'Timestamp': values, 'Temperature': zeros}
+
+
+def test_wrap():
+    buffer = RingBuffer(5)
+    buffer.append(block(range(3)))
+    buffer.append(block(range(3, 7)))
+
+    assert buffer.columns()['Bx'].tolist() == [2, 3, 4, 5, 6]
+    assert buffer.snapshot(2)['Timestamp'].tolist() == [5, 6]
+    assert (buffer.total, buffer.dropped) == (7, 2)
+
+
+def test_resize():
+    buffer = RingBuffer(5)
+    buffer.append(block(range(7)))
+
+    # Growing keeps what was in memory and makes room for more
+    buffer.resize(10)
+    assert buffer.columns()['Bx'].tolist() == [2, 3, 4, 5, 6]
+    buffer.append(block(range(7, 14)))
+    assert buffer.columns()['Bx'].tolist() == list(range(4, 14))
+
+    # Shrinking keeps the most recent records
+    buffer.resize(3)
+    assert buffer.columns()['Bx'].tolist() == [11, 12, 13]
+    buffer.append(block([14]))
+    assert buffer.columns()['Bx'].tolist() == [12, 13, 14]
+    assert (buffer.total, buffer.dropped) == (15, 12)
+
+    buffer.clear()
+    assert len(buffer) == 0 and len(buffer.snapshot()) == 0
@@ -0,0 +1,96 @@
+"""
+Validation, lattices and expansion of scan plans, without the robot or probe.
+"""
+import os
+
+import numpy as np
+import pytest
+
+import scan_plan
+import utilities
+
+# Bore center in the middle of the Opentrons workspace, machine axes
+origin_info = np.vstack([[150, 125, -25], np.eye(3)])
+
+
+def test_defaults():
+    plan = scan_plan.validate({'lattice': {'type': 'grid'}})
+
+    assert plan['name'] == 'scan'
+    assert plan['region']['radius'] == utilities.bore_radius
+    assert plan['lattice']['spacing'] == 10
+    assert plan['order'] == {'method': 'travel', 'continuous': False}
+    assert plan['probe']['average'] is None
+    assert plan['output']['journal'] is True
+
+
+def test_errors_reported_together():
+    plan = {'lattice': {'type': 'spiral', 'count': 'many', 'angles': [0, 'up']},
+            'region': {'radius': -1, 'colour': 'red'},
+            'probe': {'range': '2T', 'burst': {'block_size': 2.5, 'speed': 1}},
+            'extra': {}}
+    with pytest.raises(ValueError) as error:
+        scan_plan.validate(plan, 'test.toml')
+
+    message = str(error.value)
+    for problem in ["test.toml", "lattice.type must be one of", "lattice.count is 'many'", "lattice.angles must be",
+                    "region.radius must be positive", "unknown key region.colour", "probe.range must be one of",
+                    "probe.burst.block_size is 2.5", "unknown key probe.burst.speed", "unknown section extra"]:
+        assert problem in message
+
+
+@pytest.mark.parametrize('plan', [[], {'lattice': []}, {'lattice': {'type': 'line', 'offsets': [[0, True]]}},
+                                  {'lattice': {'type': 'grid'}, 'order': {'continuous': True}}])
+def test_invalid(plan):
+    with pytest.raises(ValueError):
+        scan_plan.validate(plan)
+
+
+def test_radial_lattice():
+    plan = scan_plan.validate({'lattice': {'type': 'radial', 'angles': [90, 0], 'count': 30, 'x': -220},
+                               'region': {'clearance': 30}})
+    groups = scan_plan.lattice_groups(plan)
+
+    assert [name for name, _, _ in groups] == ['90', '0']
+    for name, points, direction in groups:
+        # Across the diameter through the axis, within the clearance
+        assert np.all(points[:, 0] == -220)
+        assert np.allclose(points[:, 1] * direction[2] - points[:, 2] * direction[1], 0)
+        assert np.all(np.linalg.norm(points[:, 1:], axis=1) <= utilities.bore_radius - 30)
+    assert np.allclose(groups[0][2], [0, 0, 1])
+
+
+def test_ring_and_line_lattices():
+    ring = scan_plan.lattice_groups(scan_plan.validate({'lattice': {'type': 'ring', 'step': 5, 'x': -220},
+                                                        'region': {'radius': 145, 'clearance': 80}}))
+    assert len(ring) == 1 and len(ring[0][1]) == 72
+    assert np.allclose(np.linalg.norm(ring[0][1][:, 1:], axis=1), 65)
+
+    lines = scan_plan.lattice_groups(scan_plan.validate(
+        {'lattice': {'type': 'line', 'spacing': 10, 'x_range': [-20, 20], 'offsets': [[0, 0], [200, 0]]}}))
+    # The second line is outside the bore
+    assert [name for name, _, _ in lines] == ['0']
+    assert np.allclose(lines[0][1][:, 0], [-20, -10, 0, 10, 20])
+
+
+def test_expand_cache(tmp_path):
+    plan = scan_plan.validate({'lattice': {'type': 'grid', 'spacing': 40}, 'order': {'method': 'serpentine'}})
+    groups = scan_plan.expand(plan, origin_info, str(tmp_path))
+
+    points, true = groups['grid']['points'], groups['grid']['true']
+    assert np.allclose(points, true + origin_info[0])
+    assert np.all(scan_plan.in_workspace(points))
+    assert groups['grid']['direction'] is None
+
+    # Expanded once, the same points come back from plan_<hash>.npz
+    cached = os.listdir(tmp_path)
+    assert len(cached) == 1 and cached[0].startswith('plan_')
+    again = scan_plan.expand(plan, origin_info, str(tmp_path))
+    assert np.array_equal(again['grid']['points'], points)
+    assert again['grid']['direction'] is None
+
+    # Another plan or origin is expanded on its own
+    moved = origin_info.copy()
+    moved[0, 0] += 10
+    scan_plan.expand(plan, moved, str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 2
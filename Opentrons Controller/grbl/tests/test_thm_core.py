@@ -0,0 +1,139 @@
+'''
+Decoding of THM1176 fetch responses, on byte streams in the format the instrument sends them.
+'''
+import struct
+
+import numpy as np
+import pytest
+
+from pyTHM1176.api.thm_core import split_binary_response, parse_ieee_block_header
+from pyTHM1176.thm_sim import SimulatedThm1176
+
+# Tesla per count of each axis used to decode INTEGER responses
+scale = np.array([1.2e-8, 1.1e-8, 1.3e-8])
+
+
+def block(counts):
+    # IEEE definite length block of big endian 32 bit counts, e.g. #212<12 bytes>
+    data = struct.pack('>{}i'.format(len(counts)), *counts)
+    length = str(len(data)).encode('ascii')
+    return b'#' + str(len(length)).encode('ascii') + length + data
+
+
+# Counts whose bytes are ';', ',' and '\n': 0x3B2C0A3B, 0x0A3B2C0A and 0x2C0A3B2C
+awkward = [0x3B2C0A3B, 0x0A3B2C0A, 0x2C0A3B2C]
+
+
+@pytest.fixture
+def thm():
+    thm = SimulatedThm1176(trigger_type='single', format='ASCII')
+    thm.integer_scale[thm.range] = scale
+    return thm
+
+
+def test_blocks_with_separator_bytes():
+    response = b';'.join([block(awkward), block(awkward[::-1]), block([-1, 0, 1]), b'0x0000000012345678', b'27',
+                          b'0']) + b'\n'
+    fields = split_binary_response(response)
+
+    assert len(fields) == 6
+    assert fields[0].tolist() == awkward
+    assert fields[1].tolist() == awkward[::-1]
+    assert fields[2].tolist() == [-1, 0, 1]
+    assert fields[3:] == [b'0x0000000012345678', b'27', b'0']
+
+
+def test_indefinite_block():
+    data = struct.pack('>3i', *awkward)
+    response = b'#0' + data + b'\n'
+
+    assert parse_ieee_block_header(response) == (2, len(data))
+    assert split_binary_response(response)[0].tolist() == awkward
+
+
+def test_truncated_block():
+    response = block(awkward)[:-3]
+    with pytest.raises(ValueError):
+        split_binary_response(response)
+
+
+def test_integer_array_fetch(thm):
+    thm.format = 'INTEGER'
+    kinds = ['Bx', 'By', 'Bz', 'Timestamp', 'Temperature']
+    response = b';'.join([block(awkward), block([5, -5, 7]), block([0, 1, -1]), b'0x00000000000F4240', b'27',
+                          b'0']) + b'\n'
+
+    reading = thm.decode_fetch(response, kinds, count=3)
+
+    assert np.allclose(reading['Bx'], np.array(awkward) * scale[0])
+    assert np.allclose(reading['By'], np.array([5, -5, 7]) * scale[1])
+    assert np.allclose(reading['Bz'], np.array([0, 1, -1]) * scale[2])
+    assert np.isclose(reading['Timestamp'][-1], 1e-3)
+    assert np.all(reading['Temperature'] == 27)
+
+
+def test_integer_scalar_fetch(thm):
+    # Scalar fetches come back as plain numbers instead of blocks
+    thm.format = 'INTEGER'
+    reading = thm.decode_fetch(b'4760000;-12;0;0\n', thm.field_axes, count=1)
+
+    assert np.allclose(reading['Bx'], 4760000 * scale[0])
+    assert np.allclose(reading['By'], -12 * scale[1])
+    assert np.allclose(reading['Bz'], 0)
+
+
+def test_ascii_scalar_fetch(thm):
+    reading = thm.decode_fetch(b'0.05712T;-1.2E-5T;3.0E-6T;0x00000000000F4240;27;0\n',
+                               ['Bx', 'By', 'Bz', 'Timestamp', 'Temperature'], count=1)
+
+    assert np.allclose(reading['Bx'], 0.05712)
+    assert np.allclose(reading['By'], -1.2e-5)
+    assert np.allclose(reading['Bz'], 3e-6)
+
+
+def test_ascii_array_fetch(thm):
+    reading = thm.decode_fetch(b'0.1T,0.2T,0.3T;0T,0T,0T;-0.1T,-0.2T,-0.3T;0\n', thm.field_axes, count=3)
+
+    assert np.allclose(reading['Bx'], [0.1, 0.2, 0.3])
+    assert np.allclose(reading['Bz'], [-0.1, -0.2, -0.3])
+
+
+def test_truncated_response(thm):
+    # Cut off before the status byte
+    with pytest.raises(ValueError):
+        thm.decode_fetch(b'0.05712T;-1.2E-5T;3.0E-6T', thm.field_axes, count=1)
+    thm.format = 'INTEGER'
+    with pytest.raises(ValueError):
+        thm.decode_fetch(block(awkward) + b';' + block(awkward)[:-2], thm.field_axes, count=3)
+
+
+def test_integer_zero_field():
+    # The INTEGER scale is the nominal one of the range, setup needs no field to calibrate against
+    thm = SimulatedThm1176(field_model=lambda position: np.array([0.05712, 0.0, 0.0]), noise=0,
+                           trigger_type='single', format='INTEGER')
+    reading = thm.measure()
+
+    assert np.allclose(thm.integer_scale[thm.range], 0.1 / 2 ** 23)
+    assert np.allclose(reading['Bx'], 0.05712, atol=2e-8)
+    assert np.allclose(reading['By'], 0.0, atol=2e-8)
+    assert thm.applied['format'] == 'INTEGER'
+
+
+def test_failed_setup_forgets_settings(thm):
+    # A setting is only recorded once its commands are sent, a failed write leaves nothing recorded
+    write = thm.write
+
+    def timeout(message, *args):
+        if message.startswith(':TRIG:COUNT'):
+            raise TimeoutError("USB timeout")
+        return write(message, *args)
+
+    thm.write = timeout
+    with pytest.raises(TimeoutError):
+        thm.setup(trigger_type='burst', block_size=10, period=0.01, average=5)
+    assert thm.applied == {}
+
+    thm.write = write
+    thm.setup(trigger_type='burst', block_size=10, period=0.01, average=5)
+    assert thm.applied['trigger'] == ('burst', 0.01, 10)
+    assert len(thm.measure()['Bx']) == 10
@@ -3,10 +3,14 @@ from robot import robot
 from scipy.optimize import least_squares
 
 import time
+import asyncio
 
 import usbtmc as backend
 import pyTHM1176.api.thm_usbtmc_api as thm_api
 
+import scan_order
+import scan_pipeline
+
 # Bore and Opentrons dimensions
 bore_diameter = 290
 bore_radius = bore_diameter / 2
@@ -27,20 +31,53 @@ def read_points(filename):
     points = np.loadtxt(filename, delimiter=",", skiprows=1)  # Skip the header row
     return points
 
-def save_points(filename, points):
+def save_points(filename, points, footer=None):
     # Save calibration points to CSV
     headers = "X[mm],Y[mm],Z[mm]"
     np.savetxt(filename, points, delimiter=",", header=headers, comments="")
 
-def connect_probe():
+    # Extra information goes in a trailing comment line, which read_points skips
+    if footer is not None:
+        with open(filename, 'a') as file:
+            file.write(f"# {footer}\n")
+
+def order_points(points, start=None):
+    # Order points for the shortest travel time at the robot's axis speeds
+    ordered, travel_time, original_time = scan_order.order_points(points, robot.max_rate, start)
+    print(f"Predicted travel time: {travel_time:.1f} s (grid order: {original_time:.1f} s, "
+          f"saving {original_time - travel_time:.1f} s)")
+    return ordered, travel_time, original_time
+
+# Adaptive averaging: a few pilot readings estimate the noise at pilot_average, then each point gets the smallest
+# averaging count whose noise meets max(abs_tolerance, rel_tolerance * |B|), in mT, up to max_average
+adaptive = {'enabled': False, 'pilot_average': 1000, 'pilot_readings': 4,
+            'abs_tolerance': 0.0005, 'rel_tolerance': 1e-5, 'max_average': 30000}
+
+# Burst readings: each point is one periodic block of block_size samples, averaged over average counts each and
+# period s apart, giving the spread and drift of the field at the point as well as its mean.
+# The defaults take about as long as one 30000 count reading. Takes precedence over adaptive averaging.
+burst = {'enabled': False, 'block_size': 96, 'period': 0.035, 'average': 256}
+burst_stat_names = ['mean', 'std', 'min', 'max', 'slope']
+
+def probe_position():
+    # Where the probe is for the simulated probe: the machine position, or the commanded one without status reports
+    position = robot.machine_position()
+    return robot.pos if position is None else position
+
+def connect_probe(device=None):
     global params
     global thm
 
     # Parameters of the THM1176 probe
-    params = {"trigger_type": "single", 'range': '0.1T', 'average': 30000, 'format': 'ASCII'}
+    params = {"trigger_type": "single", 'range': '0.1T', 'average': 30000, 'format': 'INTEGER'}
 
-    # Connect to the first probe in the list of devices
-    thm = thm_api.Thm1176(backend.list_devices()[0], **params)
+    if device == 'Emulate':
+        # Simulated probe in a uniform field at the robot position, like robot.connect('Emulate')
+        from pyTHM1176.thm_sim import SimulatedThm1176
+        thm = SimulatedThm1176(position=probe_position, **params)
+    else:
+        # Connect to the given probe or the first one in the list of devices
+        thm = thm_api.Thm1176(device if device is not None else backend.list_devices()[0], **params)
 
     # Get device id string and print output. This can be used to check communications are OK
     device_id = thm.get_id()
@@ -73,8 +110,11 @@ def move_relative(point):
     move_to(pos)
 
 def read_field():
+    # Only settings that differ from the probe's current ones are sent
     thm.make_measurement(**params)
-    meas = thm.last_reading
+    return reading_to_field(thm.last_reading)
+
+def reading_to_field(meas):
     measurements = list(meas.values())
 
     # Readings in mT aligned with bore coordinates
@@ -84,12 +124,176 @@ def read_field():
 
     return np.array([Bx, By, Bz]).flatten()
 
-def save_readings(coords, readings, filename):
-    # Horizontally stack the coordinates and readings
-    data = np.hstack((coords, readings))
+def measure_field(average):
+    # Single reading with a given averaging count, only the count is resent to the probe
+    thm.make_measurement(**{**params, 'average': average})
+    return reading_to_field(thm.last_reading)
+
+def choose_average(pilot_fields, pilot_average):
+    '''
+    Smallest averaging count that meets the adaptive noise target, noise falls as 1/sqrt(count)
+    :param pilot_fields: (k, 3) pilot readings in mT
+    :param pilot_average: averaging count of each pilot reading
+    :return: (averaging count, noise of a single pilot reading in mT)
+    '''
+    sigma = np.max(np.std(pilot_fields, axis=0, ddof=1))
+    magnitude = np.linalg.norm(pilot_fields.mean(axis=0))
+    target = max(adaptive['abs_tolerance'], adaptive['rel_tolerance'] * magnitude)
+
+    average = int(np.ceil(pilot_average * (sigma / target) ** 2))
+    return min(max(average, pilot_average), adaptive['max_average']), sigma
+
+def read_field_adaptive():
+    '''
+    Read the field with just enough averaging for the adaptive noise target.
+    The pilot readings count towards the final average.
+    :return: (field in mT, total averaging count, estimated noise in mT)
+    '''
+    pilot_average = adaptive['pilot_average']
+    pilot = np.array([measure_field(pilot_average) for _ in range(adaptive['pilot_readings'])])
+    average, pilot_sigma = choose_average(pilot, pilot_average)
+
+    pilot_total = pilot_average * len(pilot)
+    if average <= pilot_total:
+        field = pilot.mean(axis=0)
+        average = pilot_total
+    else:
+        # Average the rest in one reading and weight it with the pilots by count
+        rest = average - pilot_total
+        field = (rest * measure_field(rest) + pilot_average * pilot.sum(axis=0)) / average
+
+    return field, average, pilot_sigma * np.sqrt(pilot_average / average)
+
+def burst_params():
+    # Probe parameters of a burst, range and format as for single readings
+    return {**params, 'trigger_type': 'burst', 'block_size': burst['block_size'], 'period': burst['period'],
+            'average': burst['average']}
+
+def burst_statistics(meas):
+    '''
+    Statistics of the samples of one burst
+    :param meas: reading of a burst, as thm.last_reading
+    :return: dict of mean, std, min and max in mT and slope in mT/s, each of Bx, By, Bz along the bore axes.
+             A burst of a single sample has no spread or drift to measure, its std and slope are 0.
+    '''
+    fields = reading_to_field(meas).reshape(3, -1)
+    t = np.asarray(meas['Timestamp'])
+    dt = t - t.mean()
+    n = fields.shape[1]
+
+    return {'mean': fields.mean(axis=1),
+            'std': fields.std(axis=1, ddof=1) if n > 1 else np.zeros(3),
+            'min': fields.min(axis=1),
+            'max': fields.max(axis=1),
+            # Least squares slope over the burst, drift or motion of the field during the reading
+            'slope': (fields - fields.mean(axis=1, keepdims=True)) @ dt / (dt @ dt) if n > 1 else np.zeros(3)}
+
+def burst_columns(stats):
+    # save_readings columns of the burst statistics of a scan, e.g. Bx_std[mT], the mean is the field itself
+    units = {'std': 'mT', 'min': 'mT', 'max': 'mT', 'slope': 'mT/s'}
+    return {f"{axis}_{name}[{unit}]": stats[name][:, i]
+            for name, unit in units.items() for i, axis in enumerate(['Bx', 'By', 'Bz'])}
+
+async def read_field_async():
+    # Measure on the probe executor without blocking the event loop
+    meas = await thm.make_measurement_async(**params)
+    return reading_to_field(meas)
+
+async def scan_points_async(points, on_reading=None, stats=None, journal=None):
+    # Move to each point and read the field. Motion, acquisition and post-processing are pipeline stages:
+    # the robot moves on as soon as a reading is complete, while the reading is processed on a worker thread.
+    # If a stats dict is given it receives the averaging count, noise estimate and latency of each point,
+    # and the burst statistics of each point in burst mode, and stats['stages'] the pipeline stage counters.
+    # With a ScanJournal every point is journaled as soon as it is processed, and points already in it are skipped.
+    loop = asyncio.get_running_loop()
+    bursting = burst['enabled']
+    adapting = adaptive['enabled'] and not bursting
+    field_vals = np.zeros((len(points), 3))
+
+    def store(i, field):
+        field_vals[i,:] = field
+        if journal is not None:
+            extra = {'average': averages[i], 'sigma': sigmas[i], 'latency': latencies[i]}
+            if bursting:
+                extra['burst'] = {name: burst_stats[name][i] for name in burst_stat_names}
+            journal.append(i, field, **extra)
+        if on_reading is not None:
+            on_reading(i, field_vals[i])
+
+    def process(i, meas):
+        if bursting:
+            statistics = burst_statistics(meas)
+            for name in burst_stat_names:
+                burst_stats[name][i] = statistics[name]
+            # Noise of the mean of the burst, unknown from a single sample
+            if burst['block_size'] > 1:
+                sigmas[i] = np.max(statistics['std']) / np.sqrt(burst['block_size'])
+            store(i, statistics['mean'])
+        else:
+            store(i, reading_to_field(meas))
+
+    # Configure the probe once, every point then only triggers and fetches
+    probe_params = burst_params() if bursting else params
+    thm.setup(**probe_params)
+
+    # Averaging count, estimated noise (only known in adaptive and burst modes) and time from trigger to reading
+    # of each point
+    total_average = probe_params['average'] * (burst['block_size'] if bursting else 1)
+    averages = np.full(len(points), total_average)
+    sigmas = np.full(len(points), np.nan)
+    latencies = np.zeros(len(points))
+    burst_stats = {name: np.full((len(points), 3), np.nan) for name in burst_stat_names}
+
+    # Points measured before an interruption
+    completed = journal.completed if journal is not None else {}
+    for i, record in completed.items():
+        field_vals[i] = record['field']
+        averages[i], sigmas[i], latencies[i] = record['average'], record['sigma'], record['latency']
+        for name in burst_stat_names:
+            if 'burst' in record:
+                burst_stats[name][i] = record['burst'][name]
+
+    async def move(i, point):
+        await robot.move_head_async(x=point[0], y=point[1], z=point[2])
+
+    async def acquire(i):
+        if adapting:
+            start = time.monotonic()
+            field, averages[i], sigmas[i] = await loop.run_in_executor(thm.executor, read_field_adaptive)
+            latencies[i] = time.monotonic() - start
+            return field
+        meas = await thm.measure_async()
+        latencies[i] = thm.last_latency
+        return meas
+
+    todo = [(i, point) for i, point in enumerate(points) if i not in completed]
+    stages, wall = await scan_pipeline.run_pipeline(todo, move, acquire, store if adapting else process)
+
+    if len(todo):
+        scan_pipeline.print_utilisation(stages, wall)
+    if len(points):
+        print(f"Probe latency per point: mean {latencies.mean():.3f} s, max {latencies.max():.3f} s "
+              f"(expected {thm.expected_acquisition_time(None if bursting else params['average']):.3f} s)")
+        if bursting and burst['block_size'] > 1:
+            print(f"Burst readings: {burst['block_size']} samples per point, "
+                  f"max noise of the mean {np.nanmax(sigmas) * 1000:.2f} uT")
+        elif adaptive['enabled']:
+            print(f"Adaptive averaging: mean count {averages.mean():.0f} (fixed: {params['average']}), "
+                  f"max noise {np.max(sigmas) * 1000:.2f} uT")
+
+    if stats is not None:
+        stats.update(average=averages, sigma=sigmas, latency=latencies, stages=stages)
+        if bursting:
+            stats['burst'] = burst_stats
+    return field_vals
+
+def save_readings(coords, readings, filename, extra=None):
+    # Horizontally stack the coordinates and readings, and any extra per-point columns given as {header: values}
+    extra = extra or {}
+    data = np.column_stack([coords, readings] + list(extra.values()))
     
     # Define column headers
-    headers = "X[mm],Y[mm],Z[mm],Bx[mT],By[mT],Bz[mT]"
+    headers = ",".join(["X[mm],Y[mm],Z[mm],Bx[mT],By[mT],Bz[mT]"] + list(extra.keys()))
     
     # Save to CSV with headers
     np.savetxt(filename, data, delimiter=",", header=headers, comments="")